@@ -1,14 +1,24 @@
 from fastapi import FastAPI, Request, Form, Depends, UploadFile, File
-from fastapi.responses import HTMLResponse, RedirectResponse, Response, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, DateTime, ForeignKey, and_, extract
+from sqlalchemy import create_engine, Column, Integer, String, Float, Date, DateTime, ForeignKey, Index, and_, or_, extract, event, delete, inspect, text, bindparam, func, tuple_, case, false
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import os
 import io
+import asyncio
+import bisect
+import hashlib
+import json
+import re
+import time
+import unicodedata
+import warnings
 from typing import Optional
+from urllib.parse import quote, urlencode
+import numpy as np
 from openpyxl import Workbook, load_workbook
 from openpyxl.styles import Font, Alignment, PatternFill
 from openpyxl.utils import get_column_letter
@@ -16,6 +26,15 @@ from openpyxl.utils import get_column_letter
 # Tạo database
 SQLALCHEMY_DATABASE_URL = "sqlite:///./transport.db"
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+
+def fold_vietnamese(value):
+    """Bỏ dấu tiếng Việt và chuyển chữ thường ("Tăng Cường" -> "tang cuong") để tìm kiếm không phân biệt dấu"""
+    if value is None:
+        return None
+    # "đ" không tách dấu khi chuẩn hoá NFD nên phải thay tay
+    value = unicodedata.normalize("NFD", str(value).replace("đ", "d").replace("Đ", "D"))
+    return "".join(char for char in value if not unicodedata.combining(char)).lower()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -43,9 +62,9 @@ class Employee(Base):
     phone = Column(String)
     cccd = Column(String)  # Số CCCD
     cccd_issue_date = Column(Date)  # Ngày cấp CCCD
-    cccd_expiry = Column(Date)  # Ngày hết hạn CCCD
+    cccd_expiry = Column(Date, index=True)  # Ngày hết hạn CCCD
     driving_license = Column(String)  # Số bằng lái xe
-    license_expiry = Column(Date)  # Ngày hết hạn bằng lái
+    license_expiry = Column(Date, index=True)  # Ngày hết hạn bằng lái
     documents = Column(String)  # Đường dẫn file upload giấy tờ (JSON array)
     status = Column(Integer, default=1)  # 1: Active, 0: Inactive
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -60,9 +79,9 @@ class Vehicle(Base):
     vehicle_info = Column(String)  # Thông tin xe (model/loại)
     capacity = Column(Float)  # Trọng tải
     fuel_consumption = Column(Float)  # Tiêu hao nhiên liệu
-    inspection_expiry = Column(Date)  # Ngày hết hạn đăng kiểm
+    inspection_expiry = Column(Date, index=True)  # Ngày hết hạn đăng kiểm
     inspection_documents = Column(String)  # Đường dẫn file upload sổ đăng kiểm (JSON array)
-    phu_hieu_expired_date = Column(Date)  # Ngày hết hạn phù hiệu vận tải
+    phu_hieu_expired_date = Column(Date, index=True)  # Ngày hết hạn phù hiệu vận tải
     phu_hieu_files = Column(String)  # Đường dẫn file upload phù hiệu vận tải (JSON array)
     status = Column(Integer, default=1)  # 1: Active, 0: Inactive
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -101,9 +120,222 @@ class DailyRoute(Base):
     employee_name = Column(String)  # Tên nhân viên
     notes = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)  # Dùng cho đồng bộ delta
     
     # Relationships
     route = relationship("Route", back_populates="daily_routes")
+    
+    __table_args__ = (
+        Index("ix_daily_routes_date_route", "date", "route_id"),
+        Index("ix_daily_routes_route_date", "route_id", "date"),
+        Index("ix_daily_routes_driver_date", "driver_name", "date"),
+        Index("ix_daily_routes_plate_date", "license_plate", "date"),
+        Index("ix_daily_routes_date_id", "date", "id"),  # Phân trang keyset theo (date, id)
+    )
+
+class DailyRouteTombstone(Base):
+    """Dấu vết chuyến đã xóa - để client offline biết cần xóa bản sao cục bộ khi đồng bộ"""
+    __tablename__ = "daily_route_tombstones"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    daily_route_id = Column(Integer, nullable=False)
+    date = Column(Date)  # Ngày chạy của chuyến đã xóa
+    deleted_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class RouteScheduleTemplate(Base):
+    """Lịch chạy lặp lại hàng tuần của tuyến - dùng để sinh chuyến hàng loạt"""
+    __tablename__ = "route_schedule_templates"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    route_id = Column(Integer, ForeignKey("routes.id"), nullable=False, index=True)
+    weekday = Column(Integer, nullable=False)  # 0: Thứ 2 ... 6: Chủ nhật
+    driver_name = Column(String)  # Tên lái xe mặc định
+    license_plate = Column(String)  # Biển số xe mặc định
+    distance_km = Column(Float)  # Số km mặc định (để trống = 0)
+    notes = Column(String)
+    is_active = Column(Integer, default=1)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    route = relationship("Route")
+    
+    __table_args__ = (
+        # Mỗi tuyến chỉ một lịch cho mỗi thứ, nếu không sinh chuyến sẽ tạo hai chuyến một ngày
+        Index("ix_route_schedule_templates_route_weekday", "route_id", "weekday", unique=True),
+    )
+
+# Tuyến "Tăng Cường" tính lương theo km thực tế thay vì lương tuyến/tháng
+TANG_CUONG_ROUTE_CODE = "Tăng Cường"
+TANG_CUONG_KM_RATE = 1100  # Đơn giá mặc định (đồng/km) khi tạo tuyến
+RATE_HISTORY_START = date(2000, 1, 1)  # Ngày hiệu lực của mức lương đầu tiên (áp dụng cho toàn bộ lịch sử)
+
+class RouteRate(Base):
+    """Lịch sử đơn giá tuyến: mỗi mức áp dụng từ effective_from đến mức kế tiếp,
+    để sửa lương tuyến không làm thay đổi lương các tháng đã qua"""
+    __tablename__ = "route_rates"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    route_id = Column(Integer, ForeignKey("routes.id"), nullable=False)
+    effective_from = Column(Date, nullable=False)
+    monthly_salary = Column(Float, default=0)  # Lương tuyến/tháng
+    km_rate = Column(Float)  # Đơn giá/km (tuyến "Tăng Cường")
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_route_rates_route_from", "route_id", "effective_from", unique=True),
+    )
+
+class SalaryRule(Base):
+    """Quy tắc tính lương chuyến theo loại tuyến ("standard" / "tang_cuong").
+    Lương chuyến = tổng các quy tắc per_trip/per_km/monthly, nâng lên mức minimum, cộng bonus."""
+    __tablename__ = "salary_rules"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    route_type = Column(String, nullable=False, index=True)
+    rule_type = Column(String, nullable=False)  # per_trip, per_km, monthly, minimum, bonus
+    amount = Column(Float)  # per_km/monthly để trống = lấy đơn giá/km của tuyến / chia 30
+    min_km = Column(Float)  # bonus: chỉ áp dụng khi số km >= min_km
+    is_active = Column(Integer, default=1)
+    notes = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class PayrollPeriod(Base):
+    """Tháng lương đã chốt: lương tháng này đọc từ bảng chốt thay vì tính lại từ chuyến"""
+    __tablename__ = "payroll_periods"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    month = Column(String, nullable=False, unique=True, index=True)  # "YYYY-MM"
+    trip_count = Column(Integer, default=0)
+    total_salary = Column(Float, default=0)
+    checksum = Column(String, nullable=False)  # SHA-256 các dòng lương chuyến
+    closed_at = Column(DateTime, default=datetime.utcnow)
+
+class PayrollTripLine(Base):
+    """Lương từng chuyến tại thời điểm chốt tháng"""
+    __tablename__ = "payroll_trip_lines"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    period_id = Column(Integer, ForeignKey("payroll_periods.id"), nullable=False, index=True)
+    daily_route_id = Column(Integer)
+    driver_name = Column(String)
+    route_code = Column(String)
+    route_name = Column(String)
+    date = Column(Date)
+    license_plate = Column(String)
+    distance_km = Column(Float, default=0)
+    salary_type = Column(String)  # "standard" hoặc "tang_cuong"
+    monthly_salary = Column(Float, default=0)
+    daily_salary = Column(Float, default=0)
+
+class PayrollDriverLine(Base):
+    """Tổng lương theo lái xe tại thời điểm chốt tháng"""
+    __tablename__ = "payroll_driver_lines"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    period_id = Column(Integer, ForeignKey("payroll_periods.id"), nullable=False, index=True)
+    driver_name = Column(String)
+    trip_count = Column(Integer, default=0)
+    distance_km = Column(Float, default=0)
+    standard_salary = Column(Float, default=0)
+    tang_cuong_salary = Column(Float, default=0)
+    total_salary = Column(Float, default=0)
+
+class RouteProfitRollup(Base):
+    """Bảng tổng hợp lợi nhuận theo tuyến/tháng, tính lại từng tháng khi dữ liệu nguồn thay đổi.
+    route_code rỗng = thu/chi/dầu chưa gắn được với tuyến nào."""
+    __tablename__ = "route_profit_rollups"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    month = Column(String, nullable=False)  # "YYYY-MM"
+    route_code = Column(String, nullable=False, default="")
+    trip_count = Column(Integer, default=0)
+    distance_km = Column(Float, default=0)
+    revenue = Column(Float, default=0)  # Thu
+    direct_cost = Column(Float, default=0)  # Chi ghi theo tuyến
+    salary_cost = Column(Float, default=0)  # Lương lái xe theo bảng tính lương
+    fuel_cost = Column(Float, default=0)  # Dầu phân bổ theo tỷ lệ km
+    profit = Column(Float, default=0)
+    refreshed_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_route_profit_month_route", "month", "route_code", unique=True),
+    )
+
+class MonthlyRollup(Base):
+    """Số liệu tổng hợp toàn công ty theo tháng, dùng cho biểu đồ xu hướng nhiều năm"""
+    __tablename__ = "monthly_rollups"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    month = Column(String, nullable=False, unique=True, index=True)  # "YYYY-MM"
+    trip_count = Column(Integer, default=0)
+    distance_km = Column(Float, default=0)
+    fuel_liters = Column(Float, default=0)
+    fuel_cost = Column(Float, default=0)
+    income = Column(Float, default=0)  # Thu
+    expense = Column(Float, default=0)  # Chi
+    payroll = Column(Float, default=0)  # Lương lái xe
+    refreshed_at = Column(DateTime, default=datetime.utcnow)
+
+class RollupState(Base):
+    """Mốc dữ liệu nguồn (id nhật ký data_changes) mà từng tháng của một bảng tổng hợp đã được tính theo"""
+    __tablename__ = "rollup_states"
+    
+    rollup = Column(String, primary_key=True)  # "route_profit", ...
+    month = Column(String, primary_key=True)  # "YYYY-MM" ("*" nếu không chia theo tháng)
+    source_version = Column(Integer, nullable=False, default=0)
+
+class DataChange(Base):
+    """Nhật ký thay đổi dữ liệu, ghi bằng trigger nên có cả thay đổi của worker khác và công cụ ngoài ứng dụng"""
+    __tablename__ = "data_changes"
+    __table_args__ = {"sqlite_autoincrement": True}  # id không bị dùng lại sau khi dọn nhật ký
+    
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String, nullable=False)
+    row_id = Column(Integer)
+    date = Column(Date)  # Ngày của dòng (bảng có cột date)
+    changed_at = Column(DateTime, index=True)
+
+class DataVersion(Base):
+    """Id nhật ký mới nhất theo phạm vi: "month:YYYY-MM" (chuyến/đổ dầu/thu chi trong tháng) hoặc "table:<tên bảng>" """
+    __tablename__ = "data_versions"
+    
+    scope = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class ApiIdempotencyKey(Base):
+    """Lưu kết quả của các thao tác API theo idempotency key để gửi lại không bị ghi trùng"""
+    __tablename__ = "api_idempotency_keys"
+    
+    key = Column(String, primary_key=True)
+    response = Column(String, nullable=False)  # Kết quả đã trả về (JSON)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class DocumentExpiryAlert(Base):
+    """Bảng tính sẵn các giấy tờ đã/sắp hết hạn (bằng lái, CCCD, đăng kiểm, phù hiệu)"""
+    __tablename__ = "document_expiry_alerts"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    document_type = Column(String, nullable=False)  # license, cccd, inspection, phu_hieu
+    entity_type = Column(String, nullable=False)  # employee, vehicle
+    entity_id = Column(Integer, nullable=False)
+    entity_name = Column(String)  # Tên nhân viên hoặc biển số xe
+    expiry_date = Column(Date, nullable=False, index=True)
+    refreshed_at = Column(DateTime, default=datetime.utcnow)
+
+class FuelPrice(Base):
+    """Giá nhiên liệu tham chiếu theo loại dầu, áp dụng từ ngày effective_from đến lần điều chỉnh kế tiếp"""
+    __tablename__ = "fuel_prices"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    fuel_type = Column(String, nullable=False, default="Dầu DO 0,05S-II")
+    effective_from = Column(Date, nullable=False)
+    price = Column(Float, nullable=False)  # Đồng/lít
+    notes = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_fuel_prices_type_from", "fuel_type", "effective_from", unique=True),
+    )
 
 class FuelRecord(Base):
     __tablename__ = "fuel_records"
@@ -120,6 +352,11 @@ class FuelRecord(Base):
     
     # Relationships
     vehicle = relationship("Vehicle", foreign_keys=[license_plate], primaryjoin="FuelRecord.license_plate == Vehicle.license_plate")
+    
+    __table_args__ = (
+        Index("ix_fuel_records_date_plate", "date", "license_plate"),
+        Index("ix_fuel_records_date_id", "date", "id"),
+    )
 
 class FinanceRecord(Base):
     __tablename__ = "finance_records"
@@ -158,10 +395,182 @@ class FinanceTransaction(Base):
     note = Column(String)  # Ghi chú
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_finance_transactions_date_id", "date", "id"),
+    )
 
 # Tạo bảng
 Base.metadata.create_all(bind=engine)
 
+# create_all không thêm cột mới cho bảng đã tồn tại -> bổ sung bằng ALTER TABLE ADD COLUMN
+with engine.begin() as _connection:
+    _inspector = inspect(_connection)
+    for _table in Base.metadata.sorted_tables:
+        _existing_columns = {column["name"] for column in _inspector.get_columns(_table.name)}
+        for _column in _table.columns:
+            if _column.name not in _existing_columns:
+                _connection.execute(text(f"ALTER TABLE {_table.name} ADD COLUMN {_column.name} {_column.type.compile(engine.dialect)}"))
+    _connection.execute(text("UPDATE daily_routes SET updated_at = created_at WHERE updated_at IS NULL"))
+
+# Lịch chạy trùng (tuyến, thứ) có từ trước khi có unique index -> giữ dòng đang áp dụng, thêm sau cùng
+with engine.begin() as _connection:
+    _connection.execute(text("""
+        DELETE FROM route_schedule_templates WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (PARTITION BY route_id, weekday ORDER BY is_active DESC, id DESC) AS position
+                FROM route_schedule_templates
+            ) WHERE position > 1
+        )
+    """))
+
+# create_all không thêm index mới cho bảng đã tồn tại -> tạo bổ sung các index còn thiếu
+for _table in Base.metadata.sorted_tables:
+    for _index in _table.indexes:
+        _index.create(bind=engine, checkfirst=True)
+
+# Tuyến chưa có lịch sử đơn giá -> lấy đơn giá hiện tại làm mức áp dụng cho toàn bộ lịch sử
+with engine.begin() as _connection:
+    _connection.execute(text("""
+        INSERT INTO route_rates (route_id, effective_from, monthly_salary, km_rate, created_at)
+        SELECT id, :effective_from, COALESCE(monthly_salary, 0),
+               CASE WHEN TRIM(route_code) = :tang_cuong THEN :km_rate END, :now
+        FROM routes
+        WHERE NOT EXISTS (SELECT 1 FROM route_rates WHERE route_rates.route_id = routes.id)
+    """), {
+        "effective_from": RATE_HISTORY_START.strftime("%Y-%m-%d"),
+        "tang_cuong": TANG_CUONG_ROUTE_CODE,
+        "km_rate": TANG_CUONG_KM_RATE,
+        "now": datetime.utcnow(),
+    })
+    # Chưa có quy tắc lương -> tạo quy tắc mặc định đúng công thức cũ
+    # (tuyến thường: lương tuyến/tháng / 30, Tăng Cường: số km × đơn giá/km của tuyến)
+    if not _connection.execute(text("SELECT 1 FROM salary_rules LIMIT 1")).first():
+        _connection.execute(text("""
+            INSERT INTO salary_rules (route_type, rule_type, amount, is_active, notes, created_at)
+            VALUES ('standard', 'monthly', 30, 1, 'Lương tuyến/tháng chia 30 ngày', :now),
+                   ('tang_cuong', 'per_km', NULL, 1, 'Số km thực tế × đơn giá/km của tuyến', :now)
+        """), {"now": datetime.utcnow()})
+
+# Nhật ký thay đổi: mỗi dòng thêm/sửa/xoá ghi một dòng data_changes và nâng phiên bản của bảng
+# (và của tháng, với bảng có cột date). Viết hoàn toàn bằng SQL để DB vẫn ghi được ngoài ứng dụng.
+CHANGE_TRACKED_TABLES = {
+    "daily_routes": "date", "fuel_records": "date", "finance_transactions": "date",
+    "employees": None, "vehicles": None, "routes": None, "route_rates": None, "salary_rules": None, "payroll_periods": None,
+    "fuel_prices": None,
+}
+
+def _change_trigger_body(table_name: str, date_column: Optional[str], row: str, only_if: str = "true") -> str:
+    """Các câu lệnh trigger ghi nhật ký cho dòng `row` (new/old) khi điều kiện only_if đúng"""
+    day = f"{row}.{date_column}" if date_column else "NULL"
+    # Upsert dạng INSERT ... SELECT luôn cần WHERE để SQLite không hiểu nhầm ON CONFLICT
+    bump = (
+        "INSERT INTO data_versions (scope, version) SELECT {scope}, (SELECT MAX(id) FROM data_changes) WHERE " + only_if +
+        " ON CONFLICT (scope) DO UPDATE SET version = excluded.version;"
+    )
+    statements = [
+        f"INSERT INTO data_changes (table_name, row_id, date, changed_at) SELECT '{table_name}', {row}.id, {day}, CURRENT_TIMESTAMP WHERE {only_if};",
+        bump.format(scope=f"'table:{table_name}'"),
+    ]
+    if date_column:
+        statements.append(bump.format(scope=f"'month:' || substr({day}, 1, 7)"))
+    return " ".join(statements)
+
+with engine.begin() as _connection:
+    for _table_name, _date_column in CHANGE_TRACKED_TABLES.items():
+        _update_body = _change_trigger_body(_table_name, _date_column, "new")
+        if _date_column:
+            # Sửa ngày của dòng -> tháng cũ cũng bị ảnh hưởng
+            _update_body += " " + _change_trigger_body(
+                _table_name, _date_column, "old", f"old.{_date_column} IS NOT new.{_date_column}"
+            )
+        for _event, _body in (
+            ("insert", _change_trigger_body(_table_name, _date_column, "new")),
+            ("update", _update_body),
+            ("delete", _change_trigger_body(_table_name, _date_column, "old")),
+        ):
+            _connection.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS data_changes_{_table_name}_{_event} "
+                f"AFTER {_event.upper()} ON {_table_name} BEGIN {_body} END"
+            ))
+
+# Index tìm chuỗi con (FTS5 trigram) cho lái xe / biển số / mã tuyến của chuyến, lưu dạng đã bỏ dấu.
+# rowid = daily_routes.id; đồng bộ từ nhật ký data_changes bằng Python (sync_search_indexes) nên
+# database vẫn ghi được từ công cụ khác, index tự bắt kịp ở lần tìm kiếm sau
+with engine.begin() as _connection:
+    _connection.execute(text("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS daily_route_search
+        USING fts5(driver_name, license_plate, route_code, tokenize = 'trigram')
+    """))
+    # Trigger cũ gọi hàm Python fold_vi -> ghi từ ngoài ứng dụng lỗi "no such function: fold_vi"
+    for _trigger in ("insert", "update", "delete", "route_code"):
+        _connection.execute(text(f"DROP TRIGGER IF EXISTS daily_route_search_{_trigger}"))
+
+# Index tìm kiếm toàn hệ thống (FTS5). rowid = id * 8 + mã loại để xoá/sửa đúng một dòng theo rowid.
+# title/body lưu dạng bỏ dấu để tìm; label/detail/url giữ nguyên để hiển thị kết quả.
+# Biểu thức viết theo "{row}" = bí danh bảng nguồn; đồng bộ cùng daily_route_search (sync_search_indexes)
+SEARCH_SOURCES = {
+    "employee": {
+        "code": 1, "table": "employees", "where": "{row}.status = 1",
+        "title": "{row}.name",
+        "body": "COALESCE({row}.phone, '') || ' ' || COALESCE({row}.cccd, '') || ' ' || COALESCE({row}.driving_license, '')",
+        "detail": "'SĐT ' || COALESCE({row}.phone, '—') || ' · CCCD ' || COALESCE({row}.cccd, '—') || ' · GPLX ' || COALESCE({row}.driving_license, '—')",
+        "url": "'/employees/edit/' || {row}.id",
+    },
+    "vehicle": {
+        "code": 2, "table": "vehicles", "where": "{row}.status = 1",
+        "title": "{row}.license_plate",
+        "body": "COALESCE({row}.vehicle_info, '')",
+        "detail": "COALESCE({row}.vehicle_info, '')",
+        "url": "'/vehicles/edit/' || {row}.id",
+    },
+    "route": {
+        "code": 3, "table": "routes", "where": "{row}.status = 1",
+        "title": "{row}.route_code",
+        "body": "COALESCE({row}.route_name, '')",
+        "detail": "COALESCE({row}.route_name, '')",
+        "url": "'/routes/edit/' || {row}.id",
+    },
+    "trip": {
+        "code": 4, "table": "daily_routes", "where": "COALESCE({row}.notes, '') != ''",
+        "title": "COALESCE((SELECT route_code FROM routes WHERE id = {row}.route_id), '')",
+        "body": "{row}.notes",
+        "detail": "strftime('%d/%m/%Y', {row}.date) || ' · ' || COALESCE({row}.driver_name, '—') || ' · ' || COALESCE({row}.license_plate, '—') || ' · ' || {row}.notes",
+        "url": "'/daily-new/edit/' || {row}.id",
+    },
+    "fuel": {
+        "code": 5, "table": "fuel_records", "where": "COALESCE({row}.notes, '') != ''",
+        "title": "{row}.license_plate",
+        "body": "{row}.notes",
+        "detail": "strftime('%d/%m/%Y', {row}.date) || ' · ' || printf('%.1f', COALESCE({row}.liters_pumped, 0)) || ' lít · ' || {row}.notes",
+        "url": "'/fuel/edit/' || {row}.id",
+    },
+    "finance": {
+        "code": 6, "table": "finance_transactions", "where": "1",
+        "title": "{row}.description",
+        "body": "COALESCE({row}.note, '') || ' ' || COALESCE({row}.route_code, '') || ' ' || COALESCE({row}.category, '')",
+        "detail": "strftime('%d/%m/%Y', {row}.date) || ' · ' || {row}.transaction_type || ' · ' || printf('%,d', CAST(COALESCE({row}.total, 0) AS INTEGER)) || ' ₫' || COALESCE(' · ' || NULLIF({row}.note, ''), '')",
+        "url": "'/finance-report?month=' || CAST(strftime('%m', {row}.date) AS INTEGER) || '&year=' || strftime('%Y', {row}.date)",
+    },
+}
+
+def _search_index_select(source: dict, row: str) -> str:
+    """SELECT (rowid, title, body, label, detail, url) từ dòng nguồn `row`; title/body chưa bỏ dấu"""
+    return "SELECT {row}.id * 8 + {code}, {title}, {body}, {title}, {detail}, {url}".format(
+        row=row, code=source["code"],
+        **{key: source[key].format(row=row) for key in ("title", "body", "detail", "url")}
+    )
+
+with engine.begin() as _connection:
+    _connection.execute(text("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_index
+        USING fts5(title, body, label UNINDEXED, detail UNINDEXED, url UNINDEXED, prefix = '2 3')
+    """))
+    # Trigger cũ gọi fold_vi giống daily_route_search ở trên
+    for _source_name in SEARCH_SOURCES:
+        for _trigger in ("insert", "update", "delete"):
+            _connection.execute(text(f"DROP TRIGGER IF EXISTS search_index_{_source_name}_{_trigger}"))
+
 # Dependency để lấy database session
 def get_db():
     db = SessionLocal()
@@ -170,6 +579,244 @@ def get_db():
     finally:
         db.close()
 
+# ===== CHANGE TRACKING =====
+# Các cache/rollup đăng ký listener để được báo khi dữ liệu thay đổi (sau khi commit thành công).
+# listener(table_name, dates, ids): dates/ids là set các ngày/ID bị ảnh hưởng (có thể rỗng)
+_data_change_listeners = []
+
+def on_data_change(listener):
+    """Decorator đăng ký listener nhận thông báo thay đổi dữ liệu"""
+    _data_change_listeners.append(listener)
+    return listener
+
+def notify_data_change(table_name, dates=None, ids=None):
+    """Gọi tất cả listener, lỗi của một listener không làm hỏng request"""
+    for listener in _data_change_listeners:
+        try:
+            listener(table_name, set(dates or ()), set(ids or ()))
+        except Exception as e:
+            print(f"Lỗi khi cập nhật cache ({listener.__name__}): {str(e)}")
+
+def mark_data_changed(db: Session, table_name, dates=None, ids=None):
+    """Ghi nhận thay đổi từ các câu lệnh bulk (không đi qua ORM), thông báo khi commit"""
+    pending = db.info.setdefault("data_changes", {})
+    entry = pending.setdefault(table_name, (set(), set()))
+    entry[0].update(dates or ())
+    entry[1].update(ids or ())
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_orm_changes(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table_name = getattr(obj, "__tablename__", None)
+        if not table_name:
+            continue
+        dates = set()
+        if "date" in obj.__mapper__.attrs:
+            history = inspect(obj).attrs.date.history
+            dates.update(d for d in list(history.added) + list(history.unchanged) + list(history.deleted) if d)
+        obj_id = getattr(obj, "id", None)
+        mark_data_changed(session, table_name, dates, [obj_id] if obj_id else [])
+
+@event.listens_for(DailyRoute, "after_delete")
+def _record_daily_route_tombstone(mapper, connection, target):
+    connection.execute(DailyRouteTombstone.__table__.insert().values(
+        daily_route_id=target.id, date=target.date, deleted_at=datetime.utcnow()
+    ))
+
+@event.listens_for(SessionLocal, "after_commit")
+def _dispatch_data_changes(session):
+    pending = session.info.pop("data_changes", None)
+    if pending:
+        for table_name, (dates, ids) in pending.items():
+            notify_data_change(table_name, dates, ids)
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_data_changes(session):
+    session.info.pop("data_changes", None)
+
+# Listener ở trên chỉ báo cho process đang ghi. Dữ liệu dùng chung giữa các worker (rollup, cache nhiều process)
+# dựa vào nhật ký data_changes / data_versions do trigger ghi trong cùng transaction.
+DATA_CHANGE_RETENTION_HOURS = 48  # Process đọc nhật ký chậm hơn mức này sẽ phải nạp lại toàn bộ
+DATA_CHANGE_PRUNE_INTERVAL_SECONDS = 3600
+
+_data_change_prune = {"next_at": 0.0}
+
+def current_data_version(db: Session) -> int:
+    """Id nhật ký thay đổi mới nhất (không giảm kể cả khi nhật ký đã được dọn)"""
+    return db.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'data_changes'")).scalar() or 0
+
+def get_data_versions(db: Session, scopes: list) -> dict:
+    """{phạm vi: id nhật ký mới nhất}, phạm vi chưa từng thay đổi không có trong kết quả"""
+    return dict(db.query(DataVersion.scope, DataVersion.version).filter(DataVersion.scope.in_(scopes)).all())
+
+def read_data_changes(db: Session, after_version: int, tables: list) -> tuple:
+    """Các thay đổi (table_name, row_id, date) của `tables` sau mốc after_version, kèm mốc mới.
+    Danh sách là None nếu nhật ký sau mốc đã bị dọn - người đọc phải nạp lại toàn bộ."""
+    latest = current_data_version(db)
+    if latest <= after_version:
+        return [], after_version
+    oldest = db.execute(text("SELECT MIN(id) FROM data_changes")).scalar()
+    if oldest is None or oldest > after_version + 1:
+        return None, latest
+    rows = db.execute(text("""
+        SELECT table_name, row_id, date FROM data_changes
+        WHERE id > :after_version AND id <= :latest AND table_name IN :tables
+        ORDER BY id
+    """).bindparams(bindparam("tables", expanding=True)), {
+        "after_version": after_version, "latest": latest, "tables": list(tables)
+    }).all()
+    return rows, latest
+
+def month_source_versions(db: Session, month_keys: list, global_tables=()) -> dict:
+    """{tháng: mốc thay đổi mới nhất của dữ liệu có ngày trong tháng hoặc của một bảng trong global_tables}"""
+    versions = get_data_versions(
+        db, [f"month:{month_key}" for month_key in month_keys] + [f"table:{table_name}" for table_name in global_tables]
+    )
+    global_version = max((versions.get(f"table:{table_name}", 0) for table_name in global_tables), default=0)
+    return {month_key: max(versions.get(f"month:{month_key}", 0), global_version) for month_key in month_keys}
+
+def stale_rollup_months(db: Session, rollup: str, month_keys: list, global_tables=()) -> list:
+    """Các tháng của bảng tổng hợp cần tính lại: chưa tính bao giờ, hoặc dữ liệu của tháng
+    (hay một bảng ảnh hưởng mọi tháng trong global_tables) đã đổi sau lần tính gần nhất"""
+    versions = month_source_versions(db, month_keys, global_tables)
+    states = dict(db.query(RollupState.month, RollupState.source_version).filter(
+        RollupState.rollup == rollup, RollupState.month.in_(month_keys)
+    ).all())
+    return [month_key for month_key in month_keys if month_key not in states or versions[month_key] > states[month_key]]
+
+def mark_rollup_months_fresh(db: Session, rollup: str, month_keys: list, source_version: int):
+    """Ghi mốc dữ liệu nguồn của các tháng vừa tính (source_version đọc trước khi tính, chưa commit)"""
+    for month_key in month_keys:
+        db.execute(text("""
+            INSERT INTO rollup_states (rollup, month, source_version) VALUES (:rollup, :month, :version)
+            ON CONFLICT (rollup, month) DO UPDATE SET source_version = excluded.source_version
+        """), {"rollup": rollup, "month": month_key, "version": source_version})
+
+def prune_data_changes(connection):
+    connection.execute(text("DELETE FROM data_changes WHERE changed_at < datetime('now', :age)"), {
+        "age": f"-{DATA_CHANGE_RETENTION_HOURS} hours"
+    })
+
+@on_data_change
+def _prune_data_changes_periodically(table_name, dates, ids):
+    if time.monotonic() < _data_change_prune["next_at"]:
+        return
+    _data_change_prune["next_at"] = time.monotonic() + DATA_CHANGE_PRUNE_INTERVAL_SECONDS
+    with engine.begin() as connection:
+        prune_data_changes(connection)
+
+# ===== ĐỒNG BỘ INDEX TÌM KIẾM =====
+# daily_route_search và search_index được ghi từ Python theo nhật ký data_changes (không dùng trigger
+# gọi hàm Python). Mốc đã đồng bộ lưu ở rollup_states như các bảng tổng hợp; chạy lúc khởi động và
+# trước mỗi lần tìm kiếm nên thay đổi từ process hoặc công cụ khác cũng được đưa vào.
+SEARCH_SYNC_ROLLUP = "search_index"
+SEARCH_SYNC_TABLES = sorted({"daily_routes", "routes"} | {source["table"] for source in SEARCH_SOURCES.values()})
+SEARCH_SYNC_CHUNK = 500  # Số id mỗi câu IN (...), dưới giới hạn biến của SQLite
+
+def _id_chunks(ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), SEARCH_SYNC_CHUNK):
+        yield ids[start:start + SEARCH_SYNC_CHUNK]
+
+def _reindex_search_rows(db: Session, table: str, columns: tuple, folded: int, select_sql: str, where: str, ids,
+                         rowid=None, owned_rows="1"):
+    """Ghi lại các dòng của bảng FTS `table` cho id nguồn `ids` (None = dựng lại mọi dòng thuộc owned_rows).
+    select_sql (bí danh nguồn "src") trả về rowid rồi đến `columns`; `folded` cột đầu được bỏ dấu bằng Python."""
+    insert = text(f"INSERT INTO {table} (rowid, {', '.join(columns)}) VALUES (:rowid, {', '.join(':' + column for column in columns)})")
+    if ids is None:
+        db.execute(text(f"DELETE FROM {table} WHERE {owned_rows}"))
+        batches = [db.execute(text(f"{select_sql} WHERE {where}")).all()]
+    else:
+        batches = []
+        for chunk in _id_chunks(ids):
+            db.execute(text(f"DELETE FROM {table} WHERE rowid IN :rowids").bindparams(bindparam("rowids", expanding=True)), {
+                "rowids": [rowid(row_id) for row_id in chunk] if rowid else chunk
+            })
+            batches.append(db.execute(
+                text(f"{select_sql} WHERE ({where}) AND src.id IN :ids").bindparams(bindparam("ids", expanding=True)),
+                {"ids": chunk}
+            ).all())
+    for rows in batches:
+        if rows:
+            db.execute(insert, [{
+                "rowid": row[0],
+                **{column: fold_vietnamese(value) if position < folded else value
+                   for position, (column, value) in enumerate(zip(columns, row[1:]))}
+            } for row in rows])
+
+def _reindex_daily_routes_search(db: Session, trip_ids=None):
+    _reindex_search_rows(
+        db, "daily_route_search", ("driver_name", "license_plate", "route_code"), 3,
+        "SELECT src.id, src.driver_name, src.license_plate, routes.route_code "
+        "FROM daily_routes AS src LEFT JOIN routes ON routes.id = src.route_id",
+        "1", trip_ids
+    )
+
+def _reindex_search_source(db: Session, source: dict, ids=None):
+    _reindex_search_rows(
+        db, "search_index", ("title", "body", "label", "detail", "url"), 2,
+        f"{_search_index_select(source, 'src')} FROM {source['table']} AS src", source["where"].format(row="src"),
+        ids, rowid=lambda row_id: row_id * 8 + source["code"], owned_rows=f"rowid % 8 = {source['code']}"
+    )
+
+def _search_sync_version(db: Session):
+    return db.query(RollupState.source_version).filter(
+        RollupState.rollup == SEARCH_SYNC_ROLLUP, RollupState.month == "*"
+    ).scalar()
+
+def _search_indexes_drifted(db: Session) -> bool:
+    """Số dòng bảng tìm kiếm khác số dòng nguồn (ví dụ bảng FTS bị sửa tay hoặc khôi phục từ bản sao lưu khác)"""
+    if db.execute(text("SELECT (SELECT COUNT(*) FROM daily_routes) != (SELECT COUNT(*) FROM daily_route_search)")).scalar():
+        return True
+    indexed = dict(db.execute(text("SELECT rowid % 8, COUNT(*) FROM search_index GROUP BY rowid % 8")).all())
+    return any(
+        db.execute(text(f"SELECT COUNT(*) FROM {source['table']} AS src WHERE {source['where'].format(row='src')}")).scalar()
+        != indexed.get(source["code"], 0)
+        for source in SEARCH_SOURCES.values()
+    )
+
+def sync_search_indexes(check_drift: bool = False):
+    """Đưa thay đổi mới trong nhật ký vào bảng tìm kiếm. Chưa có mốc (lần đầu), nhật ký sau mốc đã bị dọn
+    hoặc (check_drift, lúc khởi động) số dòng lệch với bảng nguồn -> dựng lại toàn bộ."""
+    db = SessionLocal()
+    try:
+        if not check_drift and _search_sync_version(db) == current_data_version(db):
+            return
+        # Giữ khoá ghi từ trước khi đọc để hai process không ghi đè nhau bằng dữ liệu cũ
+        db.connection().exec_driver_sql("BEGIN IMMEDIATE")
+        synced = _search_sync_version(db)
+        if synced is None or (check_drift and _search_indexes_drifted(db)):
+            changes, latest = None, current_data_version(db)
+        else:
+            changes, latest = read_data_changes(db, synced, SEARCH_SYNC_TABLES)
+        if changes is None:
+            _reindex_daily_routes_search(db)
+            for source in SEARCH_SOURCES.values():
+                _reindex_search_source(db, source)
+        else:
+            changed_ids = {}
+            for table_name, row_id, _ in changes:
+                changed_ids.setdefault(table_name, set()).add(row_id)
+            trip_ids = set(changed_ids.get("daily_routes", ()))
+            # Đổi mã tuyến -> cột route_code của daily_route_search và tiêu đề dòng "trip" của các chuyến thuộc tuyến cũng đổi
+            for chunk in _id_chunks(changed_ids.get("routes", ())):
+                trip_ids.update(db.execute(
+                    text("SELECT id FROM daily_routes WHERE route_id IN :ids").bindparams(bindparam("ids", expanding=True)),
+                    {"ids": chunk}
+                ).scalars())
+            if trip_ids:
+                _reindex_daily_routes_search(db, trip_ids)
+            changed_ids["daily_routes"] = trip_ids
+            for source in SEARCH_SOURCES.values():
+                if changed_ids.get(source["table"]):
+                    _reindex_search_source(db, source, changed_ids[source["table"]])
+        mark_rollup_months_fresh(db, SEARCH_SYNC_ROLLUP, ["*"], latest)
+        db.commit()
+    finally:
+        db.close()
+
+sync_search_indexes(check_drift=True)
+
 # FastAPI app
 app = FastAPI(title="Hệ thống quản lý vận chuyển")
 
@@ -178,21 +825,80 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # Templates đã được tạo ở trên với custom filters
 
+# ===== THỐNG KÊ TRANG CHỦ =====
+
+DASHBOARD_STATS_TTL_SECONDS = 60  # Thời gian giữ cache, đồng thời là chu kỳ tự làm mới trên trang chủ
+DASHBOARD_STATS_TABLES = {"employees", "vehicles", "routes", "daily_routes", "fuel_records", "finance_transactions"}
+
+_dashboard_stats_cache = {"expires_at": 0.0, "stats": None}
+
+@on_data_change
+def _invalidate_dashboard_stats(table_name, dates, ids):
+    if table_name in DASHBOARD_STATS_TABLES:
+        _dashboard_stats_cache["expires_at"] = 0.0
+
+def _compute_dashboard_stats(db: Session) -> dict:
+    """Một truy vấn cho toàn bộ số liệu trang chủ (chỉ đếm nhân viên/xe/tuyến đang hoạt động)"""
+    today = date.today()
+    month_start, month_end = _month_date_range(today.month, today.year)
+    row = db.execute(text("""
+        SELECT
+            (SELECT COUNT(*) FROM employees WHERE status = 1),
+            (SELECT COUNT(*) FROM vehicles WHERE status = 1),
+            (SELECT COUNT(*) FROM routes WHERE is_active = 1 AND status = 1),
+            (SELECT COUNT(*) FROM daily_routes WHERE date = :today),
+            (SELECT COALESCE(SUM(distance_km), 0) FROM daily_routes WHERE date >= :month_start AND date <= :month_end),
+            (SELECT COALESCE(SUM(liters_pumped), 0) FROM fuel_records WHERE date >= :month_start AND date <= :month_end),
+            (SELECT COALESCE(SUM(cost_pumped), 0) FROM fuel_records WHERE date >= :month_start AND date <= :month_end),
+            (SELECT COALESCE(SUM(CASE WHEN transaction_type = 'Thu' THEN total ELSE 0 END), 0)
+             FROM finance_transactions WHERE date >= :month_start AND date <= :month_end),
+            (SELECT COALESCE(SUM(CASE WHEN transaction_type = 'Chi' THEN total ELSE 0 END), 0)
+             FROM finance_transactions WHERE date >= :month_start AND date <= :month_end)
+    """), {
+        "today": today.strftime("%Y-%m-%d"),
+        "month_start": month_start.strftime("%Y-%m-%d"),
+        "month_end": month_end.strftime("%Y-%m-%d"),
+    }).one()
+    employees_count, vehicles_count, routes_count, daily_routes_count, month_km, month_fuel_liters, month_fuel_cost, month_income, month_expense = row
+    return {
+        "employees_count": employees_count,
+        "vehicles_count": vehicles_count,
+        "routes_count": routes_count,
+        "daily_routes_count": daily_routes_count,
+        "month": today.strftime("%Y-%m"),
+        "month_km": month_km,
+        "month_fuel_liters": month_fuel_liters,
+        "month_fuel_cost": month_fuel_cost,
+        "month_income": month_income,
+        "month_expense": month_expense,
+        "month_balance": month_income - month_expense,
+        "generated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+def get_dashboard_stats(db: Session) -> dict:
+    """Số liệu trang chủ, cache DASHBOARD_STATS_TTL_SECONDS giây hoặc tới khi dữ liệu liên quan thay đổi"""
+    now = time.monotonic()
+    if _dashboard_stats_cache["stats"] is None or now >= _dashboard_stats_cache["expires_at"]:
+        _dashboard_stats_cache["stats"] = _compute_dashboard_stats(db)
+        _dashboard_stats_cache["expires_at"] = now + DASHBOARD_STATS_TTL_SECONDS
+    return _dashboard_stats_cache["stats"]
+
+@app.get("/api/dashboard-stats")
+async def dashboard_stats_api(db: Session = Depends(get_db)):
+    """Số liệu tổng quan trang chủ (dùng để tự làm mới)"""
+    return dict(get_dashboard_stats(db), success=True)
+
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request, db: Session = Depends(get_db)):
     # Lấy thống kê tổng quan
-    employees_count = db.query(Employee).count()
-    vehicles_count = db.query(Vehicle).count()
-    routes_count = db.query(Route).filter(Route.is_active == 1).count()
-    today = date.today()
-    daily_routes_count = db.query(DailyRoute).filter(DailyRoute.date == today).count()
+    expiry_alerts = get_expiry_alerts(db)
     
     return templates.TemplateResponse("index.html", {
         "request": request,
-        "employees_count": employees_count,
-        "vehicles_count": vehicles_count,
-        "routes_count": routes_count,
-        "daily_routes_count": daily_routes_count
+        "stats": get_dashboard_stats(db),
+        "stats_refresh_seconds": DASHBOARD_STATS_TTL_SECONDS,
+        "expiry_alerts": expiry_alerts,
+        "expiry_alert_days": EXPIRY_ALERT_DAYS
     })
 
 @app.get("/report", response_class=HTMLResponse)
@@ -1038,6 +1744,12 @@ async def add_route(
         vehicle_id=None  # No vehicle assigned by default
     )
     db.add(route)
+    db.flush()
+    # Mức đơn giá đầu tiên áp dụng cho mọi ngày
+    set_route_rate(
+        db, route.id, RATE_HISTORY_START, monthly_salary,
+        TANG_CUONG_KM_RATE if route_code.strip() == TANG_CUONG_ROUTE_CODE else None
+    )
     db.commit()
     return RedirectResponse(url="/routes", status_code=303)
 
@@ -1050,13 +1762,30 @@ async def delete_route(route_id: int, db: Session = Depends(get_db)):
     return RedirectResponse(url="/routes", status_code=303)
 
 @app.get("/routes/edit/{route_id}", response_class=HTMLResponse)
-async def edit_route_page(request: Request, route_id: int, db: Session = Depends(get_db)):
+async def edit_route_page(request: Request, route_id: int, db: Session = Depends(get_db), error: Optional[str] = None):
     route = db.query(Route).filter(Route.id == route_id, Route.status == 1).first()
     if not route:
         return RedirectResponse(url="/routes", status_code=303)
+    schedule_templates = db.query(RouteScheduleTemplate).filter(
+        RouteScheduleTemplate.route_id == route_id
+    ).order_by(RouteScheduleTemplate.weekday).all()
+    employees = db.query(Employee).filter(Employee.status == 1).order_by(Employee.name).all()
+    vehicles = db.query(Vehicle).filter(Vehicle.status == 1).all()
+    route_rates = db.query(RouteRate).filter(RouteRate.route_id == route_id).order_by(RouteRate.effective_from.desc()).all()
+    
     return templates.TemplateResponse("edit_route.html", {
         "request": request, 
-        "route": route
+        "route": route,
+        "route_rates": route_rates,
+        "current_rate": get_route_rate(db, route_id, date.today()),
+        "is_tang_cuong": (route.route_code or "").strip() == TANG_CUONG_ROUTE_CODE,
+        "default_effective_from": date.today().replace(day=1).strftime('%Y-%m-%d'),
+        "rate_history_start": RATE_HISTORY_START,
+        "schedule_templates": schedule_templates,
+        "weekday_names": WEEKDAY_NAMES,
+        "employees": employees,
+        "vehicles": vehicles,
+        "error": error
     })
 
 @app.post("/routes/edit/{route_id}")
@@ -1066,6 +1795,8 @@ async def edit_route(
     route_name: str = Form(...),
     distance: float = Form(0),
     monthly_salary: float = Form(0),
+    km_rate: Optional[float] = Form(None),
+    rate_effective_from: str = Form(""),
     db: Session = Depends(get_db)
 ):
     route = db.query(Route).filter(Route.id == route_id, Route.status == 1).first()
@@ -1078,6 +1809,21 @@ async def edit_route(
     # unit_price is not updated since field is removed from form
     route.monthly_salary = monthly_salary
     
+    # Đơn giá thay đổi -> thêm mức mới từ ngày hiệu lực (mặc định đầu tháng hiện tại),
+    # các chuyến trước ngày đó vẫn tính theo mức cũ
+    try:
+        effective_from = datetime.strptime(rate_effective_from, "%Y-%m-%d").date()
+    except ValueError:
+        effective_from = date.today().replace(day=1)
+    current_rate = get_route_rate(db, route.id, effective_from)
+    current_km_rate = current_rate.km_rate if current_rate else None
+    new_km_rate = km_rate if km_rate is not None else current_km_rate
+    if new_km_rate is None and route_code.strip() == TANG_CUONG_ROUTE_CODE:
+        # Đổi tên thành "Tăng Cường": form chưa hiện ô đơn giá/km nên lấy mặc định như khi tạo tuyến
+        new_km_rate = TANG_CUONG_KM_RATE
+    if not current_rate or current_rate.monthly_salary != monthly_salary or current_km_rate != new_km_rate:
+        set_route_rate(db, route.id, effective_from, monthly_salary, new_km_rate)
+    
     db.commit()
     return RedirectResponse(url="/routes", status_code=303)
 
@@ -1171,6 +1917,13 @@ async def add_daily_route(request: Request, db: Session = Depends(get_db)):
                 employee_name="",  # Empty since we removed this field
                 notes=notes or ""
             )
+            # Không ghi trùng tuyến đã có chuyến trong ngày
+            if find_duplicate_assignments(db, selected_date, [(route_id, daily_route.driver_name)]):
+                continue
+            if EXPIRED_DOCUMENT_POLICY == "block" and check_trip_documents(
+                get_document_validity_index(db), selected_date, daily_route.driver_name, daily_route.license_plate
+            ):
+                continue
             db.add(daily_route)
     
     db.commit()
@@ -1190,10 +1943,8 @@ async def delete_daily_route(daily_route_id: int, request: Request, db: Session
 
 # New Daily Page with simple date selection
 @app.get("/daily-new", response_class=HTMLResponse)
-async def daily_new_page(request: Request, db: Session = Depends(get_db), selected_date: Optional[str] = None, deleted_all: Optional[str] = None):
+async def daily_new_page(request: Request, db: Session = Depends(get_db), selected_date: Optional[str] = None, deleted_all: Optional[str] = None, deleted_count: Optional[int] = None, generated_count: Optional[int] = None, duplicate_routes: Optional[str] = None, expired_routes: Optional[str] = None, unknown_routes: Optional[str] = None):
     routes = db.query(Route).filter(Route.is_active == 1, Route.status == 1).all()
-    employees = db.query(Employee).filter(Employee.status == 1).all()
-    vehicles = db.query(Vehicle).filter(Vehicle.status == 1).all()
     today = date.today()
     
     # Xử lý ngày được chọn
@@ -1221,21 +1972,33 @@ async def daily_new_page(request: Request, db: Session = Depends(get_db), select
     
     routes = sort_routes_with_tang_cuong_at_bottom(routes)
     
-    # Sắp xếp employees theo tên (A-Z) để dễ tìm kiếm trong dropdown
-    employees = sorted(employees, key=lambda emp: emp.name.lower() if emp.name else "")
-    
     # Lọc chuyến đã ghi nhận theo ngày được chọn
     daily_routes = db.query(DailyRoute).filter(DailyRoute.date == filter_date).order_by(DailyRoute.created_at.desc()).all()
     
+    # Cảnh báo giấy tờ hết hạn cho các chuyến trong ngày
+    validity_index = get_document_validity_index(db)
+    document_warnings = {}
+    for daily_route in daily_routes:
+        issues = check_trip_documents(validity_index, filter_date, daily_route.driver_name, daily_route.license_plate)
+        if issues:
+            document_warnings[daily_route.id] = issues
+    
     return templates.TemplateResponse("daily_new.html", {
         "request": request,
         "routes": routes,
-        "employees": employees,
-        "vehicles": vehicles,
         "daily_routes": daily_routes,
         "selected_date": filter_date.strftime('%Y-%m-%d'),
         "selected_date_display": filter_date.strftime('%d/%m/%Y'),
-        "deleted_all": deleted_all
+        "deleted_all": deleted_all,
+        "deleted_count": deleted_count,
+        "generated_count": generated_count,
+        "duplicate_routes": duplicate_routes,
+        "expired_routes": expired_routes,
+        "unknown_routes": unknown_routes,
+        "document_warnings": document_warnings,
+        "assignment_warnings": get_day_assignment_clashes(daily_routes),
+        "previous_date": (filter_date - timedelta(days=1)).strftime('%Y-%m-%d'),
+        "selected_month": filter_date.strftime('%Y-%m')
     })
 
 @app.post("/daily-new/add")
@@ -1272,6 +2035,7 @@ async def add_daily_new_route(request: Request, db: Session = Depends(get_db)):
     routes = sort_routes_with_tang_cuong_at_bottom(routes)
     
     # Xử lý từng route
+    new_routes = []
     for route in routes:
         route_id = route.id
         
@@ -1283,7 +2047,7 @@ async def add_daily_new_route(request: Request, db: Session = Depends(get_db)):
         
         # Chỉ tạo record nếu có ít nhất một trường được điền
         if distance_km or driver_name or license_plate or notes:
-            daily_route = DailyRoute(
+            new_routes.append(DailyRoute(
                 route_id=route_id,
                 date=selected_date,
                 distance_km=float(distance_km) if distance_km else 0,
@@ -1292,32 +2056,52 @@ async def add_daily_new_route(request: Request, db: Session = Depends(get_db)):
                 license_plate=license_plate or "",
                 employee_name="",  # Empty since we removed this field
                 notes=notes or ""
-            )
+            ))
+    
+    # Bỏ qua các chuyến bị trùng (tuyến đã có chuyến trong ngày), lưu các chuyến còn lại
+    duplicates = find_duplicate_assignments(
+        db, selected_date, [(daily_route.route_id, daily_route.driver_name) for daily_route in new_routes]
+    )
+    route_codes = {route.id: route.route_code for route in routes}
+    validity_index = get_document_validity_index(db)
+    duplicate_codes = []
+    expired_codes = []
+    unknown_codes = []
+    for index, daily_route in enumerate(new_routes):
+        if index in duplicates:
+            duplicate_codes.append(route_codes.get(daily_route.route_id, ""))
+        elif find_unknown_assignees(db, daily_route.driver_name, daily_route.license_plate):
+            unknown_codes.append(route_codes.get(daily_route.route_id, ""))
+        elif EXPIRED_DOCUMENT_POLICY == "block" and check_trip_documents(
+            validity_index, selected_date, daily_route.driver_name, daily_route.license_plate
+        ):
+            expired_codes.append(route_codes.get(daily_route.route_id, ""))
+        else:
             db.add(daily_route)
     
     db.commit()
     # Redirect về trang daily-new với ngày đã chọn
-    return RedirectResponse(url=f"/daily-new?selected_date={selected_date.strftime('%Y-%m-%d')}", status_code=303)
+    redirect_url = f"/daily-new?selected_date={selected_date.strftime('%Y-%m-%d')}"
+    if duplicate_codes:
+        redirect_url += f"&duplicate_routes={quote(', '.join(duplicate_codes))}"
+    if expired_codes:
+        redirect_url += f"&expired_routes={quote(', '.join(expired_codes))}"
+    if unknown_codes:
+        redirect_url += f"&unknown_routes={quote(', '.join(unknown_codes))}"
+    return RedirectResponse(url=redirect_url, status_code=303)
 
 @app.get("/daily-new/edit/{daily_route_id}", response_class=HTMLResponse)
-async def edit_daily_new_route_page(request: Request, daily_route_id: int, db: Session = Depends(get_db)):
+async def edit_daily_new_route_page(request: Request, daily_route_id: int, db: Session = Depends(get_db), error: Optional[str] = None):
     """Trang sửa chuyến"""
     daily_route = db.query(DailyRoute).filter(DailyRoute.id == daily_route_id).first()
     if not daily_route:
         return RedirectResponse(url="/daily-new", status_code=303)
     
-    # Lấy danh sách để hiển thị trong dropdown
-    employees = db.query(Employee).filter(Employee.status == 1).all()
-    vehicles = db.query(Vehicle).filter(Vehicle.status == 1).all()
-    
-    # Sắp xếp employees theo tên (A-Z) để dễ tìm kiếm trong dropdown
-    employees = sorted(employees, key=lambda emp: emp.name.lower() if emp.name else "")
-    
+    # Lái xe / biển số được gợi ý qua /api/autocomplete nên không cần nạp danh sách ở đây
     return templates.TemplateResponse("edit_daily_route.html", {
         "request": request,
         "daily_route": daily_route,
-        "employees": employees,
-        "vehicles": vehicles
+        "error": error
     })
 
 @app.post("/daily-new/edit/{daily_route_id}")
@@ -1334,6 +2118,23 @@ async def edit_daily_new_route(
     if not daily_route:
         return RedirectResponse(url="/daily-new", status_code=303)
     
+    unknown = find_unknown_assignees(
+        db,
+        driver_name if driver_name.strip() != (daily_route.driver_name or "") else "",
+        license_plate if license_plate.strip() != (daily_route.license_plate or "") else ""
+    )
+    if unknown:
+        return RedirectResponse(url=f"/daily-new/edit/{daily_route_id}?error={quote('; '.join(unknown))}", status_code=303)
+    duplicates = find_duplicate_assignments(
+        db, daily_route.date, [(daily_route.route_id, driver_name)], exclude_ids=[daily_route.id]
+    )
+    if duplicates:
+        return RedirectResponse(url=f"/daily-new/edit/{daily_route_id}?error={quote(duplicates[0])}", status_code=303)
+    if EXPIRED_DOCUMENT_POLICY == "block":
+        issues = check_trip_documents(get_document_validity_index(db), daily_route.date, driver_name, license_plate)
+        if issues:
+            return RedirectResponse(url=f"/daily-new/edit/{daily_route_id}?error={quote('; '.join(issues))}", status_code=303)
+    
     # Cập nhật thông tin
     daily_route.distance_km = distance_km
     daily_route.driver_name = driver_name
@@ -1356,6 +2157,39 @@ async def delete_daily_new_route(daily_route_id: int, db: Session = Depends(get_
         return RedirectResponse(url=f"/daily-new?selected_date={deleted_date.strftime('%Y-%m-%d')}", status_code=303)
     return RedirectResponse(url="/daily-new", status_code=303)
 
+def bulk_delete_daily_routes(
+    db: Session,
+    from_date: Optional[date] = None,
+    to_date: Optional[date] = None,
+    route_id: Optional[int] = None,
+    driver_name: Optional[str] = None
+) -> int:
+    """Xóa chuyến bằng một câu DELETE ... WHERE duy nhất, trả về số chuyến đã xóa.
+    Chưa commit - người gọi chịu trách nhiệm commit để cache được cập nhật."""
+    conditions = []
+    if from_date:
+        conditions.append(DailyRoute.date >= from_date)
+    if to_date:
+        conditions.append(DailyRoute.date <= to_date)
+    if route_id:
+        conditions.append(DailyRoute.route_id == route_id)
+    if driver_name:
+        conditions.append(DailyRoute.driver_name == driver_name)
+    if not conditions:
+        raise ValueError("Cần ít nhất một điều kiện lọc để xóa hàng loạt")
+    
+    deleted_rows = db.execute(
+        delete(DailyRoute).where(*conditions).returning(DailyRoute.id, DailyRoute.date),
+        execution_options={"synchronize_session": False}
+    ).all()
+    if deleted_rows:
+        deleted_at = datetime.utcnow()
+        db.execute(DailyRouteTombstone.__table__.insert(), [
+            {"daily_route_id": row.id, "date": row.date, "deleted_at": deleted_at} for row in deleted_rows
+        ])
+    mark_data_changed(db, "daily_routes", {row.date for row in deleted_rows}, {row.id for row in deleted_rows})
+    return len(deleted_rows)
+
 @app.post("/daily-new/delete-all")
 async def delete_all_daily_routes(request: Request, db: Session = Depends(get_db)):
     """Xóa tất cả chuyến đã ghi nhận trong một ngày"""
@@ -1370,760 +2204,2369 @@ async def delete_all_daily_routes(request: Request, db: Session = Depends(get_db
     except ValueError:
         return RedirectResponse(url="/daily-new", status_code=303)
     
-    # Tìm và xóa tất cả chuyến trong ngày được chọn
-    daily_routes = db.query(DailyRoute).filter(DailyRoute.date == selected_date).all()
-    
-    if daily_routes:
-        for daily_route in daily_routes:
-            db.delete(daily_route)
-        db.commit()
+    # Xóa tất cả chuyến trong ngày được chọn bằng một câu lệnh
+    deleted_count = bulk_delete_daily_routes(db, from_date=selected_date, to_date=selected_date)
+    db.commit()
     
     # Redirect về trang daily-new với ngày đã chọn và thông báo thành công
-    return RedirectResponse(url=f"/daily-new?selected_date={selected_date.strftime('%Y-%m-%d')}&deleted_all=true", status_code=303)
+    return RedirectResponse(url=f"/daily-new?selected_date={selected_date.strftime('%Y-%m-%d')}&deleted_all=true&deleted_count={deleted_count}", status_code=303)
 
-@app.get("/salary/driver-details/{driver_name}")
-async def get_driver_details(
-    driver_name: str,
-    db: Session = Depends(get_db),
-    from_date: Optional[str] = None,
-    to_date: Optional[str] = None
-):
-    """Lấy chi tiết chuyến của một lái xe cụ thể"""
-    # Xử lý khoảng thời gian
-    if from_date and to_date:
-        try:
-            from_date_obj = datetime.strptime(from_date, "%Y-%m-%d").date()
-            to_date_obj = datetime.strptime(to_date, "%Y-%m-%d").date()
-            daily_routes_query = db.query(DailyRoute).filter(
-                DailyRoute.driver_name == driver_name,
-                DailyRoute.date >= from_date_obj,
-                DailyRoute.date <= to_date_obj
-            )
-        except ValueError:
-            return {"error": "Invalid date format"}
-    else:
-        # Nếu không có khoảng thời gian, lấy tháng hiện tại
-        today = date.today()
-        daily_routes_query = db.query(DailyRoute).filter(
-            DailyRoute.driver_name == driver_name,
-            DailyRoute.date >= date(today.year, today.month, 1),
-            DailyRoute.date < date(today.year, today.month + 1, 1) if today.month < 12 else date(today.year + 1, 1, 1)
-        )
+@app.post("/daily-new/bulk-delete")
+async def bulk_delete_daily_routes_api(request: Request, db: Session = Depends(get_db)):
+    """Xóa hàng loạt chuyến theo khoảng ngày, tuyến và/hoặc lái xe"""
+    form_data = await request.form()
     
-    # Lấy dữ liệu và join với Route để có thông tin tuyến
-    daily_routes = daily_routes_query.join(Route).order_by(DailyRoute.date.desc()).all()
+    try:
+        from_date_str = form_data.get("from_date")
+        to_date_str = form_data.get("to_date")
+        route_id_str = form_data.get("route_id")
+        from_date_obj = datetime.strptime(from_date_str, "%Y-%m-%d").date() if from_date_str else None
+        to_date_obj = datetime.strptime(to_date_str, "%Y-%m-%d").date() if to_date_str else None
+        route_id = int(route_id_str) if route_id_str else None
+    except ValueError:
+        return JSONResponse({
+            "success": False,
+            "message": "Ngày (yyyy-mm-dd) hoặc mã tuyến không hợp lệ"
+        }, status_code=400)
     
-    # Format dữ liệu
-    trip_details = []
-    for trip in daily_routes:
-        trip_details.append({
-            'date': trip.date.strftime('%d/%m/%Y'),
-            'route_code': trip.route.route_code,
-            'route_name': trip.route.route_name,
-            'license_plate': trip.license_plate,
-            'distance_km': trip.distance_km,
-            'cargo_weight': trip.cargo_weight,
-            'notes': trip.notes or ''
-        })
+    if from_date_obj and to_date_obj and from_date_obj > to_date_obj:
+        return JSONResponse({
+            "success": False,
+            "message": "Từ ngày phải nhỏ hơn hoặc bằng đến ngày"
+        }, status_code=400)
     
-    return {"trip_details": trip_details}
+    try:
+        deleted_count = bulk_delete_daily_routes(
+            db,
+            from_date=from_date_obj,
+            to_date=to_date_obj,
+            route_id=route_id,
+            driver_name=form_data.get("driver_name") or None
+        )
+        db.commit()
+    except ValueError as e:
+        return JSONResponse({"success": False, "message": str(e)}, status_code=400)
+    except Exception as e:
+        db.rollback()
+        return JSONResponse({
+            "success": False,
+            "message": f"Lỗi khi xóa hàng loạt: {str(e)}"
+        }, status_code=500)
+    
+    return JSONResponse({
+        "success": True,
+        "deleted_count": deleted_count,
+        "message": f"Đã xóa {deleted_count} chuyến"
+    })
 
-@app.get("/salary/driver-details-page/{driver_name}", response_class=HTMLResponse)
-async def driver_details_page(
-    request: Request,
-    driver_name: str,
-    db: Session = Depends(get_db),
-    from_date: Optional[str] = None,
-    to_date: Optional[str] = None
-):
-    """Trang hiển thị chi tiết chuyến của một lái xe cụ thể"""
-    # Xử lý khoảng thời gian
-    if from_date and to_date:
-        try:
-            from_date_obj = datetime.strptime(from_date, "%Y-%m-%d").date()
-            to_date_obj = datetime.strptime(to_date, "%Y-%m-%d").date()
-            daily_routes_query = db.query(DailyRoute).filter(
-                DailyRoute.driver_name == driver_name,
-                DailyRoute.date >= from_date_obj,
-                DailyRoute.date <= to_date_obj
-            )
-            period_text = f"từ {from_date_obj.strftime('%d/%m/%Y')} đến {to_date_obj.strftime('%d/%m/%Y')}"
-        except ValueError:
-            return RedirectResponse(url="/salary", status_code=303)
-    else:
-        # Nếu không có khoảng thời gian, lấy tháng hiện tại
-        today = date.today()
-        daily_routes_query = db.query(DailyRoute).filter(
-            DailyRoute.driver_name == driver_name,
-            DailyRoute.date >= date(today.year, today.month, 1),
-            DailyRoute.date < date(today.year, today.month + 1, 1) if today.month < 12 else date(today.year + 1, 1, 1)
-        )
-        period_text = f"tháng {today.month}/{today.year}"
-    
-    # Lấy dữ liệu và join với Route để có thông tin tuyến
-    daily_routes = daily_routes_query.join(Route).order_by(DailyRoute.date.desc()).all()
-    
-    # Tính thống kê
-    total_trips = len(daily_routes)
-    total_distance = sum(trip.distance_km for trip in daily_routes)
-    total_cargo = sum(trip.cargo_weight for trip in daily_routes)
-    routes_used = list(set(trip.route.route_code for trip in daily_routes))
-    
-    return templates.TemplateResponse("driver_details.html", {
-        "request": request,
-        "driver_name": driver_name,
-        "period_text": period_text,
-        "daily_routes": daily_routes,
-        "total_trips": total_trips,
-        "total_distance": total_distance,
-        "total_cargo": total_cargo,
-        "routes_used": routes_used,
-        "from_date": from_date,
-        "to_date": to_date
+# ===== PHÁT HIỆN TRÙNG LỊCH =====
+
+CONFLICT_KIND_LABELS = {
+    "duplicate_route": "Tuyến bị ghi 2 lần trong ngày",
+    "driver_multi_route": "Lái xe chạy nhiều tuyến trong ngày",
+    "plate_multi_driver": "Xe được nhiều lái xe dùng trong ngày",
+}
+
+def find_unknown_assignees(db: Session, driver_name: str, license_plate: str) -> list:
+    """Lái xe / biển số không có trong danh sách nhân viên / xe đang hoạt động (để trống thì bỏ qua)"""
+    issues = []
+    driver_name = (driver_name or "").strip()
+    license_plate = (license_plate or "").strip()
+    if driver_name and not db.query(Employee.id).filter(Employee.name == driver_name, Employee.status == 1).first():
+        issues.append(f"Lái xe '{driver_name}' không có trong danh sách nhân viên")
+    if license_plate and not db.query(Vehicle.id).filter(Vehicle.license_plate == license_plate, Vehicle.status == 1).first():
+        issues.append(f"Biển số '{license_plate}' không có trong danh sách xe")
+    return issues
+
+def find_duplicate_assignments(db: Session, trip_date: date, trips: list, exclude_ids=()) -> dict:
+    """Kiểm tra chuyến bị ghi trùng trong một ngày, trả về {vị trí trong trips: thông báo lỗi}.
+    
+    trips là danh sách (route_id, driver_name). Một tuyến thường chỉ được ghi một chuyến mỗi ngày
+    (lương tuyến tính theo ngày), riêng tuyến "Tăng Cường" cho phép nhiều chuyến nhưng mỗi lái xe
+    chỉ một chuyến. Dùng một truy vấn theo chỉ mục (date, route_id) cho cả danh sách."""
+    route_ids = {route_id for route_id, _ in trips}
+    if not route_ids:
+        return {}
+    route_codes = dict(db.query(Route.id, Route.route_code).filter(Route.id.in_(route_ids)).all())
+    existing_query = db.query(DailyRoute.route_id, DailyRoute.driver_name).filter(
+        DailyRoute.date == trip_date,
+        DailyRoute.route_id.in_(route_ids)
+    )
+    exclude_ids = [trip_id for trip_id in exclude_ids if trip_id]
+    if exclude_ids:
+        existing_query = existing_query.filter(DailyRoute.id.notin_(exclude_ids))
+    
+    taken_routes = set()
+    taken_drivers = set()
+    for route_id, driver_name in existing_query.all():
+        taken_routes.add(route_id)
+        taken_drivers.add((route_id, (driver_name or "").strip()))
+    
+    duplicates = {}
+    for index, (route_id, driver_name) in enumerate(trips):
+        route_code = (route_codes.get(route_id) or "").strip()
+        driver_name = (driver_name or "").strip()
+        if route_code == TANG_CUONG_ROUTE_CODE:
+            if driver_name and (route_id, driver_name) in taken_drivers:
+                duplicates[index] = f"Lái xe {driver_name} đã có chuyến {route_code} ngày {trip_date.strftime('%d/%m/%Y')}"
+        elif route_id in taken_routes:
+            duplicates[index] = f"Tuyến {route_code} đã có chuyến ngày {trip_date.strftime('%d/%m/%Y')}"
+        # Các chuyến trong cùng danh sách cũng không được trùng nhau
+        taken_routes.add(route_id)
+        taken_drivers.add((route_id, driver_name))
+    return duplicates
+
+def _assignment_clash_messages(trip_date: date, driver_name: str, license_plate: str, others: list) -> list:
+    """Cảnh báo lái xe chạy nhiều tuyến / xe do nhiều lái xe chạy trong ngày.
+    others là danh sách (driver_name, license_plate, route_code) của các chuyến khác cùng ngày."""
+    driver_name = (driver_name or "").strip()
+    license_plate = (license_plate or "").strip()
+    day = trip_date.strftime('%d/%m/%Y')
+    driver_routes = sorted({
+        route_code or "" for other_driver, _, route_code in others
+        if driver_name and (other_driver or "").strip() == driver_name
     })
+    plate_drivers = sorted({
+        (other_driver or "").strip() or "(chưa ghi lái xe)" for other_driver, other_plate, _ in others
+        if license_plate and (other_plate or "").strip() == license_plate and (other_driver or "").strip() != driver_name
+    })
+    messages = []
+    if driver_routes:
+        messages.append(f"Lái xe {driver_name} đã chạy tuyến {', '.join(driver_routes)} ngày {day}")
+    if plate_drivers:
+        messages.append(f"Xe {license_plate} đã được {', '.join(plate_drivers)} chạy ngày {day}")
+    return messages
+
+def find_assignment_clashes(db: Session, trip_date: date, driver_name: str, license_plate: str, exclude_ids=()) -> list:
+    """Cảnh báo (không chặn lưu) trùng lái xe / xe trong ngày cho một chuyến,
+    tra theo chỉ mục (driver_name, date) và (license_plate, date)"""
+    conditions = []
+    if (driver_name or "").strip():
+        conditions.append(DailyRoute.driver_name == driver_name.strip())
+    if (license_plate or "").strip():
+        conditions.append(DailyRoute.license_plate == license_plate.strip())
+    if not conditions:
+        return []
+    query = db.query(DailyRoute.driver_name, DailyRoute.license_plate, Route.route_code).join(
+        Route, Route.id == DailyRoute.route_id
+    ).filter(DailyRoute.date == trip_date, or_(*conditions))
+    exclude_ids = [trip_id for trip_id in exclude_ids if trip_id]
+    if exclude_ids:
+        query = query.filter(DailyRoute.id.notin_(exclude_ids))
+    return _assignment_clash_messages(trip_date, driver_name, license_plate, query.all())
 
+def get_day_assignment_clashes(daily_routes: list) -> dict:
+    """Cảnh báo trùng lái xe / xe cho các chuyến đã nạp của một ngày: {id chuyến: [thông báo]}"""
+    clashes = {}
+    for daily_route in daily_routes:
+        others = [
+            (other.driver_name, other.license_plate, other.route.route_code if other.route else "")
+            for other in daily_routes if other.id != daily_route.id and other.date == daily_route.date
+        ]
+        messages = _assignment_clash_messages(daily_route.date, daily_route.driver_name, daily_route.license_plate, others)
+        if messages:
+            clashes[daily_route.id] = messages
+    return clashes
 
+def get_assignment_conflicts(db: Session, from_date: date, to_date: date) -> list:
+    """Báo cáo trùng lịch trong khoảng ngày bằng một câu self-join trên daily_routes.
+    
+    Mỗi cặp chuyến cùng ngày được xếp vào một loại:
+    - duplicate_route: cùng tuyến (với "Tăng Cường": cùng tuyến và cùng lái xe) - lỗi cần sửa
+    - driver_multi_route: một lái xe chạy nhiều tuyến - để rà soát
+    - plate_multi_driver: một xe do nhiều lái xe chạy - để rà soát"""
+    rows = db.execute(text("""
+        SELECT * FROM (
+            SELECT a.date AS date,
+                   a.id AS first_id, b.id AS second_id,
+                   ra.route_code AS first_route_code, rb.route_code AS second_route_code,
+                   a.driver_name AS first_driver, b.driver_name AS second_driver,
+                   a.license_plate AS first_plate, b.license_plate AS second_plate,
+                   CASE
+                       WHEN a.route_id = b.route_id
+                            AND (TRIM(ra.route_code) <> :tang_cuong OR a.driver_name = b.driver_name)
+                           THEN 'duplicate_route'
+                       WHEN a.driver_name <> '' AND a.driver_name = b.driver_name
+                           THEN 'driver_multi_route'
+                       WHEN a.license_plate <> '' AND a.license_plate = b.license_plate
+                            AND a.driver_name <> b.driver_name
+                           THEN 'plate_multi_driver'
+                   END AS kind
+            FROM daily_routes a
+            JOIN daily_routes b
+              ON b.date = a.date AND b.id > a.id
+             AND (b.route_id = a.route_id
+                  OR (a.driver_name <> '' AND b.driver_name = a.driver_name)
+                  OR (a.license_plate <> '' AND b.license_plate = a.license_plate))
+            JOIN routes ra ON ra.id = a.route_id
+            JOIN routes rb ON rb.id = b.route_id
+            WHERE a.date >= :from_date AND a.date <= :to_date
+        )
+        WHERE kind IS NOT NULL
+        ORDER BY date, kind, first_id, second_id
+    """), {
+        "tang_cuong": TANG_CUONG_ROUTE_CODE,
+        "from_date": from_date.strftime("%Y-%m-%d"),
+        "to_date": to_date.strftime("%Y-%m-%d"),
+    }).mappings().all()
+    
+    return [dict(row, kind_label=CONFLICT_KIND_LABELS[row["kind"]], is_error=row["kind"] == "duplicate_route") for row in rows]
 
-@app.get("/salary-simple", response_class=HTMLResponse)
-async def salary_simple_page(request: Request):
-    """Redirect đến trang báo cáo tổng hợp"""
-    from fastapi.responses import RedirectResponse
-    return RedirectResponse(url="/report", status_code=302)
+def is_valid_report_period(month: Optional[int], year: int) -> bool:
+    """Tháng (nếu có) trong 1..12 và năm trong giới hạn của date(); tham số sai thì báo cáo trả về rỗng/400 thay vì lỗi 500"""
+    return 1 <= year <= 9999 and (not month or 1 <= month <= 12)
 
-@app.get("/general-report", response_class=HTMLResponse)
-async def general_report_page(
-    request: Request, 
+def _month_date_range(month: int, year: int):
+    """Ngày đầu và ngày cuối của tháng"""
+    from_date = date(year, month, 1)
+    next_month = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return from_date, next_month - timedelta(days=1)
+
+@app.get("/conflicts", response_class=HTMLResponse)
+async def conflicts_page(
+    request: Request,
     db: Session = Depends(get_db),
-    from_date: Optional[str] = None,
-    to_date: Optional[str] = None,
-    driver_name: Optional[str] = None,
-    license_plate: Optional[str] = None,
-    route_code: Optional[str] = None
+    month: Optional[int] = None,
+    year: Optional[int] = None,
+    error: Optional[str] = None
 ):
-    """Trang thống kê tổng hợp - báo cáo chi tiết hoạt động vận chuyển"""
-    # Khởi tạo query cơ bản
-    daily_routes_query = db.query(DailyRoute)
+    """Trang báo cáo trùng lịch lái xe / xe / tuyến trong tháng"""
+    if not month or not year:
+        current_date = datetime.now()
+        month = month or current_date.month
+        year = year or current_date.year
+    try:
+        from_date, to_date = _month_date_range(month, year)
+    except ValueError:
+        return RedirectResponse(url=f"/conflicts?error={quote('Tháng không hợp lệ')}", status_code=303)
     
-    # Áp dụng bộ lọc thời gian
-    if from_date and to_date:
-        try:
-            from_date_obj = datetime.strptime(from_date, "%Y-%m-%d").date()
-            to_date_obj = datetime.strptime(to_date, "%Y-%m-%d").date()
-            daily_routes_query = daily_routes_query.filter(
-                DailyRoute.date >= from_date_obj,
-                DailyRoute.date <= to_date_obj
-            )
-        except ValueError:
-            pass
+    conflicts = get_assignment_conflicts(db, from_date, to_date)
+    summary = {kind: 0 for kind in CONFLICT_KIND_LABELS}
+    for conflict in conflicts:
+        summary[conflict["kind"]] += 1
     
-    # Áp dụng các bộ lọc khác
-    if driver_name:
-        daily_routes_query = daily_routes_query.filter(DailyRoute.driver_name.ilike(f"%{driver_name}%"))
-    if license_plate:
-        daily_routes_query = daily_routes_query.filter(DailyRoute.license_plate.ilike(f"%{license_plate}%"))
-    if route_code:
-        daily_routes_query = daily_routes_query.join(Route).filter(Route.route_code.ilike(f"%{route_code}%"))
+    return templates.TemplateResponse("conflicts.html", {
+        "request": request,
+        "conflicts": conflicts,
+        "summary": summary,
+        "kind_labels": CONFLICT_KIND_LABELS,
+        "selected_month": month,
+        "selected_year": year,
+        "error": error
+    })
+
+@app.get("/api/conflicts")
+async def conflicts_api(
+    db: Session = Depends(get_db),
+    month: Optional[int] = None,
+    year: Optional[int] = None
+):
+    """Danh sách trùng lịch trong tháng dạng JSON"""
+    if not month or not year:
+        current_date = datetime.now()
+        month = month or current_date.month
+        year = year or current_date.year
+    try:
+        from_date, to_date = _month_date_range(month, year)
+    except ValueError:
+        return JSONResponse({"success": False, "message": "Tháng không hợp lệ"}, status_code=400)
     
-    daily_routes = daily_routes_query.all()
+    conflicts = get_assignment_conflicts(db, from_date, to_date)
+    return JSONResponse({
+        "success": True,
+        "month": month,
+        "year": year,
+        "conflicts": conflicts,
+        "error_count": sum(1 for conflict in conflicts if conflict["is_error"])
+    })
+
+# ===== KIỂM TRA HẠN GIẤY TỜ =====
+
+# "warn": vẫn lưu chuyến và cảnh báo trên bảng chấm công; "block": không lưu chuyến có giấy tờ hết hạn
+EXPIRED_DOCUMENT_POLICY = "warn"
+
+# Chỉ mục hạn giấy tờ giữ trong bộ nhớ kèm mốc thay đổi của nhân viên/xe trong data_versions lúc dựng;
+# mốc khác (kể cả do process khác ghi) -> dựng lại
+DOCUMENT_SOURCE_SCOPES = ("table:employees", "table:vehicles")
+_document_validity_index = {"version": None, "index": None}
+
+def get_document_validity_index(db: Session) -> dict:
+    """Chỉ mục tên lái xe -> hạn bằng lái, biển số -> hạn đăng kiểm/phù hiệu.
+    Dựng bằng 2 truy vấn khi cần, sau đó kiểm tra mỗi chuyến chỉ là tra dict."""
+    versions = get_data_versions(db, DOCUMENT_SOURCE_SCOPES)
+    version = tuple(versions.get(scope, 0) for scope in DOCUMENT_SOURCE_SCOPES)
+    if _document_validity_index["version"] != version:
+        drivers = {}
+        for name, license_expiry in db.query(Employee.name, Employee.license_expiry).filter(Employee.status == 1).all():
+            key = (name or "").strip()
+            if not key:
+                continue
+            # Trùng tên thì lấy hạn xa nhất để không cảnh báo nhầm
+            if key not in drivers or (license_expiry and (drivers[key] is None or license_expiry > drivers[key])):
+                drivers[key] = license_expiry
+        plates = {
+            (license_plate or "").strip(): (inspection_expiry, phu_hieu_expired_date)
+            for license_plate, inspection_expiry, phu_hieu_expired_date in db.query(
+                Vehicle.license_plate, Vehicle.inspection_expiry, Vehicle.phu_hieu_expired_date
+            ).filter(Vehicle.status == 1).all()
+        }
+        _document_validity_index["index"] = {"drivers": drivers, "plates": plates}
+        _document_validity_index["version"] = version
+    return _document_validity_index["index"]
+
+def check_trip_documents(index: dict, trip_date: date, driver_name: str, license_plate: str) -> list:
+    """Danh sách cảnh báo giấy tờ hết hạn tại ngày chạy (bỏ qua giấy tờ chưa nhập ngày hết hạn)"""
+    issues = []
+    driver_name = (driver_name or "").strip()
+    license_plate = (license_plate or "").strip()
+    license_expiry = index["drivers"].get(driver_name) if driver_name else None
+    if license_expiry and license_expiry < trip_date:
+        issues.append(f"Bằng lái của {driver_name} hết hạn ngày {license_expiry.strftime('%d/%m/%Y')}")
+    inspection_expiry, phu_hieu_expired_date = index["plates"].get(license_plate, (None, None)) if license_plate else (None, None)
+    if inspection_expiry and inspection_expiry < trip_date:
+        issues.append(f"Xe {license_plate} hết hạn đăng kiểm ngày {inspection_expiry.strftime('%d/%m/%Y')}")
+    if phu_hieu_expired_date and phu_hieu_expired_date < trip_date:
+        issues.append(f"Xe {license_plate} hết hạn phù hiệu ngày {phu_hieu_expired_date.strftime('%d/%m/%Y')}")
+    return issues
+
+# ===== CẢNH BÁO GIẤY TỜ SẮP HẾT HẠN =====
+
+EXPIRY_ALERT_DAYS = 30  # Cảnh báo giấy tờ hết hạn trong vòng N ngày tới (kể cả đã hết hạn)
+EXPIRY_ALERT_REFRESH_SECONDS = 3600  # Chu kỳ tính lại bảng cảnh báo (để cập nhật theo ngày)
+
+DOCUMENT_TYPE_LABELS = {
+    "license": "Bằng lái",
+    "cccd": "CCCD",
+    "inspection": "Đăng kiểm",
+    "phu_hieu": "Phù hiệu",
+}
+
+# Bảng cảnh báo là bảng tổng hợp trong database: mốc lưu ở rollup_states với khoá là ngày tính ("YYYY-MM-DD"),
+# nên sang ngày mới hoặc nhân viên/xe đổi (ở bất kỳ process nào) thì lần kiểm tra sau tính lại
+EXPIRY_ALERT_ROLLUP = "expiry_alerts"
+EXPIRY_ALERT_GLOBAL_TABLES = ("employees", "vehicles")
+_expiry_ics_cache = {"key": None, "body": None}
+
+def refresh_expiry_alerts(force: bool = False):
+    """Tính lại bảng document_expiry_alerts (nếu đã cũ hoặc force) bằng một câu INSERT ... SELECT
+    trên 4 cột ngày hết hạn (mỗi nhánh quét theo index của cột đó). Chạy trên session riêng,
+    giữ khoá ghi và kiểm tra lại mốc để nhiều worker không cùng tính."""
+    db = SessionLocal()
+    try:
+        today = date.today()
+        day_key = today.strftime("%Y-%m-%d")
+        if not force and not stale_rollup_months(db, EXPIRY_ALERT_ROLLUP, [day_key], EXPIRY_ALERT_GLOBAL_TABLES):
+            return
+        db.connection().exec_driver_sql("BEGIN IMMEDIATE")
+        if not force and not stale_rollup_months(db, EXPIRY_ALERT_ROLLUP, [day_key], EXPIRY_ALERT_GLOBAL_TABLES):
+            return
+        source_version = month_source_versions(db, [day_key], EXPIRY_ALERT_GLOBAL_TABLES)[day_key]
+        params = {
+            "horizon": (today + timedelta(days=EXPIRY_ALERT_DAYS)).strftime("%Y-%m-%d"),
+            "now": datetime.utcnow(),
+        }
+        db.execute(text("DELETE FROM document_expiry_alerts"))
+        db.execute(text("""
+            INSERT INTO document_expiry_alerts (document_type, entity_type, entity_id, entity_name, expiry_date, refreshed_at)
+            SELECT 'license', 'employee', id, name, license_expiry, :now FROM employees
+             WHERE status = 1 AND license_expiry IS NOT NULL AND license_expiry <= :horizon
+            UNION ALL
+            SELECT 'cccd', 'employee', id, name, cccd_expiry, :now FROM employees
+             WHERE status = 1 AND cccd_expiry IS NOT NULL AND cccd_expiry <= :horizon
+            UNION ALL
+            SELECT 'inspection', 'vehicle', id, license_plate, inspection_expiry, :now FROM vehicles
+             WHERE status = 1 AND inspection_expiry IS NOT NULL AND inspection_expiry <= :horizon
+            UNION ALL
+            SELECT 'phu_hieu', 'vehicle', id, license_plate, phu_hieu_expired_date, :now FROM vehicles
+             WHERE status = 1 AND phu_hieu_expired_date IS NOT NULL AND phu_hieu_expired_date <= :horizon
+        """), params)
+        # Chỉ giữ mốc của ngày vừa tính
+        db.execute(delete(RollupState).where(RollupState.rollup == EXPIRY_ALERT_ROLLUP))
+        mark_rollup_months_fresh(db, EXPIRY_ALERT_ROLLUP, [day_key], source_version)
+        db.commit()
+    finally:
+        db.close()
+
+def expiry_alerts_version(db: Session):
+    """(ngày tính, mốc dữ liệu nguồn) của bảng cảnh báo hiện tại - khoá cache của lịch ICS"""
+    day_key = date.today().strftime("%Y-%m-%d")
+    return day_key, db.query(RollupState.source_version).filter(
+        RollupState.rollup == EXPIRY_ALERT_ROLLUP, RollupState.month == day_key
+    ).scalar()
+
+async def _expiry_alert_scheduler():
+    """Tác vụ nền: tính lại bảng cảnh báo định kỳ"""
+    while True:
+        try:
+            await asyncio.to_thread(refresh_expiry_alerts)
+        except Exception as e:
+            print(f"Lỗi khi tính bảng cảnh báo hết hạn: {str(e)}")
+        await asyncio.sleep(EXPIRY_ALERT_REFRESH_SECONDS)
+
+@app.on_event("startup")
+async def _start_expiry_alert_scheduler():
+    asyncio.create_task(_expiry_alert_scheduler())
+
+def get_expiry_alerts(db: Session, days: int = EXPIRY_ALERT_DAYS) -> list:
+    """Đọc bảng cảnh báo (một truy vấn theo index expiry_date); tính lại trước nếu dữ liệu đã cũ"""
+    refresh_expiry_alerts()
     
-    # Tính thống kê theo lái xe
-    driver_stats = {}
-    for daily_route in daily_routes:
-        driver_name_key = daily_route.driver_name
-        license_plate_key = daily_route.license_plate
-        if driver_name_key and driver_name_key not in driver_stats:
-            driver_stats[driver_name_key] = {
-                'driver_name': driver_name_key,
-                'license_plate': license_plate_key or 'N/A',
-                'trip_count': 0,
-                'total_distance': 0,
-                'total_cargo': 0,
-                'routes': set()
-            }
-        
-        if driver_name_key:
-            driver_stats[driver_name_key]['trip_count'] += 1
-            driver_stats[driver_name_key]['total_distance'] += daily_route.distance_km
-            driver_stats[driver_name_key]['total_cargo'] += daily_route.cargo_weight
-            driver_stats[driver_name_key]['routes'].add(daily_route.route.route_code)
-            if license_plate_key:
-                driver_stats[driver_name_key]['license_plate'] = license_plate_key
+    today = date.today()
+    days = max(0, min(days, EXPIRY_ALERT_DAYS))
+    alerts = db.query(DocumentExpiryAlert).filter(
+        DocumentExpiryAlert.expiry_date <= today + timedelta(days=days)
+    ).order_by(DocumentExpiryAlert.expiry_date, DocumentExpiryAlert.id).all()
+    
+    return [{
+        "document_type": alert.document_type,
+        "document_label": DOCUMENT_TYPE_LABELS.get(alert.document_type, alert.document_type),
+        "entity_type": alert.entity_type,
+        "entity_id": alert.entity_id,
+        "entity_name": alert.entity_name,
+        "expiry_date": alert.expiry_date.strftime("%Y-%m-%d"),
+        "days_left": (alert.expiry_date - today).days,
+        "is_expired": alert.expiry_date < today,
+    } for alert in alerts]
+
+@app.get("/api/expiry-alerts")
+async def expiry_alerts_api(db: Session = Depends(get_db), days: int = EXPIRY_ALERT_DAYS):
+    """Danh sách giấy tờ đã/sắp hết hạn trong vòng `days` ngày (tối đa EXPIRY_ALERT_DAYS)"""
+    alerts = get_expiry_alerts(db, days)
+    return JSONResponse({
+        "success": True,
+        "days": max(0, min(days, EXPIRY_ALERT_DAYS)),
+        "expired_count": sum(1 for alert in alerts if alert["is_expired"]),
+        "alerts": alerts
+    })
+
+def _ics_text(value: str) -> str:
+    """Giá trị TEXT theo RFC 5545: thoát \\ ; , và xuống dòng"""
+    return (str(value or "").replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n").replace("\r", "\\n"))
+
+def _fold_ics_line(line: str, limit: int = 75) -> str:
+    """Gập dòng dài quá 75 octet (UTF-8) theo RFC 5545: dòng tiếp theo bắt đầu bằng một dấu cách,
+    không cắt giữa một ký tự nhiều byte"""
+    parts = []
+    current, size = "", 0
+    for char in line:
+        char_size = len(char.encode("utf-8"))
+        # Dòng tiếp theo đã tốn 1 octet cho dấu cách đầu dòng
+        if size + char_size > (limit if not parts else limit - 1):
+            parts.append(current)
+            current, size = "", 0
+        current += char
+        size += char_size
+    parts.append(current)
+    return "\r\n ".join(parts)
+
+@app.get("/expiry-alerts.ics")
+async def expiry_alerts_calendar(db: Session = Depends(get_db)):
+    """Lịch ICS các ngày hết hạn giấy tờ, cache theo mốc của bảng cảnh báo"""
+    refresh_expiry_alerts()
+    version = expiry_alerts_version(db)
+    if _expiry_ics_cache["key"] != version:
+        alerts = get_expiry_alerts(db)
+        lines = [
+            "BEGIN:VCALENDAR",
+            "VERSION:2.0",
+            "PRODID:-//Transport Management//Expiry Alerts//VI",
+            "CALSCALE:GREGORIAN",
+            "X-WR-CALNAME:Hạn giấy tờ",
+        ]
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+        for alert in alerts:
+            expiry = alert["expiry_date"].replace("-", "")
+            next_day = (datetime.strptime(alert["expiry_date"], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y%m%d")
+            lines += [
+                "BEGIN:VEVENT",
+                f"UID:{alert['document_type']}-{alert['entity_type']}-{alert['entity_id']}-{expiry}@transport",
+                f"DTSTAMP:{stamp}",
+                f"DTSTART;VALUE=DATE:{expiry}",
+                f"DTEND;VALUE=DATE:{next_day}",
+                "SUMMARY:" + _ics_text(f"Hết hạn {alert['document_label']} - {alert['entity_name']}"),
+                "END:VEVENT",
+            ]
+        lines.append("END:VCALENDAR")
+        _expiry_ics_cache["body"] = "\r\n".join(_fold_ics_line(line) for line in lines) + "\r\n"
+        _expiry_ics_cache["key"] = version
     
-    # Convert to list
-    salary_data = []
-    for driver_name_key, stats in driver_stats.items():
-        salary_data.append({
-            'driver_name': driver_name_key,
-            'license_plate': stats['license_plate'],
-            'trip_count': stats['trip_count'],
-            'total_distance': stats['total_distance'],
-            'total_cargo': stats['total_cargo'],
-            'routes': list(stats['routes'])
-        })
+    return Response(
+        content=_expiry_ics_cache["body"],
+        media_type="text/calendar",
+        headers={"Content-Disposition": "inline; filename=expiry-alerts.ics"}
+    )
+
+# ===== DAILY ROUTE JSON API (autosave từng dòng) =====
+
+IDEMPOTENCY_KEY_TTL_DAYS = 7  # Key cũ hơn sẽ bị dọn khi có key mới
+
+def serialize_daily_route(daily_route: DailyRoute) -> dict:
+    """Chuyển chuyến sang dict JSON gọn cho API"""
+    return {
+        "id": daily_route.id,
+        "route_id": daily_route.route_id,
+        "date": daily_route.date.strftime("%Y-%m-%d"),
+        "distance_km": daily_route.distance_km or 0,
+        "driver_name": daily_route.driver_name or "",
+        "license_plate": daily_route.license_plate or "",
+        "notes": daily_route.notes or "",
+        "updated_at": daily_route.updated_at.isoformat() if daily_route.updated_at else None
+    }
+
+def apply_daily_route_data(db: Session, daily_route: DailyRoute, data: dict):
+    """Gán các trường có trong data vào chuyến, raise ValueError nếu dữ liệu không hợp lệ.
+    Kiểm tra hết dữ liệu trước khi gán để chuyến không bị sửa dở dang khi có lỗi."""
+    values = {}
+    if "route_id" in data:
+        route_id = int(data["route_id"])
+        if not db.query(Route.id).filter(Route.id == route_id, Route.status == 1).first():
+            raise ValueError(f"Không tìm thấy tuyến {route_id}")
+        values["route_id"] = route_id
+    if "date" in data:
+        values["date"] = datetime.strptime(data["date"], "%Y-%m-%d").date()
+    if "distance_km" in data:
+        distance_km = float(data["distance_km"] or 0)
+        if distance_km < 0:
+            raise ValueError("Số km không được âm")
+        values["distance_km"] = distance_km
+    for field in ("driver_name", "license_plate", "notes"):
+        if field in data:
+            values[field] = (data[field] or "").strip()
+    # Chỉ kiểm tra giá trị mới: chuyến cũ của lái xe đã nghỉ / xe đã bán vẫn sửa được các trường khác
+    unknown = find_unknown_assignees(db, *(
+        values[field] if field in values and values[field] != (getattr(daily_route, field) or "") else ""
+        for field in ("driver_name", "license_plate")
+    ))
+    if unknown:
+        raise ValueError("; ".join(unknown))
+    
+    route_id = values.get("route_id", daily_route.route_id)
+    trip_date = values.get("date", daily_route.date)
+    if route_id and trip_date:
+        duplicates = find_duplicate_assignments(
+            db, trip_date, [(route_id, values.get("driver_name", daily_route.driver_name))], exclude_ids=[daily_route.id]
+        )
+        if duplicates:
+            raise ValueError(duplicates[0])
+    if EXPIRED_DOCUMENT_POLICY == "block" and trip_date:
+        issues = check_trip_documents(
+            get_document_validity_index(db), trip_date,
+            values.get("driver_name", daily_route.driver_name), values.get("license_plate", daily_route.license_plate)
+        )
+        if issues:
+            raise ValueError("; ".join(issues))
     
-    salary_data.sort(key=lambda x: x['trip_count'], reverse=True)
+    for field, value in values.items():
+        setattr(daily_route, field, value)
+
+def _daily_route_warnings(db: Session, daily_route: DailyRoute) -> list:
+    """Cảnh báo không chặn lưu: giấy tờ hết hạn, lái xe / xe trùng trong ngày"""
+    return check_trip_documents(
+        get_document_validity_index(db), daily_route.date, daily_route.driver_name, daily_route.license_plate
+    ) + find_assignment_clashes(
+        db, daily_route.date, daily_route.driver_name, daily_route.license_plate, exclude_ids=[daily_route.id]
+    )
+
+def apply_daily_route_operation(db: Session, operation: dict) -> dict:
+    """Thực hiện một thao tác create/update/delete trên một chuyến (chưa commit).
+    Trả về dict kết quả; raise ValueError/LookupError khi dữ liệu sai/không tìm thấy."""
+    op = operation.get("op")
+    data = operation.get("data") or {}
+    
+    if op == "create":
+        if "route_id" not in data or "date" not in data:
+            raise ValueError("Thiếu route_id hoặc date")
+        daily_route = DailyRoute(cargo_weight=0, employee_name="", distance_km=0, driver_name="", license_plate="", notes="")
+        apply_daily_route_data(db, daily_route, data)
+        db.add(daily_route)
+        db.flush()
+        return {"op": op, "data": serialize_daily_route(daily_route), "warnings": _daily_route_warnings(db, daily_route)}
+    
+    daily_route = db.query(DailyRoute).filter(DailyRoute.id == operation.get("id")).first()
+    if op == "update":
+        if not daily_route:
+            raise LookupError(f"Không tìm thấy chuyến {operation.get('id')}")
+        apply_daily_route_data(db, daily_route, data)
+        db.flush()
+        return {"op": op, "data": serialize_daily_route(daily_route), "warnings": _daily_route_warnings(db, daily_route)}
+    if op == "delete":
+        # Xóa lặp lại (chuyến đã bị xóa) vẫn coi là thành công
+        if daily_route:
+            db.delete(daily_route)
+            db.flush()
+        return {"op": op, "id": operation.get("id")}
     
-    # Tạo dữ liệu chi tiết từng chuyến
-    trip_details = []
-    for daily_route in daily_routes:
-        if daily_route.driver_name:
-            trip_details.append({
-                'driver_name': daily_route.driver_name,
-                'license_plate': daily_route.license_plate or 'N/A',
-                'date': daily_route.date,
-                'route_code': daily_route.route.route_code,
-                'route_name': daily_route.route.route_name,
-                'distance_km': daily_route.distance_km,
-                'cargo_weight': daily_route.cargo_weight,
-                'notes': daily_route.notes or ''
-            })
+    raise ValueError(f"Thao tác không hợp lệ: {op}")
+
+def run_idempotent_operations(db: Session, operations: list, check_conflict=None, collect_errors: bool = False) -> list:
+    """Thực hiện danh sách thao tác, bỏ qua thao tác có idempotency key đã xử lý (trả lại kết quả cũ).
+    Dùng một truy vấn IN để tra các key đã có. Chưa commit.
+    
+    - Thao tác có "id_ref" (idempotency key của thao tác trước đó trên cùng chuyến) sẽ dùng id của chuyến
+      thao tác đó tạo/sửa, updated_at của kết quả đó được gắn vào "ref_updated_at" để kiểm tra xung đột.
+    - check_conflict(operation) trả về dict kết quả xung đột (không áp dụng thao tác) hoặc None.
+    - collect_errors=True: lỗi dữ liệu của một thao tác được trả về trong kết quả thay vì raise."""
+    import json
     
-    trip_details.sort(key=lambda x: (x['driver_name'], x['date']))
+    keys = [op.get("idempotency_key") for op in operations if op.get("idempotency_key")]
+    keys += [op.get("id_ref") for op in operations if op.get("id_ref")]
+    stored = {}
+    if keys:
+        stored = {
+            item.key: json.loads(item.response)
+            for item in db.query(ApiIdempotencyKey).filter(ApiIdempotencyKey.key.in_(keys)).all()
+        }
     
-    # Lấy danh sách cho dropdown
-    routes = db.query(Route).all()
-    employees = db.query(Employee).all()
-    vehicles = db.query(Vehicle).all()
+    results = []
+    for operation in operations:
+        key = operation.get("idempotency_key")
+        if key and key in stored:
+            results.append(dict(stored[key], replayed=True))
+            continue
+        try:
+            if operation.get("id_ref"):
+                referenced = stored.get(operation["id_ref"]) or {}
+                if "data" in referenced:
+                    operation = dict(operation, id=referenced["data"]["id"], ref_updated_at=referenced["data"]["updated_at"])
+                elif not operation.get("id"):
+                    raise LookupError(f"Không tìm thấy chuyến được tạo bởi thao tác {operation['id_ref']}")
+            result = (check_conflict(operation) if check_conflict else None) or apply_daily_route_operation(db, operation)
+        except (LookupError, ValueError, TypeError) as e:
+            if not collect_errors:
+                raise
+            # Không lưu lỗi theo key để client có thể gửi lại sau khi sửa dữ liệu
+            results.append({"op": operation.get("op"), "error": str(e)})
+            continue
+        if key:
+            stored[key] = result
+            db.add(ApiIdempotencyKey(key=key, response=json.dumps(result, ensure_ascii=False)))
+        results.append(result)
+    
+    if keys:
+        db.query(ApiIdempotencyKey).filter(
+            ApiIdempotencyKey.created_at < datetime.utcnow() - timedelta(days=IDEMPOTENCY_KEY_TTL_DAYS)
+        ).delete(synchronize_session=False)
+    return results
+
+def _daily_route_api_response(db: Session, operation: dict, success_status: int = 200):
+    """Chạy một thao tác đơn lẻ qua API và trả về JSONResponse theo định dạng chung"""
+    try:
+        result = run_idempotent_operations(db, [operation])[0]
+        db.commit()
+    except LookupError as e:
+        db.rollback()
+        return JSONResponse({"success": False, "message": str(e)}, status_code=404)
+    except (ValueError, TypeError) as e:
+        db.rollback()
+        return JSONResponse({"success": False, "message": f"Dữ liệu không hợp lệ: {str(e)}"}, status_code=400)
+    except Exception as e:
+        db.rollback()
+        return JSONResponse({"success": False, "message": f"Lỗi hệ thống: {str(e)}"}, status_code=500)
     
-    # Template data - CHỈ TRUYỀN KHI CÓ GIÁ TRỊ
-    template_data = {
-        "request": request,
-        "salary_data": salary_data,
-        "trip_details": trip_details,
-        "employees": employees,
-        "vehicles": vehicles,
-        "routes": routes,
-        "total_routes": len(daily_routes),
-        "total_distance": sum(dr.distance_km for dr in daily_routes),
-        "total_cargo": sum(dr.cargo_weight for dr in daily_routes)
-    }
+    return JSONResponse(dict(result, success=True), status_code=success_status)
+
+async def read_json_object(request: Request) -> dict:
+    """Đọc body JSON dạng object, raise ValueError nếu body sai định dạng"""
+    try:
+        payload = await request.json()
+    except ValueError:  # JSONDecodeError / UnicodeDecodeError
+        raise ValueError("body không phải JSON hợp lệ")
+    if not isinstance(payload, dict):
+        raise ValueError("body phải là một object JSON")
+    return payload
+
+def read_operation_list(payload: dict) -> list:
+    """Lấy danh sách thao tác trong body, raise ValueError nếu không phải danh sách object"""
+    operations = payload.get("operations") or []
+    if not isinstance(operations, list) or not all(isinstance(operation, dict) for operation in operations):
+        raise ValueError("operations phải là danh sách object")
+    return operations
+
+def _invalid_json_response(error: ValueError):
+    return JSONResponse({"success": False, "message": f"Dữ liệu không hợp lệ: {str(error)}"}, status_code=400)
+
+@app.post("/api/daily-routes")
+async def create_daily_route_api(request: Request, db: Session = Depends(get_db)):
+    """Tạo một chuyến (JSON). Header Idempotency-Key giúp gửi lại an toàn."""
+    try:
+        data = await read_json_object(request)
+    except ValueError as e:
+        return _invalid_json_response(e)
+    return _daily_route_api_response(db, {
+        "op": "create",
+        "data": data,
+        "idempotency_key": request.headers.get("Idempotency-Key")
+    }, success_status=201)
+
+@app.put("/api/daily-routes/{daily_route_id}")
+async def update_daily_route_api(daily_route_id: int, request: Request, db: Session = Depends(get_db)):
+    """Cập nhật một phần thông tin chuyến (chỉ các trường được gửi)"""
+    try:
+        data = await read_json_object(request)
+    except ValueError as e:
+        return _invalid_json_response(e)
+    return _daily_route_api_response(db, {
+        "op": "update",
+        "id": daily_route_id,
+        "data": data,
+        "idempotency_key": request.headers.get("Idempotency-Key")
+    })
+
+@app.delete("/api/daily-routes/{daily_route_id}")
+async def delete_daily_route_api(daily_route_id: int, request: Request, db: Session = Depends(get_db)):
+    """Xóa một chuyến"""
+    return _daily_route_api_response(db, {
+        "op": "delete",
+        "id": daily_route_id,
+        "idempotency_key": request.headers.get("Idempotency-Key")
+    })
+
+@app.post("/api/daily-routes/batch")
+async def batch_daily_routes_api(request: Request, db: Session = Depends(get_db)):
+    """Thực hiện nhiều thao tác trong một transaction.
+    Body: {"operations": [{"op": "create|update|delete", "id": ..., "data": {...}, "idempotency_key": "..."}]}"""
+    try:
+        operations = read_operation_list(await read_json_object(request))
+    except ValueError as e:
+        return _invalid_json_response(e)
     
-    # Chỉ thêm khi có giá trị
-    if from_date:
-        template_data["from_date"] = from_date
-    if to_date:
-        template_data["to_date"] = to_date
-    if driver_name:
-        template_data["driver_name"] = driver_name
-    if license_plate:
-        template_data["license_plate"] = license_plate
-    if route_code:
-        template_data["route_code"] = route_code
+    try:
+        results = run_idempotent_operations(db, operations)
+        db.commit()
+    except (LookupError, ValueError, TypeError) as e:
+        db.rollback()
+        return JSONResponse({"success": False, "message": f"Dữ liệu không hợp lệ: {str(e)}"}, status_code=400)
+    except Exception as e:
+        db.rollback()
+        return JSONResponse({"success": False, "message": f"Lỗi hệ thống: {str(e)}"}, status_code=500)
     
-    return templates.TemplateResponse("salary_simple.html", template_data)
+    return JSONResponse({"success": True, "results": results})
 
-@app.get("/salary-simple/export-excel")
-async def export_salary_simple_excel(
-    db: Session = Depends(get_db),
-    from_date: Optional[str] = None,
-    to_date: Optional[str] = None,
-    driver_name: Optional[str] = None,
-    license_plate: Optional[str] = None,
-    route_code: Optional[str] = None
-):
-    """Redirect đến general-report export"""
-    from fastapi.responses import RedirectResponse
-    params = []
-    if from_date:
-        params.append(f"from_date={from_date}")
-    if to_date:
-        params.append(f"to_date={to_date}")
-    if driver_name:
-        params.append(f"driver_name={driver_name}")
-    if license_plate:
-        params.append(f"license_plate={license_plate}")
-    if route_code:
-        params.append(f"route_code={route_code}")
+# ===== ĐỒNG BỘ OFFLINE =====
+
+SYNC_WATERMARK_OVERLAP_SECONDS = 5  # Lùi watermark để không sót giao dịch commit chậm (client upsert theo id nên đọc lặp không sao)
+TOMBSTONE_RETENTION_DAYS = 30  # Client offline lâu hơn sẽ phải tải lại toàn bộ
+
+def _parse_client_timestamp(value):
+    """Parse timestamp ISO của client (có thể kèm 'Z'/offset) về datetime UTC không timezone"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if parsed.tzinfo:
+        parsed = (parsed - parsed.utcoffset()).replace(tzinfo=None)
+    return parsed
+
+@app.post("/api/daily-routes/sync")
+async def sync_daily_routes_api(request: Request, db: Session = Depends(get_db)):
+    """Đồng bộ hàng đợi thao tác offline trong một transaction và trả về thay đổi phía server.
+    Body: {"since": watermark|null, "date_from": "YYYY-MM-DD", "date_to": "YYYY-MM-DD",
+           "operations": [{"client_op_id", "client_ts", "op", "id" | "id_ref", "base_updated_at", "data"}]}
+    Thao tác update/delete bị coi là xung đột nếu chuyến trên server đã đổi sau base_updated_at (hoặc client_ts).
+    Thao tác nối tiếp (id_ref) lấy mốc từ kết quả của thao tác trước; chuyến đã được ghi trước đó trong cùng lô
+    thì không so mốc nữa (client gửi nhiều lần sửa liên tiếp của một dòng)."""
+    request_started_at = datetime.utcnow()
     
-    url = "/general-report/export-excel"
-    if params:
-        url += "?" + "&".join(params)
+    try:
+        payload = await read_json_object(request)
+        since = _parse_client_timestamp(payload.get("since"))
+        date_from = datetime.strptime(payload["date_from"], "%Y-%m-%d").date() if payload.get("date_from") else None
+        date_to = datetime.strptime(payload["date_to"], "%Y-%m-%d").date() if payload.get("date_to") else None
+        operations = [
+            dict(
+                op,
+                idempotency_key=op.get("client_op_id"),
+                base_updated_at=_parse_client_timestamp(op.get("base_updated_at") or op.get("client_ts"))
+            )
+            for op in read_operation_list(payload)
+        ]
+    except (TypeError, ValueError) as e:
+        return _invalid_json_response(e)
+    
+    # Tải các chuyến được tham chiếu bằng một truy vấn để kiểm tra xung đột
+    referenced_ids = [op["id"] for op in operations if op.get("id")]
+    server_rows = {}
+    if referenced_ids:
+        server_rows = {row.id: row for row in db.query(DailyRoute).filter(DailyRoute.id.in_(referenced_ids)).all()}
+    
+    written_ids = set()
+    
+    def check_conflict(operation):
+        if operation.get("op") not in ("update", "delete"):
+            return None
+        server_row = server_rows.get(operation.get("id"))
+        if server_row is None and operation.get("id_ref"):
+            # Chuyến vừa được tạo bởi thao tác trước nên chưa có trong server_rows
+            server_row = server_rows[operation["id"]] = db.query(DailyRoute).filter(DailyRoute.id == operation["id"]).first()
+        if server_row is None:
+            return {"op": operation["op"], "id": operation.get("id"), "conflict": "deleted"} if operation["op"] == "update" else None
+        base_updated_at = _parse_client_timestamp(operation.get("ref_updated_at")) or operation.get("base_updated_at")
+        if server_row.id not in written_ids and base_updated_at and server_row.updated_at and server_row.updated_at > base_updated_at:
+            return {"op": operation["op"], "id": server_row.id, "conflict": "modified", "server": serialize_daily_route(server_row)}
+        written_ids.add(server_row.id)
+        return None
     
-    return RedirectResponse(url=url, status_code=302)
-
-@app.get("/general-report/export-excel")
-async def export_general_report_excel(
-    db: Session = Depends(get_db),
-    from_date: Optional[str] = None,
-    to_date: Optional[str] = None,
-    driver_name: Optional[str] = None,
-    license_plate: Optional[str] = None,
-    route_code: Optional[str] = None
-):
-    """Xuất Excel danh sách chi tiết từng chuyến cho general-report"""
-    # Sử dụng lại logic lọc từ salary_simple_page
-    daily_routes_query = db.query(DailyRoute)
+    try:
+        results = run_idempotent_operations(db, operations, check_conflict=check_conflict, collect_errors=True)
+        db.query(DailyRouteTombstone).filter(
+            DailyRouteTombstone.deleted_at < request_started_at - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+        ).delete(synchronize_session=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        return JSONResponse({"success": False, "message": f"Lỗi hệ thống: {str(e)}"}, status_code=500)
+    
+    for operation, result in zip(operations, results):
+        result["client_op_id"] = operation.get("client_op_id")
+    
+    # Delta kể từ watermark (đọc qua index updated_at / deleted_at)
+    changes_query = db.query(DailyRoute)
+    deleted_query = db.query(DailyRouteTombstone.daily_route_id)
+    if since:
+        changes_query = changes_query.filter(DailyRoute.updated_at > since)
+        deleted_query = deleted_query.filter(DailyRouteTombstone.deleted_at > since)
+    if date_from:
+        changes_query = changes_query.filter(DailyRoute.date >= date_from)
+        deleted_query = deleted_query.filter(DailyRouteTombstone.date >= date_from)
+    if date_to:
+        changes_query = changes_query.filter(DailyRoute.date <= date_to)
+        deleted_query = deleted_query.filter(DailyRouteTombstone.date <= date_to)
+    
+    if since or date_from or date_to:
+        changes = [serialize_daily_route(row) for row in changes_query.all()]
+        deleted_ids = [row.daily_route_id for row in deleted_query.all()] if since else []
+    else:
+        changes, deleted_ids = [], []
     
-    # Áp dụng bộ lọc thời gian
-    if from_date and to_date:
+    return JSONResponse({
+        "success": True,
+        "results": results,
+        "changes": changes,
+        "deleted_ids": deleted_ids,
+        "reset": bool(since and since < request_started_at - timedelta(days=TOMBSTONE_RETENTION_DAYS)),
+        "watermark": (request_started_at - timedelta(seconds=SYNC_WATERMARK_OVERLAP_SECONDS)).isoformat()
+    })
+
+# ===== CẬP NHẬT TRỰC TIẾP (SERVER-SENT EVENTS) =====
+
+LIVE_TABLES = {"daily_routes", "fuel_records", "finance_transactions"}
+LIVE_QUEUE_SIZE = 100  # Client đọc chậm bị đầy hàng đợi sẽ nhận sự kiện "resync" thay vì giữ bộ nhớ
+LIVE_KEEPALIVE_SECONDS = 25
+LIVE_MAX_TRIP_ROWS = 200  # Thay đổi hàng loạt lớn hơn thì chỉ báo client tải lại ngày đó
+LIVE_POLL_SECONDS = 2  # Chu kỳ đọc nhật ký data_changes để nhận thay đổi của worker khác
+
+# Mỗi kết nối SSE là một asyncio.Queue; thông điệp được dựng một lần rồi chia cho mọi hàng đợi.
+# Một tác vụ nền mỗi worker đọc nhật ký data_changes (thay đổi của mọi worker) và phát cho client của mình;
+# ghi trong chính process này thì đánh thức tác vụ ngay thay vì chờ hết chu kỳ.
+_live_clients = set()
+_live_loop = None
+_live_relay = {"version": None, "wakeup": None, "task": None}
+
+@app.on_event("startup")
+async def _capture_live_loop():
+    global _live_loop
+    _live_loop = asyncio.get_running_loop()
+    _live_relay["wakeup"] = asyncio.Event()
+    _live_relay["task"] = _live_loop.create_task(_relay_live_changes())
+
+@app.on_event("shutdown")
+async def _stop_live_relay():
+    if _live_relay["task"]:
+        _live_relay["task"].cancel()
+
+def _format_sse(event_name: str, payload: dict) -> str:
+    return f"event: {event_name}\ndata: {json.dumps(payload, ensure_ascii=False, default=str)}\n\n"
+
+def _fan_out_live_message(message: str):
+    """Chạy trên event loop: đẩy thông điệp vào hàng đợi của từng client"""
+    for queue in list(_live_clients):
         try:
-            from_date_obj = datetime.strptime(from_date, "%Y-%m-%d").date()
-            to_date_obj = datetime.strptime(to_date, "%Y-%m-%d").date()
-            daily_routes_query = daily_routes_query.filter(
-                DailyRoute.date >= from_date_obj,
-                DailyRoute.date <= to_date_obj
-            )
-        except ValueError:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(_format_sse("resync", {}))
+
+def _build_trip_delta(db: Session, dates: set, ids: set) -> dict:
+    """Các chuyến vừa thêm/sửa, ID đã xoá và tổng của từng ngày bị ảnh hưởng"""
+    delta = {"trips": [], "deleted_ids": [], "day_totals": {}, "reload_dates": []}
+    if ids and len(ids) <= LIVE_MAX_TRIP_ROWS:
+        trips = db.query(DailyRoute).filter(DailyRoute.id.in_(ids)).all()
+        for trip in trips:
+            delta["trips"].append(dict(serialize_daily_route(trip), route_code=trip.route.route_code if trip.route else ""))
+        delta["deleted_ids"] = sorted(ids - {trip.id for trip in trips})
+    elif ids:
+        delta["reload_dates"] = sorted(changed_date.strftime("%Y-%m-%d") for changed_date in dates)
+    if dates:
+        rows = db.execute(text("""
+            SELECT date, COUNT(*), COALESCE(SUM(distance_km), 0), COUNT(DISTINCT NULLIF(driver_name, ''))
+            FROM daily_routes WHERE date IN :dates GROUP BY date
+        """).bindparams(bindparam("dates", expanding=True)), {
+            "dates": [changed_date.strftime("%Y-%m-%d") for changed_date in dates]
+        }).all()
+        delta["day_totals"] = {changed_date.strftime("%Y-%m-%d"): {"count": 0, "distance_km": 0, "drivers": 0} for changed_date in dates}
+        for day, count, distance_km, drivers in rows:
+            delta["day_totals"][day] = {"count": count, "distance_km": distance_km, "drivers": drivers}
+    return delta
+
+def _collect_live_messages() -> list:
+    """Đọc nhật ký thay đổi từ lần đọc trước, dựng một thông điệp "change" cho mỗi bảng bị ảnh hưởng"""
+    db = SessionLocal()
+    try:
+        if _live_relay["version"] is None:
+            _live_relay["version"] = current_data_version(db)
+            return []
+        changes, _live_relay["version"] = read_data_changes(db, _live_relay["version"], sorted(LIVE_TABLES))
+        if changes is None:
+            return [_format_sse("resync", {})]
+        changed = {}
+        for table_name, row_id, changed_date in changes:
+            dates, ids = changed.setdefault(table_name, (set(), set()))
+            if changed_date:
+                dates.add(datetime.strptime(str(changed_date)[:10], "%Y-%m-%d").date())
+            if row_id is not None:
+                ids.add(row_id)
+        if not changed:
+            return []
+        # Cache số liệu trang chủ của process này chưa biết thay đổi từ worker khác
+        _dashboard_stats_cache["expires_at"] = 0.0
+        stats = get_dashboard_stats(db)
+        messages = []
+        for table_name, (dates, ids) in changed.items():
+            payload = {
+                "table": table_name,
+                "dates": sorted(changed_date.strftime("%Y-%m-%d") for changed_date in dates),
+                "reset": not dates,
+                "stats": stats,
+            }
+            if table_name == "daily_routes" and dates:
+                payload.update(_build_trip_delta(db, dates, ids))
+            messages.append(_format_sse("change", payload))
+        return messages
+    finally:
+        db.close()
+
+def _read_live_version() -> int:
+    db = SessionLocal()
+    try:
+        return current_data_version(db)
+    finally:
+        db.close()
+
+async def _relay_live_changes():
+    while True:
+        try:
+            await asyncio.wait_for(_live_relay["wakeup"].wait(), LIVE_POLL_SECONDS)
+        except asyncio.TimeoutError:
             pass
+        _live_relay["wakeup"].clear()
+        if not _live_clients:
+            # Không có ai nghe thì không đọc nhật ký; client kết nối sau chỉ nhận thay đổi từ lúc đó
+            _live_relay["version"] = None
+            continue
+        try:
+            messages = await asyncio.to_thread(_collect_live_messages)
+        except Exception as e:
+            print(f"Lỗi khi đọc thay đổi cho SSE: {str(e)}")
+            continue
+        for message in messages:
+            _fan_out_live_message(message)
+
+@on_data_change
+def _broadcast_live_change(table_name, dates, ids):
+    # Ghi trong process này -> đánh thức tác vụ nền đọc nhật ký ngay
+    if table_name in LIVE_TABLES and _live_clients and _live_loop is not None:
+        _live_loop.call_soon_threadsafe(_live_relay["wakeup"].set)
+
+@app.get("/api/live")
+async def live_events(request: Request):
+    """Luồng SSE: sự kiện "change" khi có chuyến/đổ dầu/thu chi được ghi, "resync" khi client bị tụt lại"""
+    queue = asyncio.Queue(maxsize=LIVE_QUEUE_SIZE)
+    if not _live_clients:
+        # Client đầu tiên: lấy mốc nhật ký ngay để không sót thay đổi xảy ra trước chu kỳ đọc đầu tiên
+        _live_relay["version"] = await asyncio.to_thread(_read_live_version)
+    _live_clients.add(queue)
+    
+    async def event_stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), LIVE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"
+        finally:
+            _live_clients.discard(queue)
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+# ===== COPY-FORWARD & LỊCH CHẠY LẶP LẠI =====
+
+WEEKDAY_NAMES = ["Thứ 2", "Thứ 3", "Thứ 4", "Thứ 5", "Thứ 6", "Thứ 7", "Chủ nhật"]
+MAX_GENERATE_DAYS = 93  # Giới hạn khoảng ngày sinh chuyến một lần (~3 tháng)
+
+# CTE sinh danh sách ngày [:target_from, :target_to] dạng 'YYYY-MM-DD' (giống cách SQLAlchemy lưu cột Date)
+TARGET_DAYS_CTE = """
+    WITH RECURSIVE target_days(day) AS (
+        SELECT :target_from
+        UNION ALL
+        SELECT date(day, '+1 day') FROM target_days WHERE day < :target_to
+    )
+"""
+
+def _insert_generated_daily_routes(db: Session, sql: str, params: dict) -> int:
+    """Chạy một câu INSERT ... SELECT ... RETURNING và ghi nhận thay đổi cho cache"""
+    params = dict(params, now=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f"))
+    inserted_rows = db.execute(text(sql), params).all()
+    mark_data_changed(
+        db, "daily_routes",
+        {datetime.strptime(row.date, "%Y-%m-%d").date() for row in inserted_rows},
+        {row.id for row in inserted_rows}
+    )
+    return len(inserted_rows)
+
+def copy_daily_routes(db: Session, source_date: date, target_from: date, target_to: date) -> int:
+    """Sao chép phân công của ngày nguồn sang từng ngày trong khoảng đích bằng một câu INSERT ... SELECT.
+    Bỏ qua tuyến đã có chuyến ở ngày đích để không tạo trùng. Chưa commit."""
+    sql = TARGET_DAYS_CTE + """
+        INSERT INTO daily_routes (route_id, date, distance_km, cargo_weight, driver_name, license_plate, employee_name, notes, created_at, updated_at)
+        SELECT src.route_id, target_days.day, src.distance_km, src.cargo_weight, src.driver_name,
+               src.license_plate, src.employee_name, src.notes, :now, :now
+        FROM daily_routes src
+        CROSS JOIN target_days
+        WHERE src.date = :source_date
+          AND target_days.day != :source_date
+          AND NOT EXISTS (
+              SELECT 1 FROM daily_routes existing
+              WHERE existing.date = target_days.day AND existing.route_id = src.route_id
+          )
+        RETURNING id, date
+    """
+    return _insert_generated_daily_routes(db, sql, {
+        "source_date": source_date.isoformat(),
+        "target_from": target_from.isoformat(),
+        "target_to": target_to.isoformat()
+    })
+
+def generate_scheduled_daily_routes(db: Session, target_from: date, target_to: date) -> int:
+    """Sinh chuyến từ lịch chạy hàng tuần cho cả khoảng ngày bằng một câu INSERT ... SELECT.
+    Bỏ qua tuyến đã có chuyến trong ngày. Chưa commit."""
+    # strftime('%w'): 0 = Chủ nhật -> quy đổi về 0 = Thứ 2 giống date.weekday()
+    sql = TARGET_DAYS_CTE + """
+        INSERT INTO daily_routes (route_id, date, distance_km, cargo_weight, driver_name, license_plate, employee_name, notes, created_at, updated_at)
+        SELECT t.route_id, target_days.day, COALESCE(t.distance_km, 0), 0, COALESCE(t.driver_name, ''),
+               COALESCE(t.license_plate, ''), '', COALESCE(t.notes, ''), :now, :now
+        FROM route_schedule_templates t
+        JOIN routes r ON r.id = t.route_id AND r.is_active = 1 AND r.status = 1
+        JOIN target_days ON (CAST(strftime('%w', target_days.day) AS INTEGER) + 6) % 7 = t.weekday
+        WHERE t.is_active = 1
+          AND NOT EXISTS (
+              SELECT 1 FROM daily_routes existing
+              WHERE existing.date = target_days.day AND existing.route_id = t.route_id
+          )
+        RETURNING id, date
+    """
+    return _insert_generated_daily_routes(db, sql, {
+        "target_from": target_from.isoformat(),
+        "target_to": target_to.isoformat()
+    })
+
+def _parse_target_range(target_from_str, target_to_str):
+    """Parse khoảng ngày đích, trả về (from, to) hoặc None nếu không hợp lệ"""
+    try:
+        target_from = datetime.strptime(target_from_str, "%Y-%m-%d").date()
+        target_to = datetime.strptime(target_to_str, "%Y-%m-%d").date() if target_to_str else target_from
+    except (TypeError, ValueError):
+        return None
+    if target_to < target_from or (target_to - target_from).days >= MAX_GENERATE_DAYS:
+        return None
+    return target_from, target_to
+
+@app.post("/daily-new/copy")
+async def copy_daily_new_routes(request: Request, db: Session = Depends(get_db)):
+    """Sao chép chuyến của một ngày sang một ngày hoặc một khoảng ngày"""
+    form_data = await request.form()
     
-    # Áp dụng các bộ lọc khác
-    if driver_name:
-        daily_routes_query = daily_routes_query.filter(DailyRoute.driver_name.ilike(f"%{driver_name}%"))
-    if license_plate:
-        daily_routes_query = daily_routes_query.filter(DailyRoute.license_plate.ilike(f"%{license_plate}%"))
-    if route_code:
-        daily_routes_query = daily_routes_query.join(Route).filter(Route.route_code.ilike(f"%{route_code}%"))
-    
-    daily_routes = daily_routes_query.all()
+    try:
+        source_date = datetime.strptime(form_data.get("source_date") or "", "%Y-%m-%d").date()
+    except ValueError:
+        return RedirectResponse(url="/daily-new", status_code=303)
     
-    # Tạo dữ liệu chi tiết từng chuyến
-    trip_details = []
-    for daily_route in daily_routes:
-        if daily_route.driver_name:
-            trip_details.append({
-                'stt': len(trip_details) + 1,
-                'ngay_chay': daily_route.date.strftime('%d/%m/%Y'),
-                'ten_lai_xe': daily_route.driver_name,
-                'bien_so_xe': daily_route.license_plate or 'N/A',
-                'ma_tuyen': daily_route.route.route_code,
-                'ten_tuyen': daily_route.route.route_name,
-                'km': daily_route.distance_km,
-                'tai_trong': daily_route.cargo_weight,
-                'ghi_chu': daily_route.notes or ''
-            })
+    target_range = _parse_target_range(form_data.get("target_from"), form_data.get("target_to"))
+    if not target_range:
+        return RedirectResponse(url=f"/daily-new?selected_date={source_date.strftime('%Y-%m-%d')}", status_code=303)
     
-    # Tạo CSV content với UTF-8 BOM để Excel hiển thị đúng tiếng Việt
-    csv_content = "\ufeff"  # UTF-8 BOM
-    csv_content += "STT,Ngày chạy,Tên lái xe,Biển số xe,Mã tuyến,Tên tuyến,Km,Tải trọng,Ghi chú\n"
+    copied_count = copy_daily_routes(db, source_date, *target_range)
+    db.commit()
     
-    for trip in trip_details:
-        # Escape các ký tự đặc biệt trong CSV
-        def escape_csv_field(field):
-            if field is None:
-                return ""
-            field_str = str(field)
-            # Nếu chứa dấu phẩy, dấu ngoặc kép hoặc xuống dòng thì bọc trong dấu ngoặc kép
-            if ',' in field_str or '"' in field_str or '\n' in field_str:
-                field_str = field_str.replace('"', '""')  # Escape dấu ngoặc kép
-                field_str = f'"{field_str}"'
-            return field_str
-        
-        csv_content += f"{trip['stt']},{escape_csv_field(trip['ngay_chay'])},{escape_csv_field(trip['ten_lai_xe'])},{escape_csv_field(trip['bien_so_xe'])},{escape_csv_field(trip['ma_tuyen'])},{escape_csv_field(trip['ten_tuyen'])},{trip['km']},{trip['tai_trong']},{escape_csv_field(trip['ghi_chu'])}\n"
+    return RedirectResponse(url=f"/daily-new?selected_date={target_range[0].strftime('%Y-%m-%d')}&generated_count={copied_count}", status_code=303)
+
+@app.post("/daily-new/generate-schedule")
+async def generate_daily_new_schedule(request: Request, db: Session = Depends(get_db)):
+    """Sinh chuyến từ lịch chạy hàng tuần cho một tháng (YYYY-MM) hoặc một khoảng ngày"""
+    import calendar
     
-    # Tạo tên file
-    if from_date and to_date:
-        filename = f"chi_tiet_chuyen_{from_date}_den_{to_date}.csv"
+    form_data = await request.form()
+    selected_month = form_data.get("month")
+    if selected_month:
+        try:
+            year, month = selected_month.split('-')
+            year, month = int(year), int(month)
+            target_range = (date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1]))
+        except ValueError:
+            target_range = None
     else:
-        today = date.today()
-        filename = f"chi_tiet_chuyen_{today.month}_{today.year}.csv"
+        target_range = _parse_target_range(form_data.get("target_from"), form_data.get("target_to"))
     
-    # Trả về file CSV với encoding UTF-8
-    return Response(
-        content=csv_content.encode('utf-8-sig'),  # UTF-8 with BOM
-        media_type="text/csv; charset=utf-8",
-        headers={
-            "Content-Disposition": f"attachment; filename*=UTF-8''{filename}",
-            "Content-Type": "text/csv; charset=utf-8"
-        }
-    )
-
-
+    if not target_range:
+        return RedirectResponse(url="/daily-new", status_code=303)
+    
+    generated_count = generate_scheduled_daily_routes(db, *target_range)
+    db.commit()
+    
+    return RedirectResponse(url=f"/daily-new?selected_date={target_range[0].strftime('%Y-%m-%d')}&generated_count={generated_count}", status_code=303)
 
-# ===== FUEL MANAGEMENT ROUTES =====
+@app.post("/routes/{route_id}/schedule/add")
+async def add_route_schedule_template(route_id: int, request: Request, db: Session = Depends(get_db)):
+    """Thêm lịch chạy hàng tuần cho tuyến (một dòng cho mỗi thứ được chọn; thứ đã có lịch thì cập nhật dòng đó)"""
+    route = db.query(Route).filter(Route.id == route_id, Route.status == 1).first()
+    if not route:
+        return RedirectResponse(url="/routes", status_code=303)
+    
+    form_data = await request.form()
+    try:
+        weekdays = [int(weekday_str) for weekday_str in form_data.getlist("weekdays")]
+        distance_km = float(form_data.get("distance_km")) if form_data.get("distance_km") else None
+    except ValueError:
+        return RedirectResponse(url=f"/routes/edit/{route_id}?error={quote('Thứ chạy hoặc số km không hợp lệ')}", status_code=303)
+    
+    existing = {
+        template.weekday: template
+        for template in db.query(RouteScheduleTemplate).filter(
+            RouteScheduleTemplate.route_id == route_id, RouteScheduleTemplate.weekday.in_(weekdays)
+        )
+    }
+    for weekday in sorted(set(weekdays)):
+        if not 0 <= weekday <= 6:
+            continue
+        template = existing.get(weekday) or RouteScheduleTemplate(route_id=route_id, weekday=weekday)
+        template.driver_name = form_data.get("driver_name") or ""
+        template.license_plate = form_data.get("license_plate") or ""
+        template.distance_km = distance_km
+        template.notes = form_data.get("notes") or ""
+        template.is_active = 1
+        db.add(template)
+    
+    db.commit()
+    return RedirectResponse(url=f"/routes/edit/{route_id}", status_code=303)
 
-@app.get("/fuel", response_class=HTMLResponse)
-async def fuel_page(request: Request):
-    """Redirect đến trang báo cáo tổng hợp"""
-    from fastapi.responses import RedirectResponse
-    return RedirectResponse(url="/report", status_code=302)
+@app.post("/routes/schedule/delete/{template_id}")
+async def delete_route_schedule_template(template_id: int, db: Session = Depends(get_db)):
+    """Xóa một dòng lịch chạy hàng tuần"""
+    template = db.query(RouteScheduleTemplate).filter(RouteScheduleTemplate.id == template_id).first()
+    if not template:
+        return RedirectResponse(url="/routes", status_code=303)
+    
+    route_id = template.route_id
+    db.delete(template)
+    db.commit()
+    return RedirectResponse(url=f"/routes/edit/{route_id}", status_code=303)
 
-@app.get("/fuel-report", response_class=HTMLResponse)
-async def fuel_report_page(
-    request: Request, 
+@app.get("/salary/driver-details/{driver_name}")
+async def get_driver_details(
+    driver_name: str,
     db: Session = Depends(get_db),
     from_date: Optional[str] = None,
     to_date: Optional[str] = None
 ):
-    """Trang tổng hợp đổ dầu - báo cáo chi tiết"""
+    """Lấy chi tiết chuyến của một lái xe cụ thể"""
     # Xử lý khoảng thời gian
     if from_date and to_date:
         try:
             from_date_obj = datetime.strptime(from_date, "%Y-%m-%d").date()
             to_date_obj = datetime.strptime(to_date, "%Y-%m-%d").date()
-            fuel_records_query = db.query(FuelRecord).filter(
-                FuelRecord.date >= from_date_obj,
-                FuelRecord.date <= to_date_obj
+            daily_routes_query = db.query(DailyRoute).filter(
+                DailyRoute.driver_name == driver_name,
+                DailyRoute.date >= from_date_obj,
+                DailyRoute.date <= to_date_obj
             )
         except ValueError:
-            fuel_records_query = db.query(FuelRecord)
+            return {"error": "Invalid date format"}
     else:
         # Nếu không có khoảng thời gian, lấy tháng hiện tại
         today = date.today()
-        fuel_records_query = db.query(FuelRecord).filter(
-            FuelRecord.date >= date(today.year, today.month, 1),
-            FuelRecord.date < date(today.year, today.month + 1, 1) if today.month < 12 else date(today.year + 1, 1, 1)
+        daily_routes_query = db.query(DailyRoute).filter(
+            DailyRoute.driver_name == driver_name,
+            DailyRoute.date >= date(today.year, today.month, 1),
+            DailyRoute.date < date(today.year, today.month + 1, 1) if today.month < 12 else date(today.year + 1, 1, 1)
         )
     
-    fuel_records = fuel_records_query.order_by(FuelRecord.date.desc(), FuelRecord.license_plate).all()
-    
-    # Tính tổng số lít dầu đã đổ
-    total_liters_pumped = sum(record.liters_pumped for record in fuel_records)
-    
-    # Lấy danh sách xe để hiển thị trong dropdown
-    vehicles = db.query(Vehicle).filter(Vehicle.status == 1).all()
-    
-    # Tạo template data
-    template_data = {
-        "request": request,
-        "fuel_records": fuel_records,
-        "vehicles": vehicles,
-        "total_liters_pumped": total_liters_pumped,
-        "total_records": len(fuel_records)
-    }
+    # Lấy dữ liệu và join với Route để có thông tin tuyến
+    daily_routes = daily_routes_query.join(Route).order_by(DailyRoute.date.desc()).all()
     
-    if from_date:
-        template_data["from_date"] = from_date
-    if to_date:
-        template_data["to_date"] = to_date
+    # Format dữ liệu
+    trip_details = []
+    for trip in daily_routes:
+        trip_details.append({
+            'date': trip.date.strftime('%d/%m/%Y'),
+            'route_code': trip.route.route_code,
+            'route_name': trip.route.route_name,
+            'license_plate': trip.license_plate,
+            'distance_km': trip.distance_km,
+            'cargo_weight': trip.cargo_weight,
+            'notes': trip.notes or ''
+        })
     
-    return templates.TemplateResponse("fuel.html", template_data)
+    return {"trip_details": trip_details}
 
-@app.post("/fuel/add")
-async def add_fuel_record(
+@app.get("/salary/driver-details-page/{driver_name}", response_class=HTMLResponse)
+async def driver_details_page(
     request: Request,
-    db: Session = Depends(get_db)
+    driver_name: str,
+    db: Session = Depends(get_db),
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None
 ):
-    """Thêm bản ghi đổ dầu mới"""
-    form_data = await request.form()
-    
-    # Lấy dữ liệu từ form
-    date_str = form_data.get("date")
-    fuel_type = form_data.get("fuel_type", "Dầu DO 0,05S-II")
-    license_plate = form_data.get("license_plate")
-    fuel_price_per_liter = float(form_data.get("fuel_price_per_liter", 0))
-    liters_pumped = float(form_data.get("liters_pumped", 0))
-    notes = form_data.get("notes", "")
+    """Trang hiển thị chi tiết chuyến của một lái xe cụ thể"""
+    # Xử lý khoảng thời gian
+    if from_date and to_date:
+        try:
+            from_date_obj = datetime.strptime(from_date, "%Y-%m-%d").date()
+            to_date_obj = datetime.strptime(to_date, "%Y-%m-%d").date()
+            daily_routes_query = db.query(DailyRoute).filter(
+                DailyRoute.driver_name == driver_name,
+                DailyRoute.date >= from_date_obj,
+                DailyRoute.date <= to_date_obj
+            )
+            period_text = f"từ {from_date_obj.strftime('%d/%m/%Y')} đến {to_date_obj.strftime('%d/%m/%Y')}"
+        except ValueError:
+            return RedirectResponse(url="/salary", status_code=303)
+    else:
+        # Nếu không có khoảng thời gian, lấy tháng hiện tại
+        today = date.today()
+        daily_routes_query = db.query(DailyRoute).filter(
+            DailyRoute.driver_name == driver_name,
+            DailyRoute.date >= date(today.year, today.month, 1),
+            DailyRoute.date < date(today.year, today.month + 1, 1) if today.month < 12 else date(today.year + 1, 1, 1)
+        )
+        period_text = f"tháng {today.month}/{today.year}"
     
-    if not date_str or not license_plate:
-        return RedirectResponse(url="/fuel-report", status_code=303)
+    # Lấy dữ liệu và join với Route để có thông tin tuyến
+    daily_routes = daily_routes_query.join(Route).order_by(DailyRoute.date.desc()).all()
     
-    try:
-        fuel_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-    except ValueError:
-        fuel_date = date.today()
-    
-    # Tính toán số tiền dầu đã đổ = Đơn giá dầu × Số lít dầu đã đổ (làm tròn đến đồng)
-    cost_pumped = round(fuel_price_per_liter * liters_pumped)
+    # Tính thống kê
+    total_trips = len(daily_routes)
+    total_distance = sum(trip.distance_km for trip in daily_routes)
+    total_cargo = sum(trip.cargo_weight for trip in daily_routes)
+    routes_used = list(set(trip.route.route_code for trip in daily_routes))
     
-    # Tạo bản ghi mới
-    fuel_record = FuelRecord(
-        date=fuel_date,
-        fuel_type=fuel_type,
-        license_plate=license_plate,
-        fuel_price_per_liter=fuel_price_per_liter,
-        liters_pumped=liters_pumped,
-        cost_pumped=cost_pumped,
-        notes=notes
+    return templates.TemplateResponse("driver_details.html", {
+        "request": request,
+        "driver_name": driver_name,
+        "period_text": period_text,
+        "daily_routes": daily_routes,
+        "total_trips": total_trips,
+        "total_distance": total_distance,
+        "total_cargo": total_cargo,
+        "routes_used": routes_used,
+        "from_date": from_date,
+        "to_date": to_date
+    })
+
+
+
+# ===== TÌM KIẾM CHUỖI CON (FTS5 TRIGRAM) =====
+
+def daily_route_search_filter(column_name: str, term: str):
+    """Điều kiện DailyRoute.id chứa chuỗi con `term` ở cột driver_name/license_plate/route_code,
+    không phân biệt hoa thường và dấu. Từ 3 ký tự dùng index trigram, ngắn hơn thì quét bảng tìm kiếm."""
+    sync_search_indexes()
+    folded = fold_vietnamese(term.strip())
+    param = f"search_{column_name}"
+    if len(folded) >= 3:
+        condition = f"daily_route_search MATCH :{param}"
+        value = '{%s} : "%s"' % (column_name, folded.replace('"', '""'))
+    else:
+        condition = f"instr({column_name}, :{param}) > 0"
+        value = folded
+    return DailyRoute.id.in_(
+        text(f"SELECT rowid FROM daily_route_search WHERE {condition}").bindparams(**{param: value}).columns(rowid=Integer)
     )
-    
-    db.add(fuel_record)
-    db.commit()
-    
-    # Redirect với tham số thời gian nếu có
-    redirect_url = "/fuel-report"
-    from_date = form_data.get("from_date")
-    to_date = form_data.get("to_date")
-    if from_date and to_date:
-        redirect_url += f"?from_date={from_date}&to_date={to_date}"
-    
-    return RedirectResponse(url=redirect_url, status_code=303)
 
-@app.post("/fuel/delete/{fuel_record_id}")
-async def delete_fuel_record(
-    fuel_record_id: int,
-    request: Request,
-    db: Session = Depends(get_db)
-):
-    """Xóa bản ghi đổ dầu"""
-    fuel_record = db.query(FuelRecord).filter(FuelRecord.id == fuel_record_id).first()
-    if fuel_record:
-        db.delete(fuel_record)
-        db.commit()
-    
-    # Redirect về trang fuel
-    return RedirectResponse(url="/fuel-report", status_code=303)
+# ===== GỢI Ý NHẬP LIỆU (AUTOCOMPLETE) =====
 
-@app.get("/fuel/edit/{fuel_record_id}", response_class=HTMLResponse)
-async def edit_fuel_record_page(
-    request: Request,
-    fuel_record_id: int,
-    db: Session = Depends(get_db)
-):
-    """Trang sửa bản ghi đổ dầu"""
-    fuel_record = db.query(FuelRecord).filter(FuelRecord.id == fuel_record_id).first()
-    if not fuel_record:
-        return RedirectResponse(url="/fuel-report", status_code=303)
-    
-    vehicles = db.query(Vehicle).filter(Vehicle.status == 1).all()
-    
-    return templates.TemplateResponse("edit_fuel.html", {
+AUTOCOMPLETE_KINDS = ("driver", "plate")
+AUTOCOMPLETE_LIMIT = 20
+AUTOCOMPLETE_MAX_LIMIT = 200
+
+# Danh sách (khoá đã bỏ dấu, giá trị) sắp xếp theo khoá để tìm tiền tố bằng bisect; dựng lại khi mốc thay đổi
+# của nhân viên/xe trong data_versions khác mốc đã dựng (kể cả thay đổi từ process hoặc công cụ khác)
+AUTOCOMPLETE_SOURCE_SCOPES = ("table:employees", "table:vehicles")
+_autocomplete_index = {"version": None, "etag": None, "values": {}, "keys": {}}
+
+def _normalize_autocomplete_text(kind: str, value: str) -> str:
+    """Bỏ dấu, chữ thường; biển số bỏ luôn dấu gạch/chấm ("50H-452.44" -> "50h45244")"""
+    folded = fold_vietnamese(value or "")
+    if kind == "plate":
+        return "".join(re.findall(r"[0-9a-z]+", folded))
+    return " ".join(folded.split())
+
+def _autocomplete_keys(kind: str, value: str) -> set:
+    """Khoá bắt đầu từ mỗi từ/cụm số để gõ "giap" ra "Nguyễn Văn Giáp", gõ "452" ra "50H-452.44" """
+    folded = fold_vietnamese(value)
+    if kind == "plate":
+        segments = re.findall(r"[0-9a-z]+", folded)
+        return {"".join(segments[i:]) for i in range(len(segments))}
+    words = folded.split()
+    return {" ".join(words[i:]) for i in range(len(words))}
+
+def get_autocomplete_index(db: Session) -> dict:
+    versions = get_data_versions(db, AUTOCOMPLETE_SOURCE_SCOPES)
+    # Đọc mốc trước dữ liệu: thay đổi xảy ra trong lúc dựng sẽ làm mốc lệch và lần sau dựng lại
+    version = tuple(versions.get(scope, 0) for scope in AUTOCOMPLETE_SOURCE_SCOPES)
+    if _autocomplete_index["version"] != version:
+        values = {
+            "driver": [name for (name,) in db.query(Employee.name).filter(Employee.status == 1).order_by(Employee.name) if name],
+            "plate": [plate for (plate,) in db.query(Vehicle.license_plate).filter(Vehicle.status == 1).order_by(Vehicle.license_plate) if plate],
+        }
+        _autocomplete_index.update(
+            version=version,
+            values=values,
+            keys={kind: sorted((key, value) for value in kind_values for key in _autocomplete_keys(kind, value))
+                  for kind, kind_values in values.items()},
+            etag='"%s"' % hashlib.sha1(json.dumps(values, ensure_ascii=False).encode("utf-8")).hexdigest()[:16],
+        )
+    return _autocomplete_index
+
+def autocomplete(db: Session, kind: str, q: str, limit: int = AUTOCOMPLETE_LIMIT) -> list:
+    """Tối đa `limit` giá trị có một từ (hoặc cụm số biển) bắt đầu bằng q, không phân biệt dấu"""
+    index = get_autocomplete_index(db)
+    limit = max(1, min(limit, AUTOCOMPLETE_MAX_LIMIT))
+    query = _normalize_autocomplete_text(kind, q)
+    if not query:
+        return index["values"][kind][:limit]
+    
+    keys = index["keys"][kind]
+    results = []
+    position = bisect.bisect_left(keys, (query,))
+    while position < len(keys) and keys[position][0].startswith(query) and len(results) < limit:
+        value = keys[position][1]
+        if value not in results:
+            results.append(value)
+        position += 1
+    return results
+
+@app.get("/api/autocomplete")
+async def autocomplete_api(request: Request, db: Session = Depends(get_db), kind: str = "driver", q: str = "", limit: int = AUTOCOMPLETE_LIMIT):
+    """Gợi ý tên lái xe (kind=driver) hoặc biển số (kind=plate); trả 304 nếu danh sách chưa đổi (ETag)"""
+    if kind not in AUTOCOMPLETE_KINDS:
+        return JSONResponse({"success": False, "message": f"kind phải là một trong: {', '.join(AUTOCOMPLETE_KINDS)}"}, status_code=400)
+    index = get_autocomplete_index(db)
+    headers = {"ETag": index["etag"], "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == index["etag"]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse({"success": True, "kind": kind, "items": autocomplete(db, kind, q, limit)}, headers=headers)
+
+# ===== TÌM KIẾM TOÀN HỆ THỐNG =====
+
+SEARCH_TYPE_LABELS = {
+    "employee": "👤 Nhân viên",
+    "vehicle": "🚚 Xe",
+    "route": "🛣️ Tuyến",
+    "trip": "📝 Chuyến",
+    "fuel": "⛽ Đổ dầu",
+    "finance": "💰 Thu chi",
+}
+SEARCH_RESULT_LIMIT = 50
+
+def search_everything(db: Session, q: str, entity_type: Optional[str] = None, limit: int = SEARCH_RESULT_LIMIT) -> list:
+    """Tìm trong search_index (không phân biệt dấu, khớp tiền tố từng từ), xếp hạng bm25 - tiêu đề nặng hơn nội dung"""
+    tokens = re.findall(r"\w+", fold_vietnamese(q or ""))
+    if not tokens:
+        return []
+    sync_search_indexes()
+    params = {
+        "match": " ".join(f'"{token}"*' for token in tokens),
+        "limit": max(1, min(limit, SEARCH_RESULT_LIMIT)),
+    }
+    type_filter = ""
+    if entity_type in SEARCH_SOURCES:
+        type_filter = "AND rowid % 8 = :code"
+        params["code"] = SEARCH_SOURCES[entity_type]["code"]
+    rows = db.execute(text(f"""
+        SELECT rowid, label, detail, url, bm25(search_index, 10.0, 1.0) AS score
+        FROM search_index
+        WHERE search_index MATCH :match {type_filter}
+        ORDER BY score
+        LIMIT :limit
+    """), params).all()
+    
+    types_by_code = {source["code"]: name for name, source in SEARCH_SOURCES.items()}
+    return [{
+        "type": types_by_code[rowid % 8],
+        "type_label": SEARCH_TYPE_LABELS[types_by_code[rowid % 8]],
+        "id": rowid // 8,
+        "label": label or "",
+        "detail": detail or "",
+        "url": url,
+        "score": round(-score, 3),
+    } for rowid, label, detail, url, score in rows]
+
+@app.get("/search", response_class=HTMLResponse)
+async def search_page(request: Request, db: Session = Depends(get_db), q: str = "", type: Optional[str] = None):
+    """Tìm kiếm nhân viên, xe, tuyến, ghi chú chuyến/đổ dầu và diễn giải thu chi"""
+    return templates.TemplateResponse("search.html", {
         "request": request,
-        "fuel_record": fuel_record,
-        "vehicles": vehicles
+        "q": q,
+        "selected_type": type if type in SEARCH_SOURCES else "",
+        "type_labels": SEARCH_TYPE_LABELS,
+        "results": search_everything(db, q, type),
+        "result_limit": SEARCH_RESULT_LIMIT,
     })
 
-@app.post("/fuel/edit/{fuel_record_id}")
-async def edit_fuel_record(
-    fuel_record_id: int,
-    request: Request,
-    db: Session = Depends(get_db)
-):
-    """Cập nhật bản ghi đổ dầu"""
-    fuel_record = db.query(FuelRecord).filter(FuelRecord.id == fuel_record_id).first()
-    if not fuel_record:
-        return RedirectResponse(url="/fuel-report", status_code=303)
-    
-    form_data = await request.form()
+@app.get("/api/search")
+async def search_api(db: Session = Depends(get_db), q: str = "", type: Optional[str] = None, limit: int = SEARCH_RESULT_LIMIT):
+    return {"success": True, "q": q, "results": search_everything(db, q, type, limit)}
+
+# ===== PHÂN TRANG KEYSET =====
+
+REPORT_PAGE_SIZE = 100
+REPORT_MAX_PAGE_SIZE = 500
+
+def encode_page_cursor(row) -> str:
+    """Con trỏ trang dạng "YYYY-MM-DD.id" của bản ghi đầu/cuối trang"""
+    return f"{row.date.strftime('%Y-%m-%d')}.{row.id}"
+
+def decode_page_cursor(cursor: Optional[str]):
+    """(date, id) từ con trỏ, None nếu không có hoặc không hợp lệ (coi như trang đầu)"""
+    if not cursor:
+        return None
+    try:
+        day, row_id = cursor.split(".")
+        return datetime.strptime(day, "%Y-%m-%d").date(), int(row_id)
+    except ValueError:
+        return None
+
+def keyset_page(query, model, after: Optional[str] = None, before: Optional[str] = None,
+                limit: int = REPORT_PAGE_SIZE, descending: bool = False) -> dict:
+    """Một trang theo thứ tự (date, id): lọc theo con trỏ trên index (date, id) thay vì OFFSET,
+    nên trang thứ 500 tốn như trang đầu. `before` để lùi về trang trước."""
+    limit = max(1, min(limit, REPORT_MAX_PAGE_SIZE))
+    key = tuple_(model.date, model.id)
+    after_key = decode_page_cursor(after)
+    before_key = decode_page_cursor(before)
+    backward = before_key is not None
+    
+    if backward:
+        query = query.filter(key > before_key if descending else key < before_key)
+    elif after_key:
+        query = query.filter(key < after_key if descending else key > after_key)
+    # Lùi trang: quét ngược chiều rồi đảo lại kết quả
+    if descending != backward:
+        query = query.order_by(model.date.desc(), model.id.desc())
+    else:
+        query = query.order_by(model.date, model.id)
+    
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    has_next = True if backward else has_more
+    has_prev = has_more if backward else after_key is not None
+    return {
+        "items": rows,
+        "limit": limit,
+        "next_cursor": encode_page_cursor(rows[-1]) if rows and has_next else None,
+        "prev_cursor": encode_page_cursor(rows[0]) if rows and has_prev else None,
+    }
+
+def build_page_links(request: Request, page: dict, start: int = 1) -> dict:
+    """Link trang trước/sau giữ nguyên các bộ lọc; `start` là số thứ tự dòng đầu trang (chỉ để hiển thị STT)"""
+    def page_url(**params):
+        query = {name: value for name, value in request.query_params.items() if name not in ("after", "before", "start")}
+        query.update(params)
+        return f"{request.url.path}?{urlencode(query)}"
+    
+    start = max(1, start)
+    count = len(page["items"])
+    return {
+        "start": start,
+        "end": start + count - 1,
+        "next_url": page_url(after=page["next_cursor"], start=start + count) if page["next_cursor"] else None,
+        "prev_url": page_url(before=page["prev_cursor"], start=max(1, start - page["limit"])) if page["prev_cursor"] else None,
+        "first_url": page_url() if page["prev_cursor"] else None,
+    }
+
+@app.get("/salary-simple", response_class=HTMLResponse)
+async def salary_simple_page(request: Request):
+    """Redirect đến trang báo cáo tổng hợp"""
+    from fastapi.responses import RedirectResponse
+    return RedirectResponse(url="/report", status_code=302)
+
+def _general_report_query(db: Session, from_date: Optional[str], to_date: Optional[str],
+                          driver_name: Optional[str], license_plate: Optional[str], route_code: Optional[str]):
+    """Query chuyến theo bộ lọc của trang thống kê tổng hợp"""
+    daily_routes_query = db.query(DailyRoute).outerjoin(Route)
     
-    # Cập nhật dữ liệu
-    date_str = form_data.get("date")
-    if date_str:
+    # Áp dụng bộ lọc thời gian
+    if from_date and to_date:
         try:
-            fuel_record.date = datetime.strptime(date_str, "%Y-%m-%d").date()
+            from_date_obj = datetime.strptime(from_date, "%Y-%m-%d").date()
+            to_date_obj = datetime.strptime(to_date, "%Y-%m-%d").date()
+            daily_routes_query = daily_routes_query.filter(
+                DailyRoute.date >= from_date_obj,
+                DailyRoute.date <= to_date_obj
+            )
         except ValueError:
             pass
     
-    fuel_record.fuel_type = form_data.get("fuel_type", "Dầu DO 0,05S-II")
-    fuel_record.license_plate = form_data.get("license_plate")
-    fuel_record.fuel_price_per_liter = float(form_data.get("fuel_price_per_liter", 0))
-    fuel_record.liters_pumped = float(form_data.get("liters_pumped", 0))
-    fuel_record.notes = form_data.get("notes", "")
-    
-    # Tính toán lại số tiền dầu đã đổ = Đơn giá dầu × Số lít dầu đã đổ (làm tròn đến đồng)
-    fuel_record.cost_pumped = round(fuel_record.fuel_price_per_liter * fuel_record.liters_pumped)
-    
-    db.commit()
-    return RedirectResponse(url="/fuel-report", status_code=303)
+    # Áp dụng các bộ lọc khác
+    if driver_name:
+        daily_routes_query = daily_routes_query.filter(daily_route_search_filter("driver_name", driver_name))
+    if license_plate:
+        daily_routes_query = daily_routes_query.filter(daily_route_search_filter("license_plate", license_plate))
+    if route_code:
+        daily_routes_query = daily_routes_query.filter(daily_route_search_filter("route_code", route_code))
+    return daily_routes_query
 
-@app.get("/fuel/download-template")
-async def download_fuel_template(db: Session = Depends(get_db)):
-    """Tải mẫu Excel để import dữ liệu đổ dầu"""
-    # Lấy danh sách xe để hiển thị trong mẫu
-    vehicles = db.query(Vehicle).filter(Vehicle.status == 1).all()
-    vehicle_list = [v.license_plate for v in vehicles]
+def _general_report_totals(daily_routes_query) -> dict:
+    """Tổng toàn bộ khoảng lọc bằng truy vấn gộp (không phụ thuộc trang đang xem)"""
+    total_routes, total_distance, total_cargo = daily_routes_query.with_entities(
+        func.count(DailyRoute.id),
+        func.coalesce(func.sum(DailyRoute.distance_km), 0),
+        func.coalesce(func.sum(DailyRoute.cargo_weight), 0)
+    ).one()
+    
+    # Thống kê theo lái xe
+    driver_rows = daily_routes_query.filter(
+        DailyRoute.driver_name.isnot(None), DailyRoute.driver_name != ""
+    ).with_entities(
+        DailyRoute.driver_name,
+        func.max(DailyRoute.license_plate),
+        func.count(DailyRoute.id),
+        func.coalesce(func.sum(DailyRoute.distance_km), 0),
+        func.coalesce(func.sum(DailyRoute.cargo_weight), 0),
+        func.group_concat(Route.route_code.distinct())
+    ).group_by(DailyRoute.driver_name).all()
+    
+    salary_data = [{
+        'driver_name': driver,
+        'license_plate': plate or 'N/A',
+        'trip_count': trip_count,
+        'total_distance': distance,
+        'total_cargo': cargo,
+        'routes': route_codes.split(",") if route_codes else []
+    } for driver, plate, trip_count, distance, cargo, route_codes in driver_rows]
+    salary_data.sort(key=lambda x: x['trip_count'], reverse=True)
     
-    # Tạo workbook Excel
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Mẫu Import Đổ Dầu"
+    return {
+        "salary_data": salary_data,
+        "total_routes": total_routes,
+        "total_distance": total_distance,
+        "total_cargo": total_cargo,
+        "total_trip_details": sum(item['trip_count'] for item in salary_data),
+    }
+
+def _general_report_page(daily_routes_query, after: Optional[str], before: Optional[str], limit: int) -> dict:
+    """Một trang chi tiết chuyến (chỉ chuyến có lái xe) theo thứ tự ngày"""
+    page = keyset_page(
+        daily_routes_query.filter(DailyRoute.driver_name.isnot(None), DailyRoute.driver_name != ""),
+        DailyRoute, after, before, limit
+    )
+    page["trip_details"] = [{
+        'id': daily_route.id,
+        'driver_name': daily_route.driver_name,
+        'license_plate': daily_route.license_plate or 'N/A',
+        'date': daily_route.date,
+        'route_code': daily_route.route.route_code if daily_route.route else '',
+        'route_name': daily_route.route.route_name if daily_route.route else '',
+        'distance_km': daily_route.distance_km,
+        'cargo_weight': daily_route.cargo_weight,
+        'notes': daily_route.notes or ''
+    } for daily_route in page["items"]]
+    return page
+
+@app.get("/general-report", response_class=HTMLResponse)
+async def general_report_page(
+    request: Request, 
+    db: Session = Depends(get_db),
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    driver_name: Optional[str] = None,
+    license_plate: Optional[str] = None,
+    route_code: Optional[str] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    start: int = 1,
+    limit: int = REPORT_PAGE_SIZE
+):
+    """Trang thống kê tổng hợp - báo cáo chi tiết hoạt động vận chuyển"""
+    daily_routes_query = _general_report_query(db, from_date, to_date, driver_name, license_plate, route_code)
+    totals = _general_report_totals(daily_routes_query)
+    page = _general_report_page(daily_routes_query, after, before, limit)
     
-    # Định dạng header
-    header_font = Font(bold=True, color="FFFFFF")
-    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-    header_alignment = Alignment(horizontal="center", vertical="center")
+    # Lấy danh sách cho dropdown
+    routes = db.query(Route).all()
+    employees = db.query(Employee).all()
+    vehicles = db.query(Vehicle).all()
     
-    # Tiêu đề
-    ws.merge_cells('A1:F1')
-    ws['A1'] = "MẪU IMPORT DỮ LIỆU ĐỔ DẦU"
-    ws['A1'].font = Font(bold=True, size=16)
-    ws['A1'].alignment = Alignment(horizontal="center")
+    # Template data - CHỈ TRUYỀN KHI CÓ GIÁ TRỊ
+    template_data = {
+        "request": request,
+        "trip_details": page["trip_details"],
+        "pagination": build_page_links(request, page, start),
+        "employees": employees,
+        "vehicles": vehicles,
+        "routes": routes,
+        **totals
+    }
     
-    # Hướng dẫn
-    ws.merge_cells('A2:F2')
-    ws['A2'] = "Vui lòng điền dữ liệu theo đúng định dạng bên dưới"
-    ws['A2'].alignment = Alignment(horizontal="center")
-    ws['A2'].font = Font(italic=True)
+    # Chỉ thêm khi có giá trị
+    if from_date:
+        template_data["from_date"] = from_date
+    if to_date:
+        template_data["to_date"] = to_date
+    if driver_name:
+        template_data["driver_name"] = driver_name
+    if license_plate:
+        template_data["license_plate"] = license_plate
+    if route_code:
+        template_data["route_code"] = route_code
     
-    # Header bảng
-    headers = [
-        "STT", "Ngày đổ dầu (dd/mm/yyyy)", "Biển số xe", 
-        "Số lượng dầu đổ (lít)", "Đơn giá (đồng/lít)", "Thành tiền (đồng)"
-    ]
+    return templates.TemplateResponse("salary_simple.html", template_data)
+
+@app.get("/api/general-report")
+async def general_report_api(
+    db: Session = Depends(get_db),
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    driver_name: Optional[str] = None,
+    license_plate: Optional[str] = None,
+    route_code: Optional[str] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    limit: int = REPORT_PAGE_SIZE
+):
+    """Chi tiết chuyến theo trang (con trỏ after/before) kèm tổng của toàn bộ khoảng lọc"""
+    daily_routes_query = _general_report_query(db, from_date, to_date, driver_name, license_plate, route_code)
+    page = _general_report_page(daily_routes_query, after, before, limit)
+    return {
+        "success": True,
+        "items": [dict(trip, date=trip['date'].strftime("%Y-%m-%d")) for trip in page["trip_details"]],
+        "next_cursor": page["next_cursor"],
+        "prev_cursor": page["prev_cursor"],
+        "totals": _general_report_totals(daily_routes_query),
+    }
+
+@app.get("/salary-simple/export-excel")
+async def export_salary_simple_excel(
+    db: Session = Depends(get_db),
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    driver_name: Optional[str] = None,
+    license_plate: Optional[str] = None,
+    route_code: Optional[str] = None
+):
+    """Redirect đến general-report export"""
+    from fastapi.responses import RedirectResponse
+    params = []
+    if from_date:
+        params.append(f"from_date={from_date}")
+    if to_date:
+        params.append(f"to_date={to_date}")
+    if driver_name:
+        params.append(f"driver_name={driver_name}")
+    if license_plate:
+        params.append(f"license_plate={license_plate}")
+    if route_code:
+        params.append(f"route_code={route_code}")
     
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=4, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = header_alignment
+    url = "/general-report/export-excel"
+    if params:
+        url += "?" + "&".join(params)
     
-    # Dữ liệu mẫu
-    sample_data = [
-        [1, "01/01/2025", "51A-12345", 50.000, 19020, 951000],
-        [2, "02/01/2025", "51B-67890", 45.500, 19020, 865410],
-        [3, "03/01/2025", "51C-11111", 60.000, 19020, 1141200]
-    ]
-    
-    for row, data in enumerate(sample_data, 5):
-        for col, value in enumerate(data, 1):
-            ws.cell(row=row, column=col, value=value)
-    
-    # Định dạng số
-    for row in range(5, 8):
-        # Số lượng dầu - 3 chữ số thập phân
-        ws.cell(row=row, column=4).number_format = '#,##0.000'
-        # Đơn giá - 2 chữ số thập phân
-        ws.cell(row=row, column=5).number_format = '#,##0.00'
-        # Thành tiền - không có chữ số thập phân
-        ws.cell(row=row, column=6).number_format = '#,##0'
-    
-    # Thêm sheet hướng dẫn
-    ws2 = wb.create_sheet("Hướng dẫn")
-    ws2['A1'] = "HƯỚNG DẪN SỬ DỤNG"
-    ws2['A1'].font = Font(bold=True, size=14)
-    
-    instructions = [
-        "1. Định dạng cột:",
-        "   - STT: Số thứ tự (tự động)",
-        "   - Ngày đổ dầu: Định dạng dd/mm/yyyy (ví dụ: 01/01/2025)",
-        "   - Biển số xe: Phải khớp với danh sách xe trong hệ thống",
-        "   - Số lượng dầu đổ: Cho phép 3 chữ số thập phân (ví dụ: 50.000)",
-        "   - Đơn giá: Số chính xác (ví dụ: 19020)",
-        "   - Thành tiền: Có thể để trống, hệ thống sẽ tự tính",
-        "",
-        "2. Danh sách biển số xe hợp lệ:",
-    ]
-    
-    for i, instruction in enumerate(instructions, 2):
-        ws2.cell(row=i, column=1, value=instruction)
+    return RedirectResponse(url=url, status_code=302)
+
+@app.get("/general-report/export-excel")
+async def export_general_report_excel(
+    db: Session = Depends(get_db),
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    driver_name: Optional[str] = None,
+    license_plate: Optional[str] = None,
+    route_code: Optional[str] = None
+):
+    """Xuất Excel danh sách chi tiết từng chuyến cho general-report"""
+    # Sử dụng lại logic lọc của trang thống kê tổng hợp
+    daily_routes_query = _general_report_query(db, from_date, to_date, driver_name, license_plate, route_code).order_by(DailyRoute.date, DailyRoute.id)
     
-    # Thêm danh sách xe
-    for i, vehicle in enumerate(vehicle_list, len(instructions) + 2):
-        ws2.cell(row=i, column=1, value=f"   - {vehicle}")
+    daily_routes = daily_routes_query.all()
     
-    # Điều chỉnh độ rộng cột
-    column_widths = [8, 20, 15, 20, 20, 18]
-    for col, width in enumerate(column_widths, 1):
-        ws.column_dimensions[get_column_letter(col)].width = width
+    # Tạo dữ liệu chi tiết từng chuyến
+    trip_details = []
+    for daily_route in daily_routes:
+        if daily_route.driver_name:
+            trip_details.append({
+                'stt': len(trip_details) + 1,
+                'ngay_chay': daily_route.date.strftime('%d/%m/%Y'),
+                'ten_lai_xe': daily_route.driver_name,
+                'bien_so_xe': daily_route.license_plate or 'N/A',
+                'ma_tuyen': daily_route.route.route_code,
+                'ten_tuyen': daily_route.route.route_name,
+                'km': daily_route.distance_km,
+                'tai_trong': daily_route.cargo_weight,
+                'ghi_chu': daily_route.notes or ''
+            })
     
-    ws2.column_dimensions['A'].width = 50
+    # Tạo CSV content với UTF-8 BOM để Excel hiển thị đúng tiếng Việt
+    csv_content = "\ufeff"  # UTF-8 BOM
+    csv_content += "STT,Ngày chạy,Tên lái xe,Biển số xe,Mã tuyến,Tên tuyến,Km,Tải trọng,Ghi chú\n"
     
-    # Lưu vào memory
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
+    for trip in trip_details:
+        # Escape các ký tự đặc biệt trong CSV
+        def escape_csv_field(field):
+            if field is None:
+                return ""
+            field_str = str(field)
+            # Nếu chứa dấu phẩy, dấu ngoặc kép hoặc xuống dòng thì bọc trong dấu ngoặc kép
+            if ',' in field_str or '"' in field_str or '\n' in field_str:
+                field_str = field_str.replace('"', '""')  # Escape dấu ngoặc kép
+                field_str = f'"{field_str}"'
+            return field_str
+        
+        csv_content += f"{trip['stt']},{escape_csv_field(trip['ngay_chay'])},{escape_csv_field(trip['ten_lai_xe'])},{escape_csv_field(trip['bien_so_xe'])},{escape_csv_field(trip['ma_tuyen'])},{escape_csv_field(trip['ten_tuyen'])},{trip['km']},{trip['tai_trong']},{escape_csv_field(trip['ghi_chu'])}\n"
     
     # Tạo tên file
-    today = date.today()
-    filename = f"Mau_Import_DoDau_{today.strftime('%Y%m%d')}.xlsx"
+    if from_date and to_date:
+        filename = f"chi_tiet_chuyen_{from_date}_den_{to_date}.csv"
+    else:
+        today = date.today()
+        filename = f"chi_tiet_chuyen_{today.month}_{today.year}.csv"
     
+    # Trả về file CSV với encoding UTF-8
     return Response(
-        content=output.getvalue(),
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
+        content=csv_content.encode('utf-8-sig'),  # UTF-8 with BOM
+        media_type="text/csv; charset=utf-8",
+        headers={
+            "Content-Disposition": f"attachment; filename*=UTF-8''{filename}",
+            "Content-Type": "text/csv; charset=utf-8"
+        }
     )
 
-@app.post("/fuel/import-excel")
-async def import_fuel_excel(
-    file: UploadFile = File(...),
+
+
+# ===== BẢNG GIÁ NHIÊN LIỆU =====
+
+DEFAULT_FUEL_TYPE = "Dầu DO 0,05S-II"
+FUEL_PRICE_TOLERANCE_PCT = 2  # Giá nhập lệch quá % này so với giá tham chiếu thì cảnh báo
+
+# Chỉ mục giá theo loại dầu: fuel_type -> (mảng ngày hiệu lực dạng ordinal đã sắp xếp, mảng giá).
+# None = cần dựng lại (khi bảng giá thay đổi)
+# Chỉ mục kèm mốc thay đổi của fuel_prices trong data_versions lúc dựng; mốc khác (kể cả do process khác ghi) -> dựng lại
+_fuel_price_index = {"version": None, "index": None}
+
+def get_fuel_price_index(db: Session) -> dict:
+    """Dựng chỉ mục giá từ bảng fuel_prices bằng một truy vấn, giữ trong bộ nhớ đến khi bảng giá đổi"""
+    version = get_data_versions(db, ["table:fuel_prices"]).get("table:fuel_prices", 0)
+    if _fuel_price_index["version"] != version:
+        grouped = {}
+        for fuel_type, effective_from, price in db.query(
+            FuelPrice.fuel_type, FuelPrice.effective_from, FuelPrice.price
+        ).order_by(FuelPrice.fuel_type, FuelPrice.effective_from).all():
+            days, prices = grouped.setdefault(fuel_type, ([], []))
+            days.append(effective_from.toordinal())
+            prices.append(price)
+        _fuel_price_index["index"] = {
+            fuel_type: (np.array(days, dtype=np.int64), np.array(prices, dtype=float))
+            for fuel_type, (days, prices) in grouped.items()
+        }
+        _fuel_price_index["version"] = version
+    return _fuel_price_index["index"]
+
+def lookup_fuel_price(db: Session, fuel_type: str, on_date: date) -> Optional[float]:
+    """Giá tham chiếu có hiệu lực tại ngày (bisect trên mảng ngày hiệu lực), None nếu chưa có"""
+    days, prices = get_fuel_price_index(db).get(fuel_type or DEFAULT_FUEL_TYPE, (None, None))
+    if days is None:
+        return None
+    position = bisect.bisect_right(days, on_date.toordinal()) - 1
+    return float(prices[position]) if position >= 0 else None
+
+def lookup_fuel_prices(db: Session, fuel_types: list, dates: list):
+    """Tra giá cho nhiều dòng cùng lúc (np.searchsorted theo từng loại dầu), NaN nếu chưa có giá"""
+    index = get_fuel_price_index(db)
+    fuel_types = np.array([fuel_type or DEFAULT_FUEL_TYPE for fuel_type in fuel_types], dtype=object)
+    ordinals = np.array([d.toordinal() for d in dates], dtype=np.int64)
+    result = np.full(len(ordinals), np.nan)
+    for fuel_type in set(fuel_types):
+        if fuel_type not in index:
+            continue
+        days, prices = index[fuel_type]
+        rows = np.flatnonzero(fuel_types == fuel_type)
+        positions = np.searchsorted(days, ordinals[rows], side="right") - 1
+        found = positions >= 0
+        result[rows[found]] = prices[positions[found]]
+    return result
+
+def missing_fuel_price_message(fuel_type: str, on_date: date) -> str:
+    return f"Chưa nhập đơn giá và bảng giá chưa có giá {fuel_type} áp dụng cho ngày {on_date.strftime('%d/%m/%Y')} - phiếu đổ dầu chưa được lưu"
+
+def check_fuel_price(entered_price: float, reference_price: Optional[float]) -> Optional[str]:
+    """Cảnh báo khi giá nhập lệch giá tham chiếu quá FUEL_PRICE_TOLERANCE_PCT"""
+    if not reference_price or not entered_price:
+        return None
+    deviation_pct = (entered_price - reference_price) / reference_price * 100
+    if abs(deviation_pct) > FUEL_PRICE_TOLERANCE_PCT:
+        return f"Giá {entered_price:,.0f} đ/L lệch {deviation_pct:+.1f}% so với giá tham chiếu {reference_price:,.0f} đ/L"
+    return None
+
+@app.get("/fuel-prices", response_class=HTMLResponse)
+async def fuel_prices_page(request: Request, db: Session = Depends(get_db), error: Optional[str] = None):
+    """Trang bảng giá nhiên liệu theo ngày hiệu lực"""
+    fuel_prices = db.query(FuelPrice).order_by(FuelPrice.fuel_type, FuelPrice.effective_from.desc()).all()
+    return templates.TemplateResponse("fuel_prices.html", {
+        "request": request,
+        "fuel_prices": fuel_prices,
+        "default_fuel_type": DEFAULT_FUEL_TYPE,
+        "today": date.today().strftime('%Y-%m-%d'),
+        "error": error
+    })
+
+@app.post("/fuel-prices/add")
+async def add_fuel_price(
+    fuel_type: str = Form(DEFAULT_FUEL_TYPE),
+    effective_from: str = Form(...),
+    price: float = Form(...),
+    notes: str = Form(""),
     db: Session = Depends(get_db)
 ):
-    """Import dữ liệu đổ dầu từ file Excel"""
+    """Thêm hoặc cập nhật giá áp dụng từ một ngày"""
     try:
-        # Kiểm tra định dạng file
-        if not file.filename.lower().endswith(('.xlsx', '.xls')):
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "success": False, 
-                    "error": "Định dạng file không hợp lệ",
-                    "error_type": "file_format",
-                    "details": "Chỉ chấp nhận file Excel (.xlsx hoặc .xls)",
-                    "suggestion": "Vui lòng chọn file Excel có định dạng .xlsx hoặc .xls"
-                }
-            )
-        
-        # Đọc file Excel
-        content = await file.read()
-        if len(content) == 0:
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "success": False,
-                    "error": "File rỗng",
-                    "error_type": "empty_file",
-                    "details": "File Excel không chứa dữ liệu",
-                    "suggestion": "Vui lòng kiểm tra lại file Excel có chứa dữ liệu"
-                }
-            )
-        
+        effective_date = datetime.strptime(effective_from, "%Y-%m-%d").date()
+    except ValueError:
+        return RedirectResponse(url=f"/fuel-prices?error={quote('Ngày hiệu lực không hợp lệ')}", status_code=303)
+    if price <= 0:
+        return RedirectResponse(url=f"/fuel-prices?error={quote('Giá phải lớn hơn 0')}", status_code=303)
+    
+    fuel_type = fuel_type.strip() or DEFAULT_FUEL_TYPE
+    fuel_price = db.query(FuelPrice).filter(
+        FuelPrice.fuel_type == fuel_type,
+        FuelPrice.effective_from == effective_date
+    ).first()
+    if not fuel_price:
+        fuel_price = FuelPrice(fuel_type=fuel_type, effective_from=effective_date)
+        db.add(fuel_price)
+    fuel_price.price = price
+    fuel_price.notes = notes
+    db.commit()
+    return RedirectResponse(url="/fuel-prices", status_code=303)
+
+@app.post("/fuel-prices/delete/{fuel_price_id}")
+async def delete_fuel_price(fuel_price_id: int, db: Session = Depends(get_db)):
+    fuel_price = db.query(FuelPrice).filter(FuelPrice.id == fuel_price_id).first()
+    if fuel_price:
+        db.delete(fuel_price)
+        db.commit()
+    return RedirectResponse(url="/fuel-prices", status_code=303)
+
+@app.get("/api/fuel-prices/lookup")
+async def lookup_fuel_price_api(
+    fuel_date: str,
+    fuel_type: str = DEFAULT_FUEL_TYPE,
+    db: Session = Depends(get_db)
+):
+    """Giá tham chiếu có hiệu lực tại ngày (dùng để tự điền giá trong form đổ dầu)"""
+    try:
+        on_date = datetime.strptime(fuel_date, "%Y-%m-%d").date()
+    except ValueError:
+        return JSONResponse({"success": False, "message": "Ngày không hợp lệ"}, status_code=400)
+    price = lookup_fuel_price(db, fuel_type, on_date)
+    return JSONResponse({"success": True, "fuel_type": fuel_type, "fuel_date": fuel_date, "price": price})
+
+# ===== FUEL MANAGEMENT ROUTES =====
+
+@app.get("/fuel", response_class=HTMLResponse)
+async def fuel_page(request: Request):
+    """Redirect đến trang báo cáo tổng hợp"""
+    from fastapi.responses import RedirectResponse
+    return RedirectResponse(url="/report", status_code=302)
+
+def _fuel_report_query(db: Session, from_date: Optional[str], to_date: Optional[str]):
+    """Query phiếu đổ dầu trong khoảng ngày (mặc định tháng hiện tại)"""
+    if from_date and to_date:
         try:
-            wb = load_workbook(io.BytesIO(content))
-            ws = wb.active
-        except Exception as e:
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "success": False,
-                    "error": "Không thể đọc file Excel",
-                    "error_type": "file_corrupted",
-                    "details": f"Lỗi kỹ thuật: {str(e)}",
-                    "suggestion": "Vui lòng kiểm tra file Excel không bị hỏng và có định dạng đúng"
-                }
+            from_date_obj = datetime.strptime(from_date, "%Y-%m-%d").date()
+            to_date_obj = datetime.strptime(to_date, "%Y-%m-%d").date()
+            return db.query(FuelRecord).filter(
+                FuelRecord.date >= from_date_obj,
+                FuelRecord.date <= to_date_obj
             )
-        
-        # Lấy danh sách xe hợp lệ
-        vehicles = db.query(Vehicle).filter(Vehicle.status == 1).all()
-        valid_license_plates = {v.license_plate for v in vehicles}
-        
-        imported_count = 0
-        skipped_count = 0
-        errors = []
-        
-        # Bỏ qua header (dòng 1-4)
-        for row_num in range(5, ws.max_row + 1):
-            try:
-                # Đọc dữ liệu từ Excel
-                stt = ws.cell(row=row_num, column=1).value
-                date_str = ws.cell(row=row_num, column=2).value
-                license_plate = ws.cell(row=row_num, column=3).value
-                liters_pumped = ws.cell(row=row_num, column=4).value
-                fuel_price_per_liter = ws.cell(row=row_num, column=5).value
-                cost_pumped = ws.cell(row=row_num, column=6).value
-                
-                # Bỏ qua dòng trống
-                if not date_str or not license_plate:
-                    continue
-                
-                # Validation dữ liệu với thông báo chi tiết
-                validation_errors = []
-                
-                # Kiểm tra ngày (cột B)
-                if isinstance(date_str, str):
-                    try:
-                        fuel_date = datetime.strptime(date_str, "%d/%m/%Y").date()
-                    except ValueError:
-                        validation_errors.append({
-                            "column": "B (Ngày đổ)",
-                            "error": "Định dạng ngày không đúng",
-                            "value": str(date_str),
-                            "suggestion": "Định dạng đúng: dd/mm/yyyy (ví dụ: 25/09/2025)"
-                        })
-                elif isinstance(date_str, datetime):
-                    fuel_date = date_str.date()
-                else:
-                    validation_errors.append({
-                        "column": "B (Ngày đổ)",
-                        "error": "Ngày không hợp lệ",
-                        "value": str(date_str),
-                        "suggestion": "Vui lòng nhập ngày theo định dạng dd/mm/yyyy"
-                    })
-                
-                # Kiểm tra biển số xe (cột C)
-                if not license_plate:
-                    validation_errors.append({
-                        "column": "C (Biển số xe)",
-                        "error": "Biển số xe không được để trống",
-                        "value": "",
-                        "suggestion": "Vui lòng nhập biển số xe"
-                    })
-                elif str(license_plate).strip() not in valid_license_plates:
-                    validation_errors.append({
-                        "column": "C (Biển số xe)",
-                        "error": "Biển số xe không tồn tại trong hệ thống",
-                        "value": str(license_plate),
-                        "suggestion": f"Biển số xe hợp lệ: {', '.join(list(valid_license_plates)[:5])}{'...' if len(valid_license_plates) > 5 else ''}"
-                    })
-                
+        except ValueError:
+            return db.query(FuelRecord)
+    # Nếu không có khoảng thời gian, lấy tháng hiện tại
+    today = date.today()
+    return db.query(FuelRecord).filter(
+        FuelRecord.date >= date(today.year, today.month, 1),
+        FuelRecord.date < date(today.year, today.month + 1, 1) if today.month < 12 else date(today.year + 1, 1, 1)
+    )
+
+def _fuel_report_totals(fuel_records_query) -> dict:
+    total_records, total_liters_pumped, total_cost_pumped = fuel_records_query.with_entities(
+        func.count(FuelRecord.id),
+        func.coalesce(func.sum(FuelRecord.liters_pumped), 0),
+        func.coalesce(func.sum(FuelRecord.cost_pumped), 0)
+    ).one()
+    return {
+        "total_records": total_records,
+        "total_liters_pumped": total_liters_pumped,
+        "total_cost_pumped": total_cost_pumped,
+    }
+
+@app.get("/fuel-report", response_class=HTMLResponse)
+async def fuel_report_page(
+    request: Request, 
+    db: Session = Depends(get_db),
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    price_warning: Optional[str] = None,
+    error: Optional[str] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    start: int = 1,
+    limit: int = REPORT_PAGE_SIZE
+):
+    """Trang tổng hợp đổ dầu - báo cáo chi tiết"""
+    fuel_records_query = _fuel_report_query(db, from_date, to_date)
+    page = keyset_page(fuel_records_query, FuelRecord, after, before, limit, descending=True)
+    fuel_records = page["items"]
+    
+    # Đánh dấu phiếu đổ dầu bất thường trong trang đang xem
+    fuel_anomalies = {}
+    if fuel_records:
+        fuel_anomalies = detect_fuel_anomalies(
+            db, min(record.date for record in fuel_records), max(record.date for record in fuel_records)
+        )
+    
+    # Lấy danh sách xe để hiển thị trong dropdown
+    vehicles = db.query(Vehicle).filter(Vehicle.status == 1).all()
+    
+    # Tạo template data
+    template_data = {
+        "request": request,
+        "fuel_records": fuel_records,
+        "pagination": build_page_links(request, page, start),
+        "vehicles": vehicles,
+        "fuel_anomalies": fuel_anomalies,
+        "price_warning": price_warning,
+        "error": error,
+        **_fuel_report_totals(fuel_records_query)
+    }
+    
+    if from_date:
+        template_data["from_date"] = from_date
+    if to_date:
+        template_data["to_date"] = to_date
+    
+    return templates.TemplateResponse("fuel.html", template_data)
+
+@app.get("/api/fuel-report")
+async def fuel_report_api(
+    db: Session = Depends(get_db),
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    limit: int = REPORT_PAGE_SIZE
+):
+    """Phiếu đổ dầu theo trang (mới nhất trước) kèm tổng của toàn bộ khoảng lọc"""
+    fuel_records_query = _fuel_report_query(db, from_date, to_date)
+    page = keyset_page(fuel_records_query, FuelRecord, after, before, limit, descending=True)
+    return {
+        "success": True,
+        "items": [{
+            "id": record.id,
+            "date": record.date.strftime("%Y-%m-%d"),
+            "fuel_type": record.fuel_type,
+            "license_plate": record.license_plate,
+            "fuel_price_per_liter": record.fuel_price_per_liter or 0,
+            "liters_pumped": record.liters_pumped or 0,
+            "cost_pumped": record.cost_pumped or 0,
+            "notes": record.notes or ""
+        } for record in page["items"]],
+        "next_cursor": page["next_cursor"],
+        "prev_cursor": page["prev_cursor"],
+        "totals": _fuel_report_totals(fuel_records_query),
+    }
+
+@app.post("/fuel/add")
+async def add_fuel_record(
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """Thêm bản ghi đổ dầu mới"""
+    form_data = await request.form()
+    
+    # Lấy dữ liệu từ form
+    date_str = form_data.get("date")
+    fuel_type = form_data.get("fuel_type", "Dầu DO 0,05S-II")
+    license_plate = form_data.get("license_plate")
+    fuel_price_per_liter = float(form_data.get("fuel_price_per_liter") or 0)
+    liters_pumped = float(form_data.get("liters_pumped", 0))
+    notes = form_data.get("notes", "")
+    
+    if not date_str or not license_plate:
+        return RedirectResponse(url="/fuel-report", status_code=303)
+    
+    try:
+        fuel_date = datetime.strptime(date_str, "%Y-%m-%d").date()
+    except ValueError:
+        fuel_date = date.today()
+    
+    # Để trống giá thì lấy theo bảng giá tham chiếu, có nhập thì đối chiếu
+    reference_price = lookup_fuel_price(db, fuel_type, fuel_date)
+    if not fuel_price_per_liter:
+        if not reference_price:
+            # Không lưu phiếu 0 đồng: thiếu giá thì người dùng nhập tay hoặc bổ sung bảng giá
+            return RedirectResponse(url=f"/fuel-report?error={quote(missing_fuel_price_message(fuel_type, fuel_date))}", status_code=303)
+        fuel_price_per_liter = reference_price
+    price_warning = check_fuel_price(fuel_price_per_liter, reference_price)
+    
+    # Tính toán số tiền dầu đã đổ = Đơn giá dầu × Số lít dầu đã đổ (làm tròn đến đồng)
+    cost_pumped = round(fuel_price_per_liter * liters_pumped)
+    
+    # Tạo bản ghi mới
+    fuel_record = FuelRecord(
+        date=fuel_date,
+        fuel_type=fuel_type,
+        license_plate=license_plate,
+        fuel_price_per_liter=fuel_price_per_liter,
+        liters_pumped=liters_pumped,
+        cost_pumped=cost_pumped,
+        notes=notes
+    )
+    
+    db.add(fuel_record)
+    db.commit()
+    
+    # Redirect với tham số thời gian nếu có
+    redirect_url = "/fuel-report"
+    from_date = form_data.get("from_date")
+    to_date = form_data.get("to_date")
+    if from_date and to_date:
+        redirect_url += f"?from_date={from_date}&to_date={to_date}"
+    if price_warning:
+        redirect_url += f"{'&' if '?' in redirect_url else '?'}price_warning={quote(price_warning)}"
+    
+    return RedirectResponse(url=redirect_url, status_code=303)
+
+@app.post("/fuel/delete/{fuel_record_id}")
+async def delete_fuel_record(
+    fuel_record_id: int,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """Xóa bản ghi đổ dầu"""
+    fuel_record = db.query(FuelRecord).filter(FuelRecord.id == fuel_record_id).first()
+    if fuel_record:
+        db.delete(fuel_record)
+        db.commit()
+    
+    # Redirect về trang fuel
+    return RedirectResponse(url="/fuel-report", status_code=303)
+
+@app.get("/fuel/edit/{fuel_record_id}", response_class=HTMLResponse)
+async def edit_fuel_record_page(
+    request: Request,
+    fuel_record_id: int,
+    db: Session = Depends(get_db),
+    error: Optional[str] = None
+):
+    """Trang sửa bản ghi đổ dầu"""
+    fuel_record = db.query(FuelRecord).filter(FuelRecord.id == fuel_record_id).first()
+    if not fuel_record:
+        return RedirectResponse(url="/fuel-report", status_code=303)
+    
+    vehicles = db.query(Vehicle).filter(Vehicle.status == 1).all()
+    
+    return templates.TemplateResponse("edit_fuel.html", {
+        "request": request,
+        "fuel_record": fuel_record,
+        "vehicles": vehicles,
+        "error": error
+    })
+
+@app.post("/fuel/edit/{fuel_record_id}")
+async def edit_fuel_record(
+    fuel_record_id: int,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """Cập nhật bản ghi đổ dầu"""
+    fuel_record = db.query(FuelRecord).filter(FuelRecord.id == fuel_record_id).first()
+    if not fuel_record:
+        return RedirectResponse(url="/fuel-report", status_code=303)
+    
+    form_data = await request.form()
+    
+    # Cập nhật dữ liệu
+    date_str = form_data.get("date")
+    if date_str:
+        try:
+            fuel_record.date = datetime.strptime(date_str, "%Y-%m-%d").date()
+        except ValueError:
+            pass
+    
+    fuel_record.fuel_type = form_data.get("fuel_type", "Dầu DO 0,05S-II")
+    fuel_record.license_plate = form_data.get("license_plate")
+    fuel_record.fuel_price_per_liter = float(form_data.get("fuel_price_per_liter") or 0)
+    fuel_record.liters_pumped = float(form_data.get("liters_pumped", 0))
+    fuel_record.notes = form_data.get("notes", "")
+    
+    # Để trống giá thì lấy theo bảng giá tham chiếu, có nhập thì đối chiếu
+    reference_price = lookup_fuel_price(db, fuel_record.fuel_type, fuel_record.date)
+    if not fuel_record.fuel_price_per_liter:
+        if not reference_price:
+            message = missing_fuel_price_message(fuel_record.fuel_type, fuel_record.date)
+            db.rollback()
+            return RedirectResponse(url=f"/fuel/edit/{fuel_record_id}?error={quote(message)}", status_code=303)
+        fuel_record.fuel_price_per_liter = reference_price
+    price_warning = check_fuel_price(fuel_record.fuel_price_per_liter, reference_price)
+    
+    # Tính toán lại số tiền dầu đã đổ = Đơn giá dầu × Số lít dầu đã đổ (làm tròn đến đồng)
+    fuel_record.cost_pumped = round(fuel_record.fuel_price_per_liter * fuel_record.liters_pumped)
+    
+    db.commit()
+    if price_warning:
+        return RedirectResponse(url=f"/fuel-report?price_warning={quote(price_warning)}", status_code=303)
+    return RedirectResponse(url="/fuel-report", status_code=303)
+
+@app.get("/fuel/download-template")
+async def download_fuel_template(db: Session = Depends(get_db)):
+    """Tải mẫu Excel để import dữ liệu đổ dầu"""
+    # Lấy danh sách xe để hiển thị trong mẫu
+    vehicles = db.query(Vehicle).filter(Vehicle.status == 1).all()
+    vehicle_list = [v.license_plate for v in vehicles]
+    
+    # Tạo workbook Excel
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Mẫu Import Đổ Dầu"
+    
+    # Định dạng header
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+    header_alignment = Alignment(horizontal="center", vertical="center")
+    
+    # Tiêu đề
+    ws.merge_cells('A1:F1')
+    ws['A1'] = "MẪU IMPORT DỮ LIỆU ĐỔ DẦU"
+    ws['A1'].font = Font(bold=True, size=16)
+    ws['A1'].alignment = Alignment(horizontal="center")
+    
+    # Hướng dẫn
+    ws.merge_cells('A2:F2')
+    ws['A2'] = "Vui lòng điền dữ liệu theo đúng định dạng bên dưới"
+    ws['A2'].alignment = Alignment(horizontal="center")
+    ws['A2'].font = Font(italic=True)
+    
+    # Header bảng
+    headers = [
+        "STT", "Ngày đổ dầu (dd/mm/yyyy)", "Biển số xe", 
+        "Số lượng dầu đổ (lít)", "Đơn giá (đồng/lít)", "Thành tiền (đồng)"
+    ]
+    
+    for col, header in enumerate(headers, 1):
+        cell = ws.cell(row=4, column=col, value=header)
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = header_alignment
+    
+    # Dữ liệu mẫu
+    sample_data = [
+        [1, "01/01/2025", "51A-12345", 50.000, 19020, 951000],
+        [2, "02/01/2025", "51B-67890", 45.500, 19020, 865410],
+        [3, "03/01/2025", "51C-11111", 60.000, 19020, 1141200]
+    ]
+    
+    for row, data in enumerate(sample_data, 5):
+        for col, value in enumerate(data, 1):
+            ws.cell(row=row, column=col, value=value)
+    
+    # Định dạng số
+    for row in range(5, 8):
+        # Số lượng dầu - 3 chữ số thập phân
+        ws.cell(row=row, column=4).number_format = '#,##0.000'
+        # Đơn giá - 2 chữ số thập phân
+        ws.cell(row=row, column=5).number_format = '#,##0.00'
+        # Thành tiền - không có chữ số thập phân
+        ws.cell(row=row, column=6).number_format = '#,##0'
+    
+    # Thêm sheet hướng dẫn
+    ws2 = wb.create_sheet("Hướng dẫn")
+    ws2['A1'] = "HƯỚNG DẪN SỬ DỤNG"
+    ws2['A1'].font = Font(bold=True, size=14)
+    
+    instructions = [
+        "1. Định dạng cột:",
+        "   - STT: Số thứ tự (tự động)",
+        "   - Ngày đổ dầu: Định dạng dd/mm/yyyy (ví dụ: 01/01/2025)",
+        "   - Biển số xe: Phải khớp với danh sách xe trong hệ thống",
+        "   - Số lượng dầu đổ: Cho phép 3 chữ số thập phân (ví dụ: 50.000)",
+        "   - Đơn giá: Số chính xác (ví dụ: 19020), để trống để lấy theo bảng giá nhiên liệu",
+        "   - Thành tiền: Có thể để trống, hệ thống sẽ tự tính",
+        "",
+        "2. Danh sách biển số xe hợp lệ:",
+    ]
+    
+    for i, instruction in enumerate(instructions, 2):
+        ws2.cell(row=i, column=1, value=instruction)
+    
+    # Thêm danh sách xe
+    for i, vehicle in enumerate(vehicle_list, len(instructions) + 2):
+        ws2.cell(row=i, column=1, value=f"   - {vehicle}")
+    
+    # Điều chỉnh độ rộng cột
+    column_widths = [8, 20, 15, 20, 20, 18]
+    for col, width in enumerate(column_widths, 1):
+        ws.column_dimensions[get_column_letter(col)].width = width
+    
+    ws2.column_dimensions['A'].width = 50
+    
+    # Lưu vào memory
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    
+    # Tạo tên file
+    today = date.today()
+    filename = f"Mau_Import_DoDau_{today.strftime('%Y%m%d')}.xlsx"
+    
+    return Response(
+        content=output.getvalue(),
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
+    )
+
+@app.post("/fuel/import-excel")
+async def import_fuel_excel(
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db)
+):
+    """Import dữ liệu đổ dầu từ file Excel"""
+    try:
+        # Kiểm tra định dạng file
+        if not file.filename.lower().endswith(('.xlsx', '.xls')):
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "success": False, 
+                    "error": "Định dạng file không hợp lệ",
+                    "error_type": "file_format",
+                    "details": "Chỉ chấp nhận file Excel (.xlsx hoặc .xls)",
+                    "suggestion": "Vui lòng chọn file Excel có định dạng .xlsx hoặc .xls"
+                }
+            )
+        
+        # Đọc file Excel
+        content = await file.read()
+        if len(content) == 0:
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "success": False,
+                    "error": "File rỗng",
+                    "error_type": "empty_file",
+                    "details": "File Excel không chứa dữ liệu",
+                    "suggestion": "Vui lòng kiểm tra lại file Excel có chứa dữ liệu"
+                }
+            )
+        
+        try:
+            wb = load_workbook(io.BytesIO(content))
+            ws = wb.active
+        except Exception as e:
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "success": False,
+                    "error": "Không thể đọc file Excel",
+                    "error_type": "file_corrupted",
+                    "details": f"Lỗi kỹ thuật: {str(e)}",
+                    "suggestion": "Vui lòng kiểm tra file Excel không bị hỏng và có định dạng đúng"
+                }
+            )
+        
+        # Lấy danh sách xe hợp lệ
+        vehicles = db.query(Vehicle).filter(Vehicle.status == 1).all()
+        valid_license_plates = {v.license_plate for v in vehicles}
+        
+        imported_count = 0
+        skipped_count = 0
+        errors = []
+        pending_records = []
+        imported_records = []
+        price_warnings = []
+        
+        # Bỏ qua header (dòng 1-4)
+        for row_num in range(5, ws.max_row + 1):
+            try:
+                # Đọc dữ liệu từ Excel
+                stt = ws.cell(row=row_num, column=1).value
+                date_str = ws.cell(row=row_num, column=2).value
+                license_plate = ws.cell(row=row_num, column=3).value
+                liters_pumped = ws.cell(row=row_num, column=4).value
+                fuel_price_per_liter = ws.cell(row=row_num, column=5).value
+                cost_pumped = ws.cell(row=row_num, column=6).value
+                
+                # Bỏ qua dòng trống
+                if not date_str or not license_plate:
+                    continue
+                
+                # Validation dữ liệu với thông báo chi tiết
+                validation_errors = []
+                
+                # Kiểm tra ngày (cột B)
+                if isinstance(date_str, str):
+                    try:
+                        fuel_date = datetime.strptime(date_str, "%d/%m/%Y").date()
+                    except ValueError:
+                        validation_errors.append({
+                            "column": "B (Ngày đổ)",
+                            "error": "Định dạng ngày không đúng",
+                            "value": str(date_str),
+                            "suggestion": "Định dạng đúng: dd/mm/yyyy (ví dụ: 25/09/2025)"
+                        })
+                elif isinstance(date_str, datetime):
+                    fuel_date = date_str.date()
+                else:
+                    validation_errors.append({
+                        "column": "B (Ngày đổ)",
+                        "error": "Ngày không hợp lệ",
+                        "value": str(date_str),
+                        "suggestion": "Vui lòng nhập ngày theo định dạng dd/mm/yyyy"
+                    })
+                
+                # Kiểm tra biển số xe (cột C)
+                if not license_plate:
+                    validation_errors.append({
+                        "column": "C (Biển số xe)",
+                        "error": "Biển số xe không được để trống",
+                        "value": "",
+                        "suggestion": "Vui lòng nhập biển số xe"
+                    })
+                elif str(license_plate).strip() not in valid_license_plates:
+                    validation_errors.append({
+                        "column": "C (Biển số xe)",
+                        "error": "Biển số xe không tồn tại trong hệ thống",
+                        "value": str(license_plate),
+                        "suggestion": f"Biển số xe hợp lệ: {', '.join(list(valid_license_plates)[:5])}{'...' if len(valid_license_plates) > 5 else ''}"
+                    })
+                
                 # Kiểm tra số lít dầu (cột D)
                 try:
                     liters_pumped = float(liters_pumped) if liters_pumped is not None else 0
@@ -2142,15 +4585,15 @@ async def import_fuel_excel(
                         "suggestion": "Vui lòng nhập số lít dầu là số (ví dụ: 50.5, 100)"
                     })
                 
-                # Kiểm tra đơn giá (cột E)
+                # Kiểm tra đơn giá (cột E) - để trống thì lấy theo bảng giá tham chiếu
                 try:
-                    fuel_price_per_liter = float(fuel_price_per_liter) if fuel_price_per_liter is not None else 0
-                    if fuel_price_per_liter <= 0:
+                    fuel_price_per_liter = float(fuel_price_per_liter) if fuel_price_per_liter not in (None, "") else 0
+                    if fuel_price_per_liter < 0:
                         validation_errors.append({
                             "column": "E (Giá xăng dầu)",
-                            "error": "Đơn giá phải lớn hơn 0",
+                            "error": "Đơn giá không được âm",
                             "value": str(fuel_price_per_liter),
-                            "suggestion": "Vui lòng nhập đơn giá lớn hơn 0 (ví dụ: 25000)"
+                            "suggestion": "Vui lòng nhập đơn giá lớn hơn 0 (ví dụ: 25000) hoặc để trống để lấy theo bảng giá"
                         })
                 except (ValueError, TypeError):
                     validation_errors.append({
@@ -2160,14 +4603,14 @@ async def import_fuel_excel(
                         "suggestion": "Vui lòng nhập đơn giá là số (ví dụ: 25000, 25000.5)"
                     })
                 
-                # Tính thành tiền nếu không có
+                # Thành tiền (None = tự tính sau khi đã có đơn giá)
                 if cost_pumped is None or cost_pumped == "":
-                    cost_pumped = round(fuel_price_per_liter * liters_pumped)
+                    cost_pumped = None
                 else:
                     try:
                         cost_pumped = float(cost_pumped)
                     except (ValueError, TypeError):
-                        cost_pumped = round(fuel_price_per_liter * liters_pumped)
+                        cost_pumped = None
                 
                 # Nếu có lỗi validation, bỏ qua dòng này
                 if validation_errors:
@@ -2197,7 +4640,7 @@ async def import_fuel_excel(
                     skipped_count += 1
                     continue
                 
-                # Tạo bản ghi mới
+                # Tạo bản ghi mới (đơn giá được tra/đối chiếu cho tất cả các dòng sau vòng lặp)
                 fuel_record = FuelRecord(
                     date=fuel_date,
                     fuel_type="Dầu DO 0,05S-II",  # Mặc định
@@ -2207,9 +4650,7 @@ async def import_fuel_excel(
                     cost_pumped=cost_pumped,
                     notes=f"Import từ Excel - dòng {row_num}"
                 )
-                
-                db.add(fuel_record)
-                imported_count += 1
+                pending_records.append((row_num, fuel_record))
                 
             except Exception as e:
                 errors.append({
@@ -2224,193 +4665,2200 @@ async def import_fuel_excel(
                 skipped_count += 1
                 continue
         
-        # Commit tất cả thay đổi
+        # Tra giá tham chiếu cho tất cả các dòng cùng lúc để tự điền và đối chiếu đơn giá
+        reference_prices = lookup_fuel_prices(
+            db,
+            [record.fuel_type for _, record in pending_records],
+            [record.date for _, record in pending_records]
+        )
+        for (row_num, fuel_record), reference_price in zip(pending_records, reference_prices):
+            reference_price = None if np.isnan(reference_price) else float(reference_price)
+            if not fuel_record.fuel_price_per_liter:
+                if reference_price is None:
+                    errors.append({
+                        "row": row_num,
+                        "errors": [{
+                            "column": "E (Giá xăng dầu)",
+                            "error": "Chưa có đơn giá",
+                            "value": "",
+                            "suggestion": f"Nhập đơn giá hoặc thêm giá áp dụng cho ngày {fuel_record.date.strftime('%d/%m/%Y')} trong bảng giá nhiên liệu"
+                        }]
+                    })
+                    skipped_count += 1
+                    continue
+                fuel_record.fuel_price_per_liter = reference_price
+            price_warning = check_fuel_price(fuel_record.fuel_price_per_liter, reference_price)
+            if price_warning:
+                price_warnings.append({"row": row_num, "license_plate": fuel_record.license_plate, "date": fuel_record.date.strftime('%d/%m/%Y'), "warning": price_warning})
+            if fuel_record.cost_pumped is None:
+                fuel_record.cost_pumped = round(fuel_record.fuel_price_per_liter * fuel_record.liters_pumped)
+            
+            db.add(fuel_record)
+            imported_records.append((row_num, fuel_record))
+            imported_count += 1
+        errors.sort(key=lambda error: error["row"])
+        
+        # Commit tất cả thay đổi
+        db.commit()
+        
+        # Tạo response chi tiết
+        response_data = {
+            "success": True,
+            "imported_count": imported_count,
+            "skipped_count": skipped_count,
+            "total_errors": len(errors),
+            "summary": {
+                "total_rows_processed": ws.max_row - 4,  # Trừ header
+                "successful_imports": imported_count,
+                "failed_imports": skipped_count,
+                "success_rate": f"{(imported_count / max(1, ws.max_row - 4)) * 100:.1f}%" if ws.max_row > 4 else "0%"
+            }
+        }
+        
+        # Kiểm tra bất thường cho các phiếu vừa import (so với lịch sử của từng xe)
+        if imported_records:
+            anomalies = detect_fuel_anomalies(
+                db, min(record.date for _, record in imported_records), max(record.date for _, record in imported_records)
+            )
+            response_data["anomalies"] = [{
+                "row": row_num,
+                "id": record.id,
+                "date": record.date.strftime('%d/%m/%Y'),
+                "license_plate": record.license_plate,
+                "reasons": anomalies[record.id]
+            } for row_num, record in imported_records if record.id in anomalies]
+            response_data["anomaly_count"] = len(response_data["anomalies"])
+        if price_warnings:
+            response_data["price_warnings"] = price_warnings
+        
+        if errors:
+            response_data["errors"] = errors[:20]  # Hiển thị 20 lỗi đầu tiên
+            if len(errors) > 20:
+                response_data["has_more_errors"] = True
+                response_data["remaining_errors"] = len(errors) - 20
+            response_data["error_summary"] = {
+                "validation_errors": len([e for e in errors if any(err.get("column") != "Tổng hợp" for err in e.get("errors", []))]),
+                "duplicate_errors": len([e for e in errors if any("trùng lặp" in err.get("error", "") for err in e.get("errors", []))]),
+                "technical_errors": len([e for e in errors if any("Lỗi xử lý" in err.get("error", "") for err in e.get("errors", []))])
+            }
+        
+        return JSONResponse(content=response_data)
+        
+    except Exception as e:
+        db.rollback()
+        return JSONResponse(
+            status_code=500,
+            content={
+                "success": False, 
+                "error": "Lỗi hệ thống",
+                "error_type": "system_error",
+                "details": f"Lỗi kỹ thuật: {str(e)}",
+                "suggestion": "Vui lòng thử lại hoặc liên hệ quản trị viên nếu lỗi vẫn tiếp tục"
+            }
+        )
+
+@app.get("/fuel/export-excel")
+async def export_fuel_excel(
+    db: Session = Depends(get_db),
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None
+):
+    """Redirect đến fuel-report export"""
+    from fastapi.responses import RedirectResponse
+    params = []
+    if from_date:
+        params.append(f"from_date={from_date}")
+    if to_date:
+        params.append(f"to_date={to_date}")
+    
+    url = "/fuel-report/export-excel"
+    if params:
+        url += "?" + "&".join(params)
+    
+    return RedirectResponse(url=url, status_code=302)
+
+@app.get("/fuel-report/export-excel")
+async def export_fuel_report_excel(
+    db: Session = Depends(get_db),
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None
+):
+    """Xuất Excel báo cáo đổ dầu"""
+    # Xử lý khoảng thời gian (sử dụng logic giống như fuel_page)
+    if from_date and to_date:
+        try:
+            from_date_obj = datetime.strptime(from_date, "%Y-%m-%d").date()
+            to_date_obj = datetime.strptime(to_date, "%Y-%m-%d").date()
+            fuel_records_query = db.query(FuelRecord).filter(
+                FuelRecord.date >= from_date_obj,
+                FuelRecord.date <= to_date_obj
+            )
+        except ValueError:
+            fuel_records_query = db.query(FuelRecord)
+    else:
+        # Nếu không có khoảng thời gian, lấy tháng hiện tại
+        today = date.today()
+        fuel_records_query = db.query(FuelRecord).filter(
+            FuelRecord.date >= date(today.year, today.month, 1),
+            FuelRecord.date < date(today.year, today.month + 1, 1) if today.month < 12 else date(today.year + 1, 1, 1)
+        )
+    
+    fuel_records = fuel_records_query.order_by(FuelRecord.date.desc(), FuelRecord.license_plate).all()
+    
+    # Tạo workbook Excel
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Báo cáo đổ dầu"
+    
+    # Định dạng header
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+    header_alignment = Alignment(horizontal="center", vertical="center")
+    
+    # Tiêu đề báo cáo
+    ws.merge_cells('A1:H1')
+    ws['A1'] = "BÁO CÁO ĐỔ DẦU"
+    ws['A1'].font = Font(bold=True, size=16)
+    ws['A1'].alignment = Alignment(horizontal="center")
+    
+    # Thông tin thời gian
+    period_text = ""
+    if from_date and to_date:
+        period_text = f"Từ ngày: {from_date} đến ngày: {to_date}"
+    else:
+        today = date.today()
+        period_text = f"Tháng: {today.month}/{today.year}"
+    
+    ws.merge_cells('A2:H2')
+    ws['A2'] = period_text
+    ws['A2'].alignment = Alignment(horizontal="center")
+    
+    # Header bảng
+    headers = [
+        "STT", "Ngày đổ", "Loại dầu", "Biển số xe", 
+        "Giá xăng dầu (đồng/lít)", "Số lít đã đổ", "Số tiền đã đổ (VNĐ)", "Ghi chú"
+    ]
+    
+    for col, header in enumerate(headers, 1):
+        cell = ws.cell(row=4, column=col, value=header)
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = header_alignment
+    
+    # Dữ liệu
+    for row, record in enumerate(fuel_records, 5):
+        ws.cell(row=row, column=1, value=row-4)  # STT
+        ws.cell(row=row, column=2, value=record.date.strftime('%d/%m/%Y'))  # Ngày đổ
+        ws.cell(row=row, column=3, value=record.fuel_type)  # Loại dầu
+        ws.cell(row=row, column=4, value=record.license_plate)  # Biển số xe
+        ws.cell(row=row, column=5, value=record.fuel_price_per_liter)  # Giá xăng dầu
+        ws.cell(row=row, column=6, value=record.liters_pumped)  # Số lít đã đổ
+        ws.cell(row=row, column=7, value=record.cost_pumped)  # Số tiền đã đổ
+        ws.cell(row=row, column=8, value=record.notes or '')  # Ghi chú
+    
+    # Định dạng số
+    for row in range(5, 5 + len(fuel_records)):
+        # Giá xăng dầu - 2 chữ số thập phân
+        ws.cell(row=row, column=5).number_format = '#,##0.00'
+        # Số lít - 3 chữ số thập phân
+        ws.cell(row=row, column=6).number_format = '#,##0.000'
+        # Số tiền - không có chữ số thập phân
+        ws.cell(row=row, column=7).number_format = '#,##0'
+    
+    # Dòng tổng cộng
+    if fuel_records:
+        total_row = 5 + len(fuel_records)
+        ws.cell(row=total_row, column=1, value="TỔNG CỘNG").font = Font(bold=True)
+        ws.cell(row=total_row, column=2, value="").font = Font(bold=True)
+        ws.cell(row=total_row, column=3, value="").font = Font(bold=True)
+        ws.cell(row=total_row, column=4, value="").font = Font(bold=True)
+        ws.cell(row=total_row, column=5, value="").font = Font(bold=True)
+        ws.cell(row=total_row, column=6, value=sum(r.liters_pumped for r in fuel_records)).font = Font(bold=True)
+        ws.cell(row=total_row, column=7, value=sum(r.cost_pumped for r in fuel_records)).font = Font(bold=True)
+        ws.cell(row=total_row, column=8, value="").font = Font(bold=True)
+        
+        # Định dạng số cho dòng tổng cộng
+        ws.cell(row=total_row, column=6).number_format = '#,##0.000'
+        ws.cell(row=total_row, column=7).number_format = '#,##0'
+    
+    # Điều chỉnh độ rộng cột
+    column_widths = [8, 12, 20, 15, 20, 15, 18, 30]
+    for col, width in enumerate(column_widths, 1):
+        ws.column_dimensions[get_column_letter(col)].width = width
+    
+    # Lưu vào memory
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    
+    # Tạo tên file
+    today = date.today()
+    filename = f"BaoCao_DoDau_{today.strftime('%Y%m%d')}.xlsx"
+    
+    return Response(
+        content=output.getvalue(),
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
+    )
+
+# ===== HIỆU SUẤT NHIÊN LIỆU =====
+
+FUEL_EFFICIENCY_WARN_PCT = 15  # Tiêu hao thực tế vượt định mức quá % này thì đánh dấu
+
+# Cache kết quả theo tháng "YYYY-MM" -> danh sách dòng (mỗi xe một dòng)
+# {tháng: (mốc dữ liệu nguồn lúc tính, các dòng)}; mốc trong data_versions khác (kể cả do process khác ghi) -> tính lại
+FUEL_EFFICIENCY_GLOBAL_TABLES = ("vehicles",)  # Định mức tiêu hao thay đổi ảnh hưởng mọi tháng
+_fuel_efficiency_cache = {}
+
+def _compute_fuel_efficiency(db: Session, from_date: date, to_date: date) -> dict:
+    """Tổng km (bảng chấm công) và tổng lít (đổ dầu) theo biển số và tháng bằng một truy vấn,
+    sau đó tính tiêu hao thực tế so với định mức bằng NumPy. Trả về {tháng: [dòng]}."""
+    rows = db.execute(text("""
+        WITH km AS (
+            SELECT UPPER(TRIM(license_plate)) AS plate, strftime('%Y-%m', date) AS month,
+                   COUNT(*) AS trip_count, SUM(distance_km) AS distance_km
+            FROM daily_routes
+            WHERE date >= :from_date AND date <= :to_date AND TRIM(COALESCE(license_plate, '')) <> ''
+            GROUP BY 1, 2
+        ),
+        fuel AS (
+            SELECT UPPER(TRIM(license_plate)) AS plate, strftime('%Y-%m', date) AS month,
+                   COUNT(*) AS fill_count, SUM(liters_pumped) AS liters, SUM(cost_pumped) AS fuel_cost
+            FROM fuel_records
+            WHERE date >= :from_date AND date <= :to_date AND TRIM(COALESCE(license_plate, '')) <> ''
+            GROUP BY 1, 2
+        ),
+        keys AS (
+            SELECT plate, month FROM km UNION SELECT plate, month FROM fuel
+        ),
+        nominal AS (
+            SELECT UPPER(TRIM(license_plate)) AS plate, MAX(fuel_consumption) AS fuel_consumption
+            FROM vehicles GROUP BY 1
+        )
+        SELECT keys.month, keys.plate,
+               COALESCE(km.trip_count, 0), COALESCE(km.distance_km, 0),
+               COALESCE(fuel.fill_count, 0), COALESCE(fuel.liters, 0), COALESCE(fuel.fuel_cost, 0),
+               nominal.fuel_consumption
+        FROM keys
+        LEFT JOIN km ON km.plate = keys.plate AND km.month = keys.month
+        LEFT JOIN fuel ON fuel.plate = keys.plate AND fuel.month = keys.month
+        LEFT JOIN nominal ON nominal.plate = keys.plate
+        ORDER BY keys.month, keys.plate
+    """), {"from_date": from_date.strftime("%Y-%m-%d"), "to_date": to_date.strftime("%Y-%m-%d")}).all()
+    
+    result = {}
+    if not rows:
+        return result
+    
+    distance_km = np.array([row[3] for row in rows], dtype=float)
+    liters = np.array([row[5] for row in rows], dtype=float)
+    nominal = np.array([row[7] if row[7] else np.nan for row in rows], dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        actual = np.where(distance_km > 0, liters / distance_km * 100, np.nan)
+        expected_liters = distance_km * nominal / 100
+        excess_liters = liters - expected_liters
+        variance_pct = (actual - nominal) / nominal * 100
+    
+    def to_number(value, digits):
+        return None if np.isnan(value) else round(float(value), digits)
+    
+    for index, (month, plate, trip_count, _, fill_count, _, fuel_cost, _) in enumerate(rows):
+        if distance_km[index] <= 0:
+            status = "no_km"
+        elif liters[index] <= 0:
+            status = "no_fuel"
+        elif np.isnan(nominal[index]):
+            status = "no_nominal"
+        elif variance_pct[index] > FUEL_EFFICIENCY_WARN_PCT:
+            status = "over"
+        else:
+            status = "normal"
+        result.setdefault(month, []).append({
+            "month": month,
+            "license_plate": plate,
+            "trip_count": trip_count,
+            "fill_count": fill_count,
+            "distance_km": round(float(distance_km[index]), 1),
+            "liters": round(float(liters[index]), 3),
+            "fuel_cost": fuel_cost,
+            "nominal": to_number(nominal[index], 2),
+            "actual": to_number(actual[index], 2),
+            "expected_liters": to_number(expected_liters[index], 3),
+            "excess_liters": to_number(excess_liters[index], 3),
+            "variance_pct": to_number(variance_pct[index], 1),
+            "status": status,
+        })
+    return result
+
+def get_fuel_efficiency(db: Session, year: int, month: Optional[int] = None) -> list:
+    """Hiệu suất nhiên liệu theo xe cho một tháng hoặc cả năm; các tháng chưa có trong cache
+    được tính cùng lúc bằng một truy vấn"""
+    months = [month] if month else list(range(1, 13))
+    month_keys = [f"{year}-{m:02d}" for m in months]
+    # Đọc mốc trước khi tính: thay đổi xảy ra trong lúc tính làm mốc lệch và lần sau tính lại
+    versions = month_source_versions(db, month_keys, FUEL_EFFICIENCY_GLOBAL_TABLES)
+    cached = {key: _fuel_efficiency_cache.get(key) for key in month_keys}
+    missing = [m for m, key in zip(months, month_keys) if not cached[key] or cached[key][0] != versions[key]]
+    if missing:
+        computed = _compute_fuel_efficiency(
+            db, _month_date_range(min(missing), year)[0], _month_date_range(max(missing), year)[1]
+        )
+        for m in missing:
+            key = f"{year}-{m:02d}"
+            cached[key] = _fuel_efficiency_cache[key] = (versions[key], computed.get(key, []))
+    
+    return [row for key in month_keys for row in cached[key][1]]
+
+def summarize_fuel_efficiency(rows: list) -> dict:
+    """Tổng hợp toàn đội xe (chỉ tính tiêu hao trên các dòng có cả km và lít)"""
+    measured = [row for row in rows if row["actual"] is not None and row["liters"] > 0]
+    distance_km = sum(row["distance_km"] for row in measured)
+    liters = sum(row["liters"] for row in measured)
+    expected_liters = sum(row["expected_liters"] for row in measured if row["expected_liters"] is not None)
+    return {
+        "distance_km": sum(row["distance_km"] for row in rows),
+        "liters": sum(row["liters"] for row in rows),
+        "fuel_cost": sum(row["fuel_cost"] for row in rows),
+        "actual": round(liters / distance_km * 100, 2) if distance_km else None,
+        "excess_liters": round(liters - expected_liters, 3) if measured else None,
+        "over_count": sum(1 for row in rows if row["status"] == "over"),
+    }
+
+FUEL_EFFICIENCY_STATUS_LABELS = {
+    "normal": "Đạt định mức",
+    "over": "Vượt định mức",
+    "no_km": "Có đổ dầu, không có km",
+    "no_fuel": "Có km, chưa đổ dầu",
+    "no_nominal": "Chưa có định mức",
+}
+
+@app.get("/fuel-efficiency", response_class=HTMLResponse)
+async def fuel_efficiency_page(
+    request: Request,
+    db: Session = Depends(get_db),
+    month: Optional[int] = None,
+    year: Optional[int] = None
+):
+    """Trang hiệu suất nhiên liệu (lít/100km) theo xe: thực tế so với định mức"""
+    if not year:
+        current_date = datetime.now()
+        year = current_date.year
+        month = month or current_date.month
+    
+    # Tháng/năm không hợp lệ -> báo cáo rỗng
+    rows = get_fuel_efficiency(db, year, month) if is_valid_report_period(month, year) else []
+    return templates.TemplateResponse("fuel_efficiency.html", {
+        "request": request,
+        "rows": rows,
+        "summary": summarize_fuel_efficiency(rows),
+        "status_labels": FUEL_EFFICIENCY_STATUS_LABELS,
+        "warn_pct": FUEL_EFFICIENCY_WARN_PCT,
+        "selected_month": month,
+        "selected_year": year
+    })
+
+@app.get("/fuel-efficiency/export-excel")
+async def export_fuel_efficiency_excel(
+    db: Session = Depends(get_db),
+    month: Optional[int] = None,
+    year: Optional[int] = None
+):
+    """Xuất Excel hiệu suất nhiên liệu theo xe"""
+    if not year:
+        current_date = datetime.now()
+        year = current_date.year
+        month = month or current_date.month
+    
+    # Tháng/năm không hợp lệ -> báo cáo rỗng
+    rows = get_fuel_efficiency(db, year, month) if is_valid_report_period(month, year) else []
+    summary = summarize_fuel_efficiency(rows)
+    
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Hiệu suất nhiên liệu"
+    
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+    header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+    over_fill = PatternFill(start_color="F8D7DA", end_color="F8D7DA", fill_type="solid")
+    
+    ws.merge_cells('A1:L1')
+    ws['A1'] = "BÁO CÁO HIỆU SUẤT NHIÊN LIỆU"
+    ws['A1'].font = Font(bold=True, size=16)
+    ws['A1'].alignment = Alignment(horizontal="center")
+    ws.merge_cells('A2:L2')
+    ws['A2'] = f"Tháng: {month}/{year}" if month else f"Năm: {year}"
+    ws['A2'].alignment = Alignment(horizontal="center")
+    
+    headers = [
+        "Tháng", "Biển số xe", "Số chuyến", "Số km", "Số lần đổ", "Số lít", "Tiền dầu (VNĐ)",
+        "Định mức (L/100km)", "Thực tế (L/100km)", "Chênh lệch (%)", "Lít vượt định mức", "Trạng thái"
+    ]
+    for col, header in enumerate(headers, 1):
+        cell = ws.cell(row=4, column=col, value=header)
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = header_alignment
+    
+    for row_index, row in enumerate(rows, 5):
+        values = [
+            row["month"], row["license_plate"], row["trip_count"], row["distance_km"], row["fill_count"],
+            row["liters"], row["fuel_cost"], row["nominal"], row["actual"], row["variance_pct"],
+            row["excess_liters"], FUEL_EFFICIENCY_STATUS_LABELS[row["status"]]
+        ]
+        for col, value in enumerate(values, 1):
+            cell = ws.cell(row=row_index, column=col, value=value)
+            if row["status"] == "over":
+                cell.fill = over_fill
+        ws.cell(row=row_index, column=4).number_format = '#,##0.0'
+        ws.cell(row=row_index, column=6).number_format = '#,##0.000'
+        ws.cell(row=row_index, column=7).number_format = '#,##0'
+        ws.cell(row=row_index, column=9).number_format = '#,##0.00'
+        ws.cell(row=row_index, column=11).number_format = '#,##0.000'
+    
+    if rows:
+        total_row = 5 + len(rows)
+        ws.cell(row=total_row, column=1, value="TỔNG CỘNG").font = Font(bold=True)
+        ws.cell(row=total_row, column=4, value=summary["distance_km"]).font = Font(bold=True)
+        ws.cell(row=total_row, column=6, value=summary["liters"]).font = Font(bold=True)
+        ws.cell(row=total_row, column=7, value=summary["fuel_cost"]).font = Font(bold=True)
+        ws.cell(row=total_row, column=9, value=summary["actual"]).font = Font(bold=True)
+        ws.cell(row=total_row, column=11, value=summary["excess_liters"]).font = Font(bold=True)
+        ws.cell(row=total_row, column=4).number_format = '#,##0.0'
+        ws.cell(row=total_row, column=6).number_format = '#,##0.000'
+        ws.cell(row=total_row, column=7).number_format = '#,##0'
+    
+    column_widths = [10, 15, 10, 12, 10, 12, 16, 14, 14, 12, 14, 24]
+    for col, width in enumerate(column_widths, 1):
+        ws.column_dimensions[get_column_letter(col)].width = width
+    
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    
+    filename = f"HieuSuat_NhienLieu_{year}{month:02d}.xlsx" if month else f"HieuSuat_NhienLieu_{year}.xlsx"
+    return Response(
+        content=output.getvalue(),
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
+    )
+
+# ===== HIỆU SUẤT SỬ DỤNG XE =====
+
+# Cache kết quả các tháng đã kết thúc: "YYYY-MM" -> danh sách dòng (mỗi xe một dòng).
+# Tháng hiện tại luôn tính lại vì còn phát sinh chuyến.
+# {tháng đã kết thúc: (mốc dữ liệu nguồn lúc tính, các dòng)}; mốc trong data_versions khác (kể cả do process khác ghi) -> tính lại
+VEHICLE_UTILIZATION_GLOBAL_TABLES = ("routes", "vehicles")  # Xe gán cho tuyến / danh sách xe ảnh hưởng mọi tháng
+_vehicle_utilization_cache = {}
+
+def _compute_vehicle_utilization(db: Session, from_date: date, to_date: date) -> dict:
+    """Một lượt quét các chuyến trong khoảng ngày (theo index ngày): gom theo xe + ngày,
+    LAG() trên từng xe/tháng cho khoảng cách giữa hai ngày chạy liên tiếp, rồi gom theo xe + tháng.
+    Biển số lấy từ chuyến, chuyến chưa ghi biển số lấy xe gán cho tuyến.
+    Trả về {"YYYY-MM": [dòng]} (chỉ các xe có chạy)."""
+    rows = db.execute(text("""
+        WITH trips AS (
+            SELECT UPPER(TRIM(COALESCE(NULLIF(TRIM(dr.license_plate), ''), v.license_plate))) AS plate,
+                   dr.date AS date,
+                   COALESCE(dr.distance_km, 0) AS km
+            FROM daily_routes dr
+            JOIN routes r ON r.id = dr.route_id
+            LEFT JOIN vehicles v ON v.id = r.vehicle_id
+            WHERE dr.date >= :from_date AND dr.date <= :to_date
+        ),
+        active_days AS (
+            SELECT plate, date, substr(date, 1, 7) AS month,
+                   COUNT(*) AS trip_count,
+                   SUM(km) AS km,
+                   julianday(date) - julianday(LAG(date) OVER (PARTITION BY plate, substr(date, 1, 7) ORDER BY date)) AS gap
+            FROM trips
+            WHERE plate IS NOT NULL AND plate != ''
+            GROUP BY plate, date
+        )
+        SELECT month, plate,
+               COUNT(*) AS active_days,
+               SUM(trip_count) AS trip_count,
+               SUM(km) AS distance_km,
+               AVG(gap) AS avg_gap,
+               MAX(gap) AS max_gap,
+               SUM(CASE WHEN gap > 1 THEN 1 ELSE 0 END) AS inner_idle_streaks,
+               MIN(date) AS first_date,
+               MAX(date) AS last_date
+        FROM active_days
+        GROUP BY month, plate
+        ORDER BY month, plate
+    """), {"from_date": from_date.strftime("%Y-%m-%d"), "to_date": to_date.strftime("%Y-%m-%d")}).all()
+    
+    result = {}
+    for row in rows:
+        result.setdefault(row.month, []).append(row)
+    return result
+
+def _build_utilization_rows(year: int, month: int, computed_rows: list, fleet_plates: list) -> list:
+    """Chỉ số từng xe trong tháng; xe đang hoạt động nhưng không chạy chuyến nào cũng có một dòng (nghỉ cả tháng)"""
+    month_start, month_end = _month_date_range(month, year)
+    period_end = min(month_end, date.today())  # Tháng hiện tại chỉ tính đến hôm nay
+    period_days = (period_end - month_start).days + 1
+    
+    rows = []
+    seen_plates = set()
+    for row in computed_rows:
+        seen_plates.add(row.plate)
+        first_date = date.fromisoformat(row.first_date)
+        last_date = date.fromisoformat(row.last_date)
+        # Chuỗi ngày nghỉ: giữa hai ngày chạy, đầu tháng trước ngày chạy đầu tiên, cuối kỳ sau ngày chạy cuối
+        leading_idle = (first_date - month_start).days
+        trailing_idle = (period_end - last_date).days
+        rows.append({
+            "month": f"{year}-{month:02d}",
+            "license_plate": row.plate,
+            "period_days": period_days,
+            "active_days": row.active_days,
+            "idle_days": period_days - row.active_days,
+            "utilization_pct": round(row.active_days / period_days * 100, 1),
+            "trip_count": row.trip_count,
+            "trips_per_day": round(row.trip_count / row.active_days, 2),
+            "distance_km": round(row.distance_km or 0, 1),
+            "km_per_day": round((row.distance_km or 0) / row.active_days, 1),
+            "avg_gap_days": round(row.avg_gap, 2) if row.avg_gap is not None else None,
+            "max_idle_streak": int(max((row.max_gap or 1) - 1, leading_idle, trailing_idle, 0)),
+            "idle_streaks": row.inner_idle_streaks + (leading_idle > 0) + (trailing_idle > 0),
+            "first_date": first_date,
+            "last_date": last_date,
+        })
+    for plate in fleet_plates:
+        if plate not in seen_plates:
+            rows.append({
+                "month": f"{year}-{month:02d}",
+                "license_plate": plate,
+                "period_days": period_days,
+                "active_days": 0,
+                "idle_days": period_days,
+                "utilization_pct": 0.0,
+                "trip_count": 0,
+                "trips_per_day": 0,
+                "distance_km": 0,
+                "km_per_day": 0,
+                "avg_gap_days": None,
+                "max_idle_streak": period_days,
+                "idle_streaks": 1,
+                "first_date": None,
+                "last_date": None,
+            })
+    rows.sort(key=lambda row: (-row["utilization_pct"], row["license_plate"]))
+    return rows
+
+def get_vehicle_utilization(db: Session, year: int, month: Optional[int] = None) -> list:
+    """Hiệu suất sử dụng xe cho một tháng hoặc cả năm (đến tháng hiện tại).
+    Các tháng chưa có trong cache được tính cùng lúc bằng một truy vấn; chỉ cache tháng đã kết thúc."""
+    today = date.today()
+    months = [month] if month else list(range(1, 13))
+    months = [m for m in months if date(year, m, 1) <= today]
+    if not months:
+        return []
+    month_keys = {m: f"{year}-{m:02d}" for m in months}
+    # Đọc mốc trước khi tính: thay đổi xảy ra trong lúc tính làm mốc lệch và lần sau tính lại
+    versions = month_source_versions(db, list(month_keys.values()), VEHICLE_UTILIZATION_GLOBAL_TABLES)
+    results = {}
+    for m in months:
+        cached = _vehicle_utilization_cache.get(month_keys[m])
+        if cached and cached[0] == versions[month_keys[m]]:
+            results[m] = cached[1]
+    missing = [m for m in months if m not in results]
+    
+    if missing:
+        computed = _compute_vehicle_utilization(
+            db, _month_date_range(min(missing), year)[0], _month_date_range(max(missing), year)[1]
+        )
+        fleet_plates = sorted({
+            plate.strip().upper() for (plate,) in db.query(Vehicle.license_plate).filter(Vehicle.status == 1).all()
+            if plate and plate.strip()
+        })
+        for m in missing:
+            results[m] = _build_utilization_rows(year, m, computed.get(month_keys[m], []), fleet_plates)
+            if _month_date_range(m, year)[1] < today:
+                _vehicle_utilization_cache[month_keys[m]] = (versions[month_keys[m]], results[m])
+    
+    return [row for m in months for row in results[m]]
+
+def summarize_vehicle_utilization(rows: list) -> dict:
+    """Tổng hợp toàn đội xe"""
+    active_days = sum(row["active_days"] for row in rows)
+    period_days = sum(row["period_days"] for row in rows)
+    return {
+        "vehicle_count": len({row["license_plate"] for row in rows}),
+        "trip_count": sum(row["trip_count"] for row in rows),
+        "distance_km": sum(row["distance_km"] for row in rows),
+        "utilization_pct": round(active_days / period_days * 100, 1) if period_days else None,
+        "idle_vehicle_count": sum(1 for row in rows if row["active_days"] == 0),
+    }
+
+@app.get("/vehicle-utilization", response_class=HTMLResponse)
+async def vehicle_utilization_page(
+    request: Request,
+    db: Session = Depends(get_db),
+    month: Optional[int] = None,
+    year: Optional[int] = None
+):
+    """Trang hiệu suất sử dụng xe: ngày chạy, chuỗi ngày nghỉ, chuyến/ngày, km/ngày"""
+    if not year:
+        current_date = datetime.now()
+        year = current_date.year
+        month = month or current_date.month
+    
+    # Tháng/năm không hợp lệ -> báo cáo rỗng
+    rows = get_vehicle_utilization(db, year, month) if is_valid_report_period(month, year) else []
+    return templates.TemplateResponse("vehicle_utilization.html", {
+        "request": request,
+        "rows": rows,
+        "summary": summarize_vehicle_utilization(rows),
+        "selected_month": month,
+        "selected_year": year
+    })
+
+@app.get("/api/vehicle-utilization")
+async def vehicle_utilization_api(db: Session = Depends(get_db), month: Optional[int] = None, year: Optional[int] = None):
+    if not year:
+        current_date = datetime.now()
+        year = current_date.year
+        month = month or current_date.month
+    if not is_valid_report_period(month, year):
+        return JSONResponse({"success": False, "message": "Tháng hoặc năm không hợp lệ"}, status_code=400)
+    rows = get_vehicle_utilization(db, year, month)
+    return {
+        "year": year,
+        "month": month,
+        "summary": summarize_vehicle_utilization(rows),
+        "vehicles": [
+            dict(row, first_date=row["first_date"].isoformat() if row["first_date"] else None,
+                 last_date=row["last_date"].isoformat() if row["last_date"] else None)
+            for row in rows
+        ]
+    }
+
+@app.get("/vehicle-utilization/export-excel")
+async def export_vehicle_utilization_excel(
+    db: Session = Depends(get_db),
+    month: Optional[int] = None,
+    year: Optional[int] = None
+):
+    """Xuất Excel hiệu suất sử dụng xe"""
+    if not year:
+        current_date = datetime.now()
+        year = current_date.year
+        month = month or current_date.month
+    
+    rows = get_vehicle_utilization(db, year, month) if is_valid_report_period(month, year) else []
+    summary = summarize_vehicle_utilization(rows)
+    
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Hiệu suất sử dụng xe"
+    
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+    header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+    idle_fill = PatternFill(start_color="F8D7DA", end_color="F8D7DA", fill_type="solid")
+    
+    ws.merge_cells('A1:L1')
+    ws['A1'] = "BÁO CÁO HIỆU SUẤT SỬ DỤNG XE"
+    ws['A1'].font = Font(bold=True, size=16)
+    ws['A1'].alignment = Alignment(horizontal="center")
+    ws.merge_cells('A2:L2')
+    ws['A2'] = f"Tháng: {month}/{year}" if month else f"Năm: {year}"
+    ws['A2'].alignment = Alignment(horizontal="center")
+    
+    headers = [
+        "Tháng", "Biển số xe", "Số ngày kỳ", "Ngày chạy", "Tỷ lệ sử dụng (%)", "Số chuyến", "Chuyến/ngày",
+        "Số km", "Km/ngày", "Khoảng cách TB (ngày)", "Chuỗi nghỉ dài nhất", "Số đợt nghỉ"
+    ]
+    for col, header in enumerate(headers, 1):
+        cell = ws.cell(row=4, column=col, value=header)
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = header_alignment
+    
+    for row_index, row in enumerate(rows, 5):
+        values = [
+            row["month"], row["license_plate"], row["period_days"], row["active_days"], row["utilization_pct"],
+            row["trip_count"], row["trips_per_day"], row["distance_km"], row["km_per_day"],
+            row["avg_gap_days"], row["max_idle_streak"], row["idle_streaks"]
+        ]
+        for col, value in enumerate(values, 1):
+            cell = ws.cell(row=row_index, column=col, value=value)
+            if row["active_days"] == 0:
+                cell.fill = idle_fill
+        ws.cell(row=row_index, column=8).number_format = '#,##0.0'
+    
+    if rows:
+        total_row = 5 + len(rows)
+        ws.cell(row=total_row, column=1, value="TỔNG CỘNG").font = Font(bold=True)
+        ws.cell(row=total_row, column=5, value=summary["utilization_pct"]).font = Font(bold=True)
+        ws.cell(row=total_row, column=6, value=summary["trip_count"]).font = Font(bold=True)
+        ws.cell(row=total_row, column=8, value=summary["distance_km"]).font = Font(bold=True)
+        ws.cell(row=total_row, column=8).number_format = '#,##0.0'
+    
+    column_widths = [10, 15, 10, 10, 12, 10, 10, 12, 10, 14, 14, 10]
+    for col, width in enumerate(column_widths, 1):
+        ws.column_dimensions[get_column_letter(col)].width = width
+    
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    
+    filename = f"HieuSuat_SuDungXe_{year}{month:02d}.xlsx" if month else f"HieuSuat_SuDungXe_{year}.xlsx"
+    return Response(
+        content=output.getvalue(),
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
+    )
+
+# ===== PHÁT HIỆN ĐỔ DẦU BẤT THƯỜNG =====
+
+FUEL_ANOMALY_WINDOW = 10  # Số lần đổ gần nhất của xe dùng làm chuẩn so sánh
+FUEL_ANOMALY_MIN_HISTORY = 3  # Cần ít nhất ngần này lần đổ trước đó mới đánh giá
+FUEL_ANOMALY_Z_SCORE = 3.5  # Ngưỡng robust z-score (theo median/MAD) để coi là bất thường
+FUEL_ANOMALY_LOOKBACK_DAYS = 180  # Nạp thêm lịch sử trước khoảng cần kiểm tra
+FUEL_PRICE_DEVIATION_PCT = 10  # Giá lệch quá % này so với giá trung vị trong ngày của đội xe
+
+def _trailing_baseline(values, group_start, window: int):
+    """Median và MAD của tối đa `window` giá trị liền trước trong cùng nhóm (không tính giá trị hiện tại).
+    values đã sắp xếp theo nhóm; group_start[i] là vị trí đầu nhóm của phần tử i. Trả về NaN khi thiếu lịch sử."""
+    positions = np.arange(len(values))[:, None] - 1 - np.arange(window)[None, :]
+    valid = positions >= group_start[:, None]
+    history = np.where(valid, values[np.clip(positions, 0, None)], np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # Dòng toàn NaN -> median NaN
+        median = np.nanmedian(history, axis=1)
+        mad = np.nanmedian(np.abs(history - median[:, None]), axis=1)
+    median[np.sum(~np.isnan(history), axis=1) < FUEL_ANOMALY_MIN_HISTORY] = np.nan
+    return median, mad
+
+def _robust_z_score(values, median, mad):
+    """|x - median| / độ phân tán; MAD được chặn dưới để chuỗi gần như không đổi không bị báo nhầm"""
+    scale = np.maximum(1.4826 * mad, 0.1 * np.abs(median))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (values - median) / np.where(scale > 0, scale, np.nan)
+
+def detect_fuel_anomalies(db: Session, from_date: date, to_date: date) -> dict:
+    """Phát hiện phiếu đổ dầu bất thường trong khoảng ngày, trả về {fuel_record_id: [lý do]}.
+    
+    Nạp phiếu đổ dầu và km chạy theo ngày của từng xe bằng một truy vấn, rồi tính trên mảng NumPy:
+    số lít mỗi lần đổ, số ngày giữa hai lần đổ, lít/km chạy từ lần đổ trước (so với lịch sử của chính xe đó)
+    và giá so với giá trung vị trong ngày của cả đội xe."""
+    rows = db.execute(text("""
+        SELECT 0 AS kind, id, UPPER(TRIM(license_plate)) AS plate, julianday(date) - 2451544.5 AS day,
+               liters_pumped AS amount, fuel_price_per_liter AS price
+        FROM fuel_records
+        WHERE date >= :history_from AND date <= :to_date AND TRIM(COALESCE(license_plate, '')) <> ''
+        UNION ALL
+        SELECT 1, 0, UPPER(TRIM(license_plate)), julianday(date) - 2451544.5, SUM(distance_km), 0
+        FROM daily_routes
+        WHERE date >= :history_from AND date <= :to_date AND TRIM(COALESCE(license_plate, '')) <> ''
+        GROUP BY UPPER(TRIM(license_plate)), date
+    """), {
+        "history_from": (from_date - timedelta(days=FUEL_ANOMALY_LOOKBACK_DAYS)).strftime("%Y-%m-%d"),
+        "to_date": to_date.strftime("%Y-%m-%d"),
+    }).all()
+    if not rows:
+        return {}
+    
+    kind = np.array([row[0] for row in rows], dtype=np.int8)
+    record_ids = np.array([row[1] for row in rows], dtype=np.int64)
+    _, plate_codes = np.unique([row[2] for row in rows], return_inverse=True)
+    days = np.array([row[3] for row in rows], dtype=float)
+    amounts = np.array([row[4] or 0 for row in rows], dtype=float)
+    prices = np.array([row[5] or 0 for row in rows], dtype=float)
+    # Khóa ghép (xe, ngày) để tra km lũy kế của mọi xe bằng một lần searchsorted
+    keys = plate_codes * 100000.0 + days
+    
+    # Km lũy kế theo khóa (xe, ngày)
+    trips = kind == 1
+    trip_order = np.argsort(keys[trips], kind="stable")
+    trip_keys = keys[trips][trip_order]
+    trip_km_cumsum = np.concatenate(([0.0], np.cumsum(amounts[trips][trip_order])))
+    
+    # Phiếu đổ dầu sắp xếp theo xe rồi theo ngày
+    fuel = kind == 0
+    order = np.lexsort((record_ids[fuel], days[fuel], plate_codes[fuel]))
+    ids = record_ids[fuel][order]
+    codes = plate_codes[fuel][order]
+    fill_days = days[fuel][order]
+    liters = amounts[fuel][order]
+    fill_prices = prices[fuel][order]
+    fill_keys = keys[fuel][order]
+    group_start = np.searchsorted(codes, codes, side="left")
+    has_previous = np.arange(len(ids)) > group_start
+    previous = np.maximum(np.arange(len(ids)) - 1, 0)
+    
+    # Khoảng cách (ngày) và km đã chạy kể từ lần đổ trước của cùng xe
+    interval = np.where(has_previous, fill_days - fill_days[previous], np.nan)
+    km_at = trip_km_cumsum[np.searchsorted(trip_keys, fill_keys, side="right")]
+    km_since_previous = np.where(has_previous, km_at - km_at[previous], np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        liters_per_km = np.where(km_since_previous > 0, liters / km_since_previous, np.nan)
+    
+    liters_median, liters_mad = _trailing_baseline(liters, group_start, FUEL_ANOMALY_WINDOW)
+    interval_median, interval_mad = _trailing_baseline(interval, group_start, FUEL_ANOMALY_WINDOW)
+    rate_median, rate_mad = _trailing_baseline(liters_per_km, group_start, FUEL_ANOMALY_WINDOW)
+    liters_z = _robust_z_score(liters, liters_median, liters_mad)
+    interval_z = _robust_z_score(interval, interval_median, interval_mad)
+    rate_z = _robust_z_score(liters_per_km, rate_median, rate_mad)
+    
+    # Giá trung vị trong ngày của cả đội xe (chỉ so khi ngày có từ 2 phiếu có giá)
+    priced = fill_prices > 0
+    day_values, day_index, day_counts = np.unique(fill_days[priced], return_inverse=True, return_counts=True)
+    day_median = np.full(len(day_values), np.nan)
+    if len(day_values):
+        price_order = np.lexsort((fill_prices[priced], day_index))
+        sorted_prices = fill_prices[priced][price_order]
+        day_first = np.concatenate(([0], np.cumsum(day_counts)[:-1]))
+        day_median = (sorted_prices[day_first + (day_counts - 1) // 2] + sorted_prices[day_first + day_counts // 2]) / 2
+        day_median[day_counts < 2] = np.nan
+    fleet_price = np.full(len(ids), np.nan)
+    fleet_price[priced] = day_median[day_index]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        price_deviation_pct = (fill_prices - fleet_price) / fleet_price * 100
+    
+    # Chỉ báo các phiếu trong khoảng cần kiểm tra (ngày tính từ 01/01/2000 như trong truy vấn)
+    in_range = (fill_days >= (from_date - date(2000, 1, 1)).days) & (fill_days <= (to_date - date(2000, 1, 1)).days)
+    flags = {
+        "liters": in_range & (np.abs(liters_z) > FUEL_ANOMALY_Z_SCORE),
+        "interval": in_range & (interval_z < -FUEL_ANOMALY_Z_SCORE),
+        "rate": in_range & (np.abs(rate_z) > FUEL_ANOMALY_Z_SCORE),
+        "price": in_range & (np.abs(price_deviation_pct) > FUEL_PRICE_DEVIATION_PCT),
+    }
+    
+    anomalies = {}
+    for index in np.flatnonzero(flags["liters"] | flags["interval"] | flags["rate"] | flags["price"]):
+        reasons = []
+        if flags["liters"][index]:
+            reasons.append(f"Số lít bất thường: {liters[index]:,.1f} L (thường ~{liters_median[index]:,.1f} L)")
+        if flags["interval"][index]:
+            reasons.append(f"Đổ dầu dày bất thường: cách lần trước {interval[index]:.0f} ngày (thường ~{interval_median[index]:.0f} ngày)")
+        if flags["rate"][index]:
+            reasons.append(f"Tiêu hao {liters_per_km[index] * 100:,.1f} L/100km từ lần đổ trước (thường ~{rate_median[index] * 100:,.1f})")
+        if flags["price"][index]:
+            reasons.append(f"Giá {fill_prices[index]:,.0f} đ/L lệch {price_deviation_pct[index]:+.1f}% so với giá trung vị trong ngày ({fleet_price[index]:,.0f})")
+        anomalies[int(ids[index])] = reasons
+    return anomalies
+
+# ===== ĐƠN GIÁ TUYẾN THEO THỜI GIAN =====
+
+def get_route_rate(db: Session, route_id: int, on_date: date) -> Optional[RouteRate]:
+    """Mức đơn giá của tuyến có hiệu lực tại ngày"""
+    return db.query(RouteRate).filter(
+        RouteRate.route_id == route_id,
+        RouteRate.effective_from <= on_date
+    ).order_by(RouteRate.effective_from.desc()).first()
+
+def set_route_rate(db: Session, route_id: int, effective_from: date, monthly_salary: float, km_rate: Optional[float]):
+    """Thêm (hoặc sửa nếu trùng ngày hiệu lực) mức đơn giá áp dụng từ effective_from. Chưa commit."""
+    rate = db.query(RouteRate).filter(
+        RouteRate.route_id == route_id,
+        RouteRate.effective_from == effective_from
+    ).first()
+    if not rate:
+        rate = RouteRate(route_id=route_id, effective_from=effective_from)
+        db.add(rate)
+    rate.monthly_salary = monthly_salary
+    rate.km_rate = km_rate
+    return rate
+
+# ===== QUY TẮC TÍNH LƯƠNG =====
+
+ROUTE_TYPE_LABELS = {
+    "standard": "Tuyến thường",
+    "tang_cuong": "Tăng Cường",
+}
+
+SALARY_RULE_TYPE_LABELS = {
+    "per_trip": "Cố định mỗi chuyến",
+    "per_km": "Theo km (số km × đơn giá/km)",
+    "monthly": "Lương tuyến/tháng ÷ số ngày",
+    "minimum": "Lương chuyến tối thiểu",
+    "bonus": "Thưởng mỗi chuyến (theo km tối thiểu)",
+}
+
+# Quy tắc đã biên dịch: route_type -> (các hàm cộng dồn, mức tối thiểu, các hàm thưởng).
+# None = cần biên dịch lại (khi bảng salary_rules thay đổi)
+# Quy tắc đã biên dịch kèm mốc thay đổi của salary_rules trong data_versions lúc dựng;
+# mốc khác (kể cả sửa từ process khác) -> biên dịch lại
+_compiled_salary_rules = {"version": None, "rules": None}
+
+def _compile_salary_rule(rule_type: str, amount: Optional[float], min_km: Optional[float]):
+    """Biên dịch một quy tắc thành hàm mảng f(monthly_salary, km_rate, distance_km) -> lương"""
+    if rule_type == "per_trip":
+        return lambda monthly_salary, km_rate, distance_km: np.full(distance_km.shape, amount or 0.0)
+    if rule_type == "per_km":
+        # Để trống đơn giá -> dùng đơn giá/km có hiệu lực của tuyến
+        return lambda monthly_salary, km_rate, distance_km: np.where(
+            distance_km > 0, distance_km * (km_rate if amount is None else amount), 0.0
+        )
+    if rule_type == "monthly":
+        divisor = amount or 30
+        return lambda monthly_salary, km_rate, distance_km: np.where(monthly_salary > 0, monthly_salary / divisor, 0.0)
+    if rule_type == "bonus":
+        threshold = min_km or 0
+        return lambda monthly_salary, km_rate, distance_km: np.where(distance_km >= threshold, amount or 0.0, 0.0)
+    raise ValueError(f"Loại quy tắc không hợp lệ: {rule_type}")
+
+def get_compiled_salary_rules(db: Session) -> dict:
+    """Đọc các quy tắc đang áp dụng bằng một truy vấn và biên dịch một lần, giữ trong bộ nhớ đến khi quy tắc đổi"""
+    # Đọc mốc trước quy tắc: sửa xảy ra trong lúc biên dịch sẽ làm mốc lệch và lần sau biên dịch lại
+    version = get_data_versions(db, ["table:salary_rules"]).get("table:salary_rules", 0)
+    if _compiled_salary_rules["version"] != version:
+        compiled = {}
+        for rule_type, route_type, amount, min_km in db.query(
+            SalaryRule.rule_type, SalaryRule.route_type, SalaryRule.amount, SalaryRule.min_km
+        ).filter(SalaryRule.is_active == 1).order_by(SalaryRule.id).all():
+            additive, minimum, bonuses = compiled.setdefault(route_type, ([], [0.0], []))
+            if rule_type == "minimum":
+                minimum[0] = max(minimum[0], amount or 0.0)
+            elif rule_type == "bonus":
+                bonuses.append(_compile_salary_rule(rule_type, amount, min_km))
+            else:
+                additive.append(_compile_salary_rule(rule_type, amount, min_km))
+        _compiled_salary_rules["rules"] = {
+            route_type: (additive, minimum[0], bonuses)
+            for route_type, (additive, minimum, bonuses) in compiled.items()
+        }
+        _compiled_salary_rules["version"] = version
+    return _compiled_salary_rules["rules"]
+
+def evaluate_salary_rules(rules: dict, route_types, monthly_salary, km_rate, distance_km):
+    """Tính lương cho cả mảng chuyến: mỗi loại tuyến chạy các hàm đã biên dịch trên phần mảng của nó.
+    Loại tuyến không có quy tắc nào -> lương 0."""
+    salary = np.zeros(len(route_types))
+    for route_type, (additive, minimum, bonuses) in rules.items():
+        rows = np.flatnonzero(route_types == route_type)
+        if not len(rows):
+            continue
+        args = (monthly_salary[rows], km_rate[rows], distance_km[rows])
+        trip_salary = np.zeros(len(rows))
+        for term in additive:
+            trip_salary += term(*args)
+        trip_salary = np.maximum(trip_salary, minimum)
+        for bonus in bonuses:
+            trip_salary += bonus(*args)
+        salary[rows] = trip_salary
+    return salary
+
+def _resolve_driver_name(db: Session, selected_employee: Optional[str]) -> Optional[str]:
+    """Bộ lọc nhân viên nhận ID hoặc tên -> tên lái xe (None = không lọc)"""
+    if not selected_employee or selected_employee == "all":
+        return None
+    try:
+        employee = db.query(Employee).filter(Employee.id == int(selected_employee), Employee.status == 1).first()
+        return employee.name if employee else None
+    except ValueError:
+        return selected_employee
+
+def get_salary_data(db: Session, from_date: date, to_date: date,
+                    selected_employee: Optional[str] = None, selected_route: Optional[str] = None) -> list:
+    """Danh sách chuyến có lái xe trong khoảng ngày kèm lương chuyến.
+    Một truy vấn lấy chuyến + đơn giá có hiệu lực tại ngày chạy (as-of join route_rates)
+    + biển số các chuyến cùng lái xe/tuyến/ngày, sau đó tính lương bằng quy tắc đã biên dịch."""
+    conditions = ["dr.date >= :from_date", "dr.date <= :to_date",
+                  "dr.driver_name IS NOT NULL", "dr.driver_name != ''"]
+    params = {
+        "from_date": from_date.strftime("%Y-%m-%d"),
+        "to_date": to_date.strftime("%Y-%m-%d"),
+        "tang_cuong": TANG_CUONG_ROUTE_CODE,
+        "default_km_rate": TANG_CUONG_KM_RATE,
+    }
+    
+    # Filter theo nhân viên (ID hoặc tên) và mã tuyến
+    driver_name = _resolve_driver_name(db, selected_employee)
+    if driver_name:
+        conditions.append("dr.driver_name = :driver_name")
+        params["driver_name"] = driver_name
+    if selected_route and selected_route != "all":
+        conditions.append("r.route_code = :route_code")
+        params["route_code"] = selected_route
+    
+    rows = db.execute(text(f"""
+        SELECT dr.id, dr.driver_name, r.route_code, r.route_name, dr.date,
+               COALESCE(dr.distance_km, 0) AS distance_km,
+               CASE WHEN TRIM(r.route_code) = :tang_cuong THEN 'tang_cuong' ELSE 'standard' END AS route_type,
+               CASE WHEN rr.id IS NULL THEN r.monthly_salary ELSE rr.monthly_salary END AS monthly_salary,
+               CASE WHEN rr.id IS NULL THEN :default_km_rate ELSE rr.km_rate END AS km_rate,
+               plates.license_plates
+        FROM daily_routes dr
+        JOIN routes r ON r.id = dr.route_id
+        LEFT JOIN route_rates rr ON rr.id = (
+            SELECT r2.id FROM route_rates r2
+            WHERE r2.route_id = dr.route_id AND r2.effective_from <= dr.date
+            ORDER BY r2.effective_from DESC
+            LIMIT 1
+        )
+        LEFT JOIN (
+            SELECT driver_name, route_id, date, GROUP_CONCAT(DISTINCT license_plate) AS license_plates
+            FROM daily_routes
+            WHERE date >= :from_date AND date <= :to_date
+              AND license_plate IS NOT NULL AND license_plate != ''
+            GROUP BY driver_name, route_id, date
+        ) plates ON plates.driver_name = dr.driver_name AND plates.route_id = dr.route_id AND plates.date = dr.date
+        WHERE {" AND ".join(conditions)}
+        ORDER BY r.route_code, dr.date, dr.id
+    """), params).all()
+    if not rows:
+        return []
+    
+    route_types = np.array([row.route_type for row in rows], dtype=object)
+    monthly_salary = np.array([row.monthly_salary or 0 for row in rows], dtype=float)
+    km_rate = np.array([row.km_rate or 0 for row in rows], dtype=float)
+    distance_km = np.array([row.distance_km for row in rows], dtype=float)
+    salaries = evaluate_salary_rules(get_compiled_salary_rules(db), route_types, monthly_salary, km_rate, distance_km)
+    
+    salary_data = []
+    for row, daily_salary, trip_monthly_salary in zip(rows, salaries.tolist(), monthly_salary.tolist()):
+        # Biển số lấy từ các chuyến cùng: tên lái xe + tuyến + ngày chạy
+        license_plates = sorted(set(row.license_plates.split(","))) if row.license_plates else []
+        salary_data.append({
+            'id': row.id,
+            'driver_name': row.driver_name,
+            'route_code': row.route_code,
+            'route_name': row.route_name,
+            'date': date.fromisoformat(row.date),
+            'license_plate': ", ".join(license_plates) if license_plates else "Chưa cập nhật",
+            'daily_salary': daily_salary,
+            'monthly_salary': trip_monthly_salary,
+            'days_in_month': 30,  # Chuẩn hóa tháng 30 ngày
+            'salary_type': row.route_type,  # "standard" hoặc "tang_cuong"
+            'distance_km': row.distance_km  # Số km thực tế cho tuyến Tăng Cường
+        })
+    return salary_data
+
+@app.get("/salary-rules", response_class=HTMLResponse)
+async def salary_rules_page(request: Request, db: Session = Depends(get_db), error: Optional[str] = None):
+    """Trang cấu hình quy tắc tính lương theo loại tuyến"""
+    salary_rules = db.query(SalaryRule).order_by(SalaryRule.route_type, SalaryRule.id).all()
+    return templates.TemplateResponse("salary_rules.html", {
+        "request": request,
+        "salary_rules": salary_rules,
+        "route_type_labels": ROUTE_TYPE_LABELS,
+        "rule_type_labels": SALARY_RULE_TYPE_LABELS,
+        "error": error
+    })
+
+@app.post("/salary-rules/add")
+async def add_salary_rule(
+    route_type: str = Form(...),
+    rule_type: str = Form(...),
+    amount: Optional[float] = Form(None),
+    min_km: Optional[float] = Form(None),
+    notes: str = Form(""),
+    db: Session = Depends(get_db)
+):
+    """Thêm quy tắc lương, áp dụng ngay cho mọi lần tính lương sau đó"""
+    if route_type not in ROUTE_TYPE_LABELS or rule_type not in SALARY_RULE_TYPE_LABELS:
+        return RedirectResponse(url=f"/salary-rules?error={quote('Loại tuyến hoặc loại quy tắc không hợp lệ')}", status_code=303)
+    if amount is None and rule_type not in ("per_km", "monthly"):
+        return RedirectResponse(url=f"/salary-rules?error={quote('Vui lòng nhập số tiền')}", status_code=303)
+    if (amount is not None and amount < 0) or (rule_type == "monthly" and amount == 0):
+        return RedirectResponse(url=f"/salary-rules?error={quote('Giá trị không hợp lệ')}", status_code=303)
+    
+    db.add(SalaryRule(route_type=route_type, rule_type=rule_type, amount=amount, min_km=min_km, notes=notes))
+    db.commit()
+    return RedirectResponse(url="/salary-rules", status_code=303)
+
+@app.post("/salary-rules/toggle/{rule_id}")
+async def toggle_salary_rule(rule_id: int, db: Session = Depends(get_db)):
+    """Bật/tắt quy tắc mà không cần xóa"""
+    salary_rule = db.query(SalaryRule).filter(SalaryRule.id == rule_id).first()
+    if salary_rule:
+        salary_rule.is_active = 0 if salary_rule.is_active else 1
         db.commit()
-        
-        # Tạo response chi tiết
-        response_data = {
-            "success": True,
-            "imported_count": imported_count,
-            "skipped_count": skipped_count,
-            "total_errors": len(errors),
-            "summary": {
-                "total_rows_processed": ws.max_row - 4,  # Trừ header
-                "successful_imports": imported_count,
-                "failed_imports": skipped_count,
-                "success_rate": f"{(imported_count / max(1, ws.max_row - 4)) * 100:.1f}%" if ws.max_row > 4 else "0%"
-            }
+    return RedirectResponse(url="/salary-rules", status_code=303)
+
+@app.post("/salary-rules/delete/{rule_id}")
+async def delete_salary_rule(rule_id: int, db: Session = Depends(get_db)):
+    salary_rule = db.query(SalaryRule).filter(SalaryRule.id == rule_id).first()
+    if salary_rule:
+        db.delete(salary_rule)
+        db.commit()
+    return RedirectResponse(url="/salary-rules", status_code=303)
+
+# ===== CHỐT LƯƠNG THÁNG =====
+
+def compute_payroll_checksum(trip_lines: list) -> str:
+    """SHA-256 trên nội dung các dòng lương chuyến (đã sắp xếp), dùng để kiểm tra bảng chốt không bị sửa"""
+    import json
+    import hashlib
+    canonical = sorted(
+        [
+            line['daily_route_id'], line['driver_name'], line['route_code'], line['date'].isoformat(),
+            line['license_plate'], round(line['distance_km'], 3), line['salary_type'],
+            round(line['monthly_salary'], 2), round(line['daily_salary'], 2)
+        ]
+        for line in trip_lines
+    )
+    return hashlib.sha256(json.dumps(canonical, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def get_payroll_period(db: Session, year: int, month: int) -> Optional[PayrollPeriod]:
+    return db.query(PayrollPeriod).filter(PayrollPeriod.month == f"{year}-{month:02d}").first()
+
+def close_payroll_month(db: Session, year: int, month: int) -> PayrollPeriod:
+    """Tính lương tháng một lần và ghi vào bảng chốt (từng chuyến + tổng theo lái xe) kèm checksum"""
+    import calendar
+    from_date = date(year, month, 1)
+    to_date = date(year, month, calendar.monthrange(year, month)[1])
+    salary_data = get_salary_data(db, from_date, to_date)
+    
+    trip_lines = [
+        {
+            'daily_route_id': item['id'],
+            'driver_name': item['driver_name'],
+            'route_code': item['route_code'],
+            'route_name': item['route_name'],
+            'date': item['date'],
+            'license_plate': item['license_plate'],
+            'distance_km': item['distance_km'],
+            'salary_type': item['salary_type'],
+            'monthly_salary': item['monthly_salary'],
+            'daily_salary': item['daily_salary'],
         }
-        
-        if errors:
-            response_data["errors"] = errors[:20]  # Hiển thị 20 lỗi đầu tiên
-            if len(errors) > 20:
-                response_data["has_more_errors"] = True
-                response_data["remaining_errors"] = len(errors) - 20
-            response_data["error_summary"] = {
-                "validation_errors": len([e for e in errors if any(err.get("column") != "Tổng hợp" for err in e.get("errors", []))]),
-                "duplicate_errors": len([e for e in errors if any("trùng lặp" in err.get("error", "") for err in e.get("errors", []))]),
-                "technical_errors": len([e for e in errors if any("Lỗi xử lý" in err.get("error", "") for err in e.get("errors", []))])
-            }
-        
-        return JSONResponse(content=response_data)
-        
+        for item in salary_data
+    ]
+    driver_totals = {}
+    for line in trip_lines:
+        totals = driver_totals.setdefault(line['driver_name'], {
+            'driver_name': line['driver_name'], 'trip_count': 0, 'distance_km': 0.0,
+            'standard_salary': 0.0, 'tang_cuong_salary': 0.0, 'total_salary': 0.0
+        })
+        totals['trip_count'] += 1
+        totals['distance_km'] += line['distance_km']
+        totals[f"{line['salary_type']}_salary"] += line['daily_salary']
+        totals['total_salary'] += line['daily_salary']
+    
+    period = PayrollPeriod(
+        month=f"{year}-{month:02d}",
+        trip_count=len(trip_lines),
+        total_salary=sum(line['daily_salary'] for line in trip_lines),
+        checksum=compute_payroll_checksum(trip_lines)
+    )
+    db.add(period)
+    db.flush()
+    if trip_lines:
+        db.execute(PayrollTripLine.__table__.insert(), [dict(line, period_id=period.id) for line in trip_lines])
+    if driver_totals:
+        db.execute(PayrollDriverLine.__table__.insert(), [dict(totals, period_id=period.id) for totals in driver_totals.values()])
+    db.commit()
+    return period
+
+def get_payroll_trip_lines(db: Session, period: PayrollPeriod, driver_name: Optional[str] = None,
+                           route_code: Optional[str] = None) -> list:
+    """Dòng lương chuyến của tháng đã chốt, cùng định dạng với get_salary_data"""
+    query = db.query(PayrollTripLine).filter(PayrollTripLine.period_id == period.id)
+    if driver_name:
+        query = query.filter(PayrollTripLine.driver_name == driver_name)
+    if route_code:
+        query = query.filter(PayrollTripLine.route_code == route_code)
+    return [
+        {
+            'id': line.daily_route_id,
+            'driver_name': line.driver_name,
+            'route_code': line.route_code,
+            'route_name': line.route_name,
+            'date': line.date,
+            'license_plate': line.license_plate,
+            'daily_salary': line.daily_salary,
+            'monthly_salary': line.monthly_salary,
+            'days_in_month': 30,
+            'salary_type': line.salary_type,
+            'distance_km': line.distance_km
+        }
+        for line in query.order_by(PayrollTripLine.route_code, PayrollTripLine.date, PayrollTripLine.daily_route_id).all()
+    ]
+
+def get_month_salary_data(db: Session, year: int, month: int, selected_employee: Optional[str] = None,
+                          selected_route: Optional[str] = None) -> tuple:
+    """Lương tháng: tháng đã chốt đọc từ bảng chốt, tháng chưa chốt tính trực tiếp từ chuyến.
+    Trả về (salary_data, payroll_period hoặc None)."""
+    import calendar
+    period = get_payroll_period(db, year, month)
+    if period:
+        route_code = selected_route if selected_route and selected_route != "all" else None
+        return get_payroll_trip_lines(db, period, _resolve_driver_name(db, selected_employee), route_code), period
+    from_date = date(year, month, 1)
+    to_date = date(year, month, calendar.monthrange(year, month)[1])
+    return get_salary_data(db, from_date, to_date, selected_employee, selected_route), None
+
+def _parse_payroll_month(selected_month: str) -> Optional[tuple]:
+    try:
+        year, month = map(int, selected_month.split('-'))
+        date(year, month, 1)
+        return year, month
+    except ValueError:
+        return None
+
+@app.post("/salary-calculation/close-month")
+async def close_payroll_month_route(selected_month: str = Form(...), db: Session = Depends(get_db)):
+    """Chốt lương tháng (chỉ tháng đã kết thúc)"""
+    import calendar
+    parsed = _parse_payroll_month(selected_month)
+    if not parsed:
+        return RedirectResponse(url=f"/salary-calculation?error={quote('Tháng không hợp lệ')}", status_code=303)
+    year, month = parsed
+    redirect_url = f"/salary-calculation?selected_month={year}-{month:02d}"
+    if date(year, month, calendar.monthrange(year, month)[1]) >= date.today():
+        return RedirectResponse(url=f"{redirect_url}&error={quote('Chỉ chốt được tháng đã kết thúc')}", status_code=303)
+    if get_payroll_period(db, year, month):
+        return RedirectResponse(url=f"{redirect_url}&error={quote('Tháng này đã được chốt')}", status_code=303)
+    try:
+        close_payroll_month(db, year, month)
     except Exception as e:
         db.rollback()
-        return JSONResponse(
-            status_code=500,
-            content={
-                "success": False, 
-                "error": "Lỗi hệ thống",
-                "error_type": "system_error",
-                "details": f"Lỗi kỹ thuật: {str(e)}",
-                "suggestion": "Vui lòng thử lại hoặc liên hệ quản trị viên nếu lỗi vẫn tiếp tục"
+        return RedirectResponse(url=f"{redirect_url}&error={quote(f'Không chốt được lương: {str(e)}')}", status_code=303)
+    return RedirectResponse(url=redirect_url, status_code=303)
+
+@app.post("/salary-calculation/reopen-month")
+async def reopen_payroll_month_route(selected_month: str = Form(...), db: Session = Depends(get_db)):
+    """Hủy chốt: xóa bảng chốt để tháng được tính lại từ chuyến"""
+    parsed = _parse_payroll_month(selected_month)
+    if not parsed:
+        return RedirectResponse(url=f"/salary-calculation?error={quote('Tháng không hợp lệ')}", status_code=303)
+    year, month = parsed
+    period = get_payroll_period(db, year, month)
+    if period:
+        db.execute(delete(PayrollTripLine).where(PayrollTripLine.period_id == period.id))
+        db.execute(delete(PayrollDriverLine).where(PayrollDriverLine.period_id == period.id))
+        db.delete(period)
+        db.commit()
+    return RedirectResponse(url=f"/salary-calculation?selected_month={year}-{month:02d}", status_code=303)
+
+@app.get("/api/payroll/{selected_month}")
+async def get_payroll_api(selected_month: str, db: Session = Depends(get_db)):
+    """Bảng chốt lương tháng: tổng theo lái xe và kết quả kiểm tra checksum"""
+    parsed = _parse_payroll_month(selected_month)
+    if not parsed:
+        return JSONResponse({"success": False, "message": "Tháng không hợp lệ"}, status_code=400)
+    period = get_payroll_period(db, *parsed)
+    if not period:
+        return JSONResponse({"success": False, "message": "Tháng chưa được chốt lương"}, status_code=404)
+    trip_lines = [
+        {
+            'daily_route_id': line.daily_route_id, 'driver_name': line.driver_name, 'route_code': line.route_code,
+            'date': line.date, 'license_plate': line.license_plate, 'distance_km': line.distance_km,
+            'salary_type': line.salary_type, 'monthly_salary': line.monthly_salary, 'daily_salary': line.daily_salary
+        }
+        for line in db.query(PayrollTripLine).filter(PayrollTripLine.period_id == period.id).all()
+    ]
+    drivers = db.query(PayrollDriverLine).filter(
+        PayrollDriverLine.period_id == period.id
+    ).order_by(PayrollDriverLine.driver_name).all()
+    return {
+        "success": True,
+        "month": period.month,
+        "closed_at": period.closed_at.isoformat() if period.closed_at else None,
+        "trip_count": period.trip_count,
+        "total_salary": period.total_salary,
+        "checksum": period.checksum,
+        "checksum_valid": compute_payroll_checksum(trip_lines) == period.checksum,
+        "drivers": [
+            {
+                "driver_name": driver.driver_name,
+                "trip_count": driver.trip_count,
+                "distance_km": driver.distance_km,
+                "standard_salary": driver.standard_salary,
+                "tang_cuong_salary": driver.tang_cuong_salary,
+                "total_salary": driver.total_salary
             }
+            for driver in drivers
+        ]
+    }
+
+# ===== MA TRẬN LÁI XE × NGÀY / TUYẾN =====
+
+PIVOT_DIMENSION_LABELS = {
+    "day": "Ngày trong tháng",
+    "route": "Mã tuyến",
+}
+
+PIVOT_MEASURE_LABELS = {
+    "trips": "Số chuyến",
+    "salary": "Lương chuyến (VNĐ)",
+    "km": "Số km",
+}
+
+def build_salary_pivot(db: Session, year: int, month: int, dimension: str = "day", measure: str = "trips") -> dict:
+    """Ma trận lái xe (dòng) × ngày hoặc mã tuyến (cột) cho một tháng.
+    Dữ liệu lấy một lần (bảng chốt hoặc get_salary_data), ô được cộng dồn bằng np.bincount
+    trên chỉ số phẳng dòng*số_cột + cột thay vì gom nhóm trong template."""
+    import calendar
+    salary_data, period = get_month_salary_data(db, year, month)
+    
+    if dimension == "route":
+        columns, column_index = np.unique(
+            np.array([item['route_code'] or "" for item in salary_data], dtype=str), return_inverse=True
         )
+        columns = columns.tolist()
+    else:
+        columns = list(range(1, calendar.monthrange(year, month)[1] + 1))
+        column_index = np.array([item['date'].day - 1 for item in salary_data], dtype=np.int64)
+    drivers, driver_index = np.unique(
+        np.array([item['driver_name'] for item in salary_data], dtype=str), return_inverse=True
+    )
+    
+    if measure == "salary":
+        weights = np.array([item['daily_salary'] for item in salary_data], dtype=float)
+    elif measure == "km":
+        weights = np.array([item['distance_km'] for item in salary_data], dtype=float)
+    else:
+        weights = None  # Đếm số chuyến
+    
+    n_rows, n_columns = len(drivers), len(columns)
+    matrix = np.bincount(
+        driver_index.astype(np.int64) * n_columns + column_index.astype(np.int64),
+        weights=weights, minlength=n_rows * n_columns
+    ).astype(float).reshape(n_rows, n_columns)
+    
+    return {
+        "drivers": drivers.tolist(),
+        "columns": columns,
+        "matrix": matrix,
+        "row_totals": matrix.sum(axis=1),
+        "column_totals": matrix.sum(axis=0),
+        "total": float(matrix.sum()),
+        "is_closed": period is not None,
+    }
 
-@app.get("/fuel/export-excel")
-async def export_fuel_excel(
+def _parse_pivot_params(selected_month: Optional[str], dimension: str, measure: str) -> tuple:
+    today = date.today()
+    year, month = (_parse_payroll_month(selected_month) if selected_month else None) or (today.year, today.month)
+    dimension = dimension if dimension in PIVOT_DIMENSION_LABELS else "day"
+    measure = measure if measure in PIVOT_MEASURE_LABELS else "trips"
+    return year, month, dimension, measure
+
+@app.get("/salary-matrix", response_class=HTMLResponse)
+async def salary_matrix_page(
+    request: Request,
     db: Session = Depends(get_db),
-    from_date: Optional[str] = None,
-    to_date: Optional[str] = None
+    selected_month: Optional[str] = None,
+    dimension: str = "day",
+    measure: str = "trips"
 ):
-    """Redirect đến fuel-report export"""
-    from fastapi.responses import RedirectResponse
-    params = []
-    if from_date:
-        params.append(f"from_date={from_date}")
-    if to_date:
-        params.append(f"to_date={to_date}")
+    """Trang ma trận lái xe × ngày / lái xe × tuyến"""
+    year, month, dimension, measure = _parse_pivot_params(selected_month, dimension, measure)
+    pivot = build_salary_pivot(db, year, month, dimension, measure)
+    return templates.TemplateResponse("salary_matrix.html", {
+        "request": request,
+        "pivot": pivot,
+        "rows": list(zip(pivot["drivers"], pivot["matrix"].tolist(), pivot["row_totals"].tolist())),
+        "column_totals": pivot["column_totals"].tolist(),
+        "selected_month": f"{year}-{month:02d}",
+        "selected_month_display": f"{month}/{year}",
+        "dimension": dimension,
+        "measure": measure,
+        "dimension_labels": PIVOT_DIMENSION_LABELS,
+        "measure_labels": PIVOT_MEASURE_LABELS,
+        "value_format": "{:,.0f}" if measure != "km" else "{:,.1f}"
+    })
+
+@app.get("/api/salary-matrix")
+async def salary_matrix_api(
+    db: Session = Depends(get_db),
+    selected_month: Optional[str] = None,
+    dimension: str = "day",
+    measure: str = "trips"
+):
+    year, month, dimension, measure = _parse_pivot_params(selected_month, dimension, measure)
+    pivot = build_salary_pivot(db, year, month, dimension, measure)
+    return {
+        "month": f"{year}-{month:02d}",
+        "dimension": dimension,
+        "measure": measure,
+        "is_closed": pivot["is_closed"],
+        "drivers": pivot["drivers"],
+        "columns": pivot["columns"],
+        "matrix": pivot["matrix"].tolist(),
+        "row_totals": pivot["row_totals"].tolist(),
+        "column_totals": pivot["column_totals"].tolist(),
+        "total": pivot["total"]
+    }
+
+@app.get("/salary-matrix/export-excel")
+async def export_salary_matrix_excel(
+    db: Session = Depends(get_db),
+    selected_month: Optional[str] = None,
+    dimension: str = "day",
+    measure: str = "trips"
+):
+    """Xuất Excel ma trận lái xe × ngày / tuyến"""
+    year, month, dimension, measure = _parse_pivot_params(selected_month, dimension, measure)
+    pivot = build_salary_pivot(db, year, month, dimension, measure)
+    columns = pivot["columns"]
+    last_col = len(columns) + 3
+    number_format = '#,##0.0' if measure == "km" else '#,##0'
     
-    url = "/fuel-report/export-excel"
-    if params:
-        url += "?" + "&".join(params)
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Ma trận"
+    
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+    header_alignment = Alignment(horizontal="center", vertical="center")
+    
+    ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=last_col)
+    ws['A1'] = f"{PIVOT_MEASURE_LABELS[measure].upper()} THEO LÁI XE × {PIVOT_DIMENSION_LABELS[dimension].upper()}"
+    ws['A1'].font = Font(bold=True, size=16)
+    ws['A1'].alignment = Alignment(horizontal="center")
+    ws.merge_cells(start_row=2, start_column=1, end_row=2, end_column=last_col)
+    ws['A2'] = f"Tháng: {month}/{year}" + (" (đã chốt)" if pivot["is_closed"] else "")
+    ws['A2'].alignment = Alignment(horizontal="center")
+    ws['A2'].font = Font(italic=True)
+    
+    headers = ["STT", "Họ và tên lái xe"] + [str(column) for column in columns] + ["Tổng"]
+    for col, header in enumerate(headers, 1):
+        cell = ws.cell(row=4, column=col, value=header)
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = header_alignment
+    
+    row = 5
+    for stt, (driver_name, values, row_total) in enumerate(
+        zip(pivot["drivers"], pivot["matrix"].tolist(), pivot["row_totals"].tolist()), 1
+    ):
+        ws.cell(row=row, column=1, value=stt)
+        ws.cell(row=row, column=2, value=driver_name)
+        for col, value in enumerate(values, 3):
+            if value:
+                ws.cell(row=row, column=col, value=value).number_format = number_format
+        ws.cell(row=row, column=last_col, value=row_total).number_format = number_format
+        ws.cell(row=row, column=last_col).font = Font(bold=True)
+        row += 1
+    
+    ws.cell(row=row, column=1, value="TỔNG CỘNG").font = Font(bold=True)
+    for col, value in enumerate(pivot["column_totals"].tolist() + [pivot["total"]], 3):
+        ws.cell(row=row, column=col, value=value).font = Font(bold=True)
+        ws.cell(row=row, column=col).number_format = number_format
+    
+    ws.column_dimensions['A'].width = 8
+    ws.column_dimensions['B'].width = 25
+    for col in range(3, last_col + 1):
+        ws.column_dimensions[get_column_letter(col)].width = 6 if dimension == "day" and measure == "trips" else 14
+    ws.freeze_panes = "C5"
+    
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    
+    filename = f"MaTran_{'Ngay' if dimension == 'day' else 'Tuyen'}_{month:02d}_{year}.xlsx"
+    
+    return Response(
+        content=output.getvalue(),
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
+    )
+
+# ===== LỢI NHUẬN THEO TUYẾN =====
+
+UNALLOCATED_ROUTE_LABEL = "Chung (chưa gắn tuyến)"  # Thu/chi không khớp mã tuyến, dầu của xe không chạy tuyến nào
+
+# Chuyến/thu chi/đổ dầu chỉ làm cũ tháng của chúng; các bảng dưới đây ảnh hưởng mọi tháng.
+# Mốc tính của từng tháng lưu trong rollup_states nên mọi worker (và lần khởi động sau) dùng chung.
+ROUTE_PROFIT_GLOBAL_TABLES = ("routes", "vehicles", "route_rates", "salary_rules", "payroll_periods")
+
+def _compute_route_profit(db: Session, from_date: date, to_date: date) -> dict:
+    """Thu, chi, chi phí dầu phân bổ theo tuyến/tháng bằng một truy vấn tập hợp.
+    Dầu của mỗi xe trong tháng chia cho các tuyến xe đó chạy theo tỷ lệ km
+    (xe chưa ghi km thì theo tỷ lệ số chuyến). Trả về {(month, route_code): {measure: value}}."""
+    rows = db.execute(text("""
+        WITH trips AS (
+            SELECT substr(dr.date, 1, 7) AS month, r.route_code,
+                   UPPER(TRIM(COALESCE(NULLIF(TRIM(dr.license_plate), ''), v.license_plate))) AS plate,
+                   COALESCE(dr.distance_km, 0) AS km
+            FROM daily_routes dr
+            JOIN routes r ON r.id = dr.route_id
+            LEFT JOIN vehicles v ON v.id = r.vehicle_id
+            WHERE dr.date >= :from_date AND dr.date <= :to_date
+        ),
+        plate_routes AS (
+            SELECT month, plate, route_code, COUNT(*) AS trips, SUM(km) AS km,
+                   SUM(COUNT(*)) OVER (PARTITION BY month, plate) AS plate_trips,
+                   SUM(SUM(km)) OVER (PARTITION BY month, plate) AS plate_km
+            FROM trips
+            WHERE plate IS NOT NULL AND plate != ''
+            GROUP BY month, plate, route_code
+        ),
+        fuel AS (
+            SELECT substr(date, 1, 7) AS month, UPPER(TRIM(license_plate)) AS plate, SUM(COALESCE(cost_pumped, 0)) AS cost
+            FROM fuel_records
+            WHERE date >= :from_date AND date <= :to_date
+            GROUP BY 1, 2
+        ),
+        route_codes AS (
+            SELECT UPPER(TRIM(route_code)) AS route_key, MIN(route_code) AS route_code
+            FROM routes GROUP BY 1
+        )
+        SELECT month, route_code, 'trip_count' AS measure, COUNT(*) AS value FROM trips GROUP BY 1, 2
+        UNION ALL
+        SELECT month, route_code, 'distance_km', SUM(km) FROM trips GROUP BY 1, 2
+        UNION ALL
+        SELECT substr(ft.date, 1, 7), COALESCE(rc.route_code, ''),
+               CASE WHEN ft.transaction_type = 'Thu' THEN 'revenue' ELSE 'direct_cost' END,
+               SUM(COALESCE(ft.total, 0))
+        FROM finance_transactions ft
+        LEFT JOIN route_codes rc ON rc.route_key = UPPER(TRIM(ft.route_code))
+        WHERE ft.date >= :from_date AND ft.date <= :to_date AND ft.transaction_type IN ('Thu', 'Chi')
+        GROUP BY 1, 2, 3
+        UNION ALL
+        SELECT pr.month, pr.route_code, 'fuel_cost',
+               SUM(f.cost * CASE WHEN pr.plate_km > 0 THEN pr.km / pr.plate_km ELSE pr.trips * 1.0 / pr.plate_trips END)
+        FROM plate_routes pr
+        JOIN fuel f ON f.month = pr.month AND f.plate = pr.plate
+        GROUP BY 1, 2
+        UNION ALL
+        SELECT f.month, '', 'fuel_cost', SUM(f.cost)
+        FROM fuel f
+        WHERE NOT EXISTS (SELECT 1 FROM plate_routes pr WHERE pr.month = f.month AND pr.plate = f.plate)
+        GROUP BY 1
+    """), {"from_date": from_date.strftime("%Y-%m-%d"), "to_date": to_date.strftime("%Y-%m-%d")}).all()
+    
+    result = {}
+    for month, route_code, measure, value in rows:
+        result.setdefault((month, route_code or ""), {})[measure] = value or 0
+    return result
+
+def refresh_route_profit(db: Session, year: int, months: list):
+    """Tính lại các tháng cho bảng route_profit_rollups (xóa dòng cũ của tháng rồi ghi lại).
+    Lương lấy theo bảng tính lương (bảng chốt nếu tháng đã chốt) cộng theo mã tuyến."""
+    # Đọc mốc trước khi tính: thay đổi xen vào lúc đang tính sẽ làm tháng cũ đi ở lần đọc sau
+    source_version = current_data_version(db)
+    computed = _compute_route_profit(
+        db, _month_date_range(min(months), year)[0], _month_date_range(max(months), year)[1]
+    )
+    for month in months:
+        salary_data, _ = get_month_salary_data(db, year, month)
+        for item in salary_data:
+            measures = computed.setdefault((f"{year}-{month:02d}", item['route_code'] or ""), {})
+            measures['salary_cost'] = measures.get('salary_cost', 0) + item['daily_salary']
+    
+    month_keys = [f"{year}-{month:02d}" for month in months]
+    refreshed_at = datetime.utcnow()
+    db.execute(delete(RouteProfitRollup).where(RouteProfitRollup.month.in_(month_keys)))
+    rows = []
+    for (month_key, route_code), measures in computed.items():
+        if month_key not in month_keys:
+            continue
+        revenue = measures.get('revenue', 0)
+        costs = measures.get('direct_cost', 0) + measures.get('salary_cost', 0) + measures.get('fuel_cost', 0)
+        rows.append({
+            "month": month_key,
+            "route_code": route_code,
+            "trip_count": int(measures.get('trip_count', 0)),
+            "distance_km": measures.get('distance_km', 0),
+            "revenue": revenue,
+            "direct_cost": measures.get('direct_cost', 0),
+            "salary_cost": measures.get('salary_cost', 0),
+            "fuel_cost": measures.get('fuel_cost', 0),
+            "profit": revenue - costs,
+            "refreshed_at": refreshed_at,
+        })
+    if rows:
+        db.execute(RouteProfitRollup.__table__.insert(), rows)
+    mark_rollup_months_fresh(db, "route_profit", month_keys, source_version)
+    db.commit()
+
+def get_route_profit(db: Session, year: int, month: Optional[int] = None) -> list:
+    """Lợi nhuận theo tuyến/tháng từ bảng rollup; tháng chưa khớp dữ liệu được tính lại trước khi đọc"""
+    today = date.today()
+    months = [month] if month else list(range(1, 13))
+    months = [m for m in months if date(year, m, 1) <= today]
+    if not months:
+        return []
+    stale = stale_rollup_months(db, "route_profit", [f"{year}-{m:02d}" for m in months], ROUTE_PROFIT_GLOBAL_TABLES)
+    if stale:
+        refresh_route_profit(db, year, [int(month_key[5:]) for month_key in stale])
+    
+    rows = db.query(RouteProfitRollup).filter(
+        RouteProfitRollup.month.in_([f"{year}-{m:02d}" for m in months])
+    ).order_by(RouteProfitRollup.month, RouteProfitRollup.profit.desc()).all()
+    return [
+        {
+            "month": row.month,
+            "route_code": row.route_code,
+            "route_label": row.route_code or UNALLOCATED_ROUTE_LABEL,
+            "trip_count": row.trip_count,
+            "distance_km": row.distance_km,
+            "revenue": row.revenue,
+            "direct_cost": row.direct_cost,
+            "salary_cost": row.salary_cost,
+            "fuel_cost": row.fuel_cost,
+            "profit": row.profit,
+            "margin_pct": round(row.profit / row.revenue * 100, 1) if row.revenue else None,
+        }
+        for row in rows
+    ]
+
+def summarize_route_profit(rows: list) -> dict:
+    revenue = sum(row["revenue"] for row in rows)
+    profit = sum(row["profit"] for row in rows)
+    return {
+        "revenue": revenue,
+        "direct_cost": sum(row["direct_cost"] for row in rows),
+        "salary_cost": sum(row["salary_cost"] for row in rows),
+        "fuel_cost": sum(row["fuel_cost"] for row in rows),
+        "profit": profit,
+        "margin_pct": round(profit / revenue * 100, 1) if revenue else None,
+        "loss_count": sum(1 for row in rows if row["profit"] < 0 and row["route_code"]),
+    }
+
+@app.get("/route-profit", response_class=HTMLResponse)
+async def route_profit_page(
+    request: Request,
+    db: Session = Depends(get_db),
+    month: Optional[int] = None,
+    year: Optional[int] = None
+):
+    """Trang lợi nhuận theo tuyến: doanh thu, chi phí trực tiếp, lương, dầu phân bổ"""
+    if not year:
+        current_date = datetime.now()
+        year = current_date.year
+        month = month or current_date.month
     
-    return RedirectResponse(url=url, status_code=302)
+    # Tháng/năm không hợp lệ -> báo cáo rỗng
+    rows = get_route_profit(db, year, month) if is_valid_report_period(month, year) else []
+    return templates.TemplateResponse("route_profit.html", {
+        "request": request,
+        "rows": rows,
+        "summary": summarize_route_profit(rows),
+        "selected_month": month,
+        "selected_year": year
+    })
 
-@app.get("/fuel-report/export-excel")
-async def export_fuel_report_excel(
+@app.get("/api/route-profit")
+async def route_profit_api(db: Session = Depends(get_db), month: Optional[int] = None, year: Optional[int] = None):
+    if not year:
+        current_date = datetime.now()
+        year = current_date.year
+        month = month or current_date.month
+    if not is_valid_report_period(month, year):
+        return JSONResponse({"success": False, "message": "Tháng hoặc năm không hợp lệ"}, status_code=400)
+    rows = get_route_profit(db, year, month)
+    return {"year": year, "month": month, "summary": summarize_route_profit(rows), "routes": rows}
+
+@app.get("/route-profit/export-excel")
+async def export_route_profit_excel(
     db: Session = Depends(get_db),
-    from_date: Optional[str] = None,
-    to_date: Optional[str] = None
+    month: Optional[int] = None,
+    year: Optional[int] = None
 ):
-    """Xuất Excel báo cáo đổ dầu"""
-    # Xử lý khoảng thời gian (sử dụng logic giống như fuel_page)
-    if from_date and to_date:
-        try:
-            from_date_obj = datetime.strptime(from_date, "%Y-%m-%d").date()
-            to_date_obj = datetime.strptime(to_date, "%Y-%m-%d").date()
-            fuel_records_query = db.query(FuelRecord).filter(
-                FuelRecord.date >= from_date_obj,
-                FuelRecord.date <= to_date_obj
-            )
-        except ValueError:
-            fuel_records_query = db.query(FuelRecord)
-    else:
-        # Nếu không có khoảng thời gian, lấy tháng hiện tại
-        today = date.today()
-        fuel_records_query = db.query(FuelRecord).filter(
-            FuelRecord.date >= date(today.year, today.month, 1),
-            FuelRecord.date < date(today.year, today.month + 1, 1) if today.month < 12 else date(today.year + 1, 1, 1)
-        )
+    """Xuất Excel lợi nhuận theo tuyến"""
+    if not year:
+        current_date = datetime.now()
+        year = current_date.year
+        month = month or current_date.month
     
-    fuel_records = fuel_records_query.order_by(FuelRecord.date.desc(), FuelRecord.license_plate).all()
+    rows = get_route_profit(db, year, month) if is_valid_report_period(month, year) else []
+    summary = summarize_route_profit(rows)
     
-    # Tạo workbook Excel
     wb = Workbook()
     ws = wb.active
-    ws.title = "Báo cáo đổ dầu"
+    ws.title = "Lợi nhuận theo tuyến"
     
-    # Định dạng header
     header_font = Font(bold=True, color="FFFFFF")
     header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-    header_alignment = Alignment(horizontal="center", vertical="center")
+    header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+    loss_fill = PatternFill(start_color="F8D7DA", end_color="F8D7DA", fill_type="solid")
     
-    # Tiêu đề báo cáo
-    ws.merge_cells('A1:H1')
-    ws['A1'] = "BÁO CÁO ĐỔ DẦU"
+    ws.merge_cells('A1:J1')
+    ws['A1'] = "BÁO CÁO LỢI NHUẬN THEO TUYẾN"
     ws['A1'].font = Font(bold=True, size=16)
     ws['A1'].alignment = Alignment(horizontal="center")
-    
-    # Thông tin thời gian
-    period_text = ""
-    if from_date and to_date:
-        period_text = f"Từ ngày: {from_date} đến ngày: {to_date}"
-    else:
-        today = date.today()
-        period_text = f"Tháng: {today.month}/{today.year}"
-    
-    ws.merge_cells('A2:H2')
-    ws['A2'] = period_text
+    ws.merge_cells('A2:J2')
+    ws['A2'] = f"Tháng: {month}/{year}" if month else f"Năm: {year}"
     ws['A2'].alignment = Alignment(horizontal="center")
     
-    # Header bảng
     headers = [
-        "STT", "Ngày đổ", "Loại dầu", "Biển số xe", 
-        "Giá xăng dầu (đồng/lít)", "Số lít đã đổ", "Số tiền đã đổ (VNĐ)", "Ghi chú"
+        "Tháng", "Mã tuyến", "Số chuyến", "Số km", "Doanh thu", "Chi phí trực tiếp",
+        "Lương lái xe", "Dầu phân bổ", "Lợi nhuận", "Tỷ suất (%)"
     ]
-    
     for col, header in enumerate(headers, 1):
         cell = ws.cell(row=4, column=col, value=header)
         cell.font = header_font
         cell.fill = header_fill
         cell.alignment = header_alignment
     
-    # Dữ liệu
-    for row, record in enumerate(fuel_records, 5):
-        ws.cell(row=row, column=1, value=row-4)  # STT
-        ws.cell(row=row, column=2, value=record.date.strftime('%d/%m/%Y'))  # Ngày đổ
-        ws.cell(row=row, column=3, value=record.fuel_type)  # Loại dầu
-        ws.cell(row=row, column=4, value=record.license_plate)  # Biển số xe
-        ws.cell(row=row, column=5, value=record.fuel_price_per_liter)  # Giá xăng dầu
-        ws.cell(row=row, column=6, value=record.liters_pumped)  # Số lít đã đổ
-        ws.cell(row=row, column=7, value=record.cost_pumped)  # Số tiền đã đổ
-        ws.cell(row=row, column=8, value=record.notes or '')  # Ghi chú
-    
-    # Định dạng số
-    for row in range(5, 5 + len(fuel_records)):
-        # Giá xăng dầu - 2 chữ số thập phân
-        ws.cell(row=row, column=5).number_format = '#,##0.00'
-        # Số lít - 3 chữ số thập phân
-        ws.cell(row=row, column=6).number_format = '#,##0.000'
-        # Số tiền - không có chữ số thập phân
-        ws.cell(row=row, column=7).number_format = '#,##0'
-    
-    # Dòng tổng cộng
-    if fuel_records:
-        total_row = 5 + len(fuel_records)
+    for row_index, row in enumerate(rows, 5):
+        values = [
+            row["month"], row["route_label"], row["trip_count"], row["distance_km"], row["revenue"],
+            row["direct_cost"], row["salary_cost"], row["fuel_cost"], row["profit"], row["margin_pct"]
+        ]
+        for col, value in enumerate(values, 1):
+            cell = ws.cell(row=row_index, column=col, value=value)
+            if 5 <= col <= 9:
+                cell.number_format = '#,##0'
+            if row["profit"] < 0:
+                cell.fill = loss_fill
+    
+    if rows:
+        total_row = 5 + len(rows)
         ws.cell(row=total_row, column=1, value="TỔNG CỘNG").font = Font(bold=True)
-        ws.cell(row=total_row, column=2, value="").font = Font(bold=True)
-        ws.cell(row=total_row, column=3, value="").font = Font(bold=True)
-        ws.cell(row=total_row, column=4, value="").font = Font(bold=True)
-        ws.cell(row=total_row, column=5, value="").font = Font(bold=True)
-        ws.cell(row=total_row, column=6, value=sum(r.liters_pumped for r in fuel_records)).font = Font(bold=True)
-        ws.cell(row=total_row, column=7, value=sum(r.cost_pumped for r in fuel_records)).font = Font(bold=True)
-        ws.cell(row=total_row, column=8, value="").font = Font(bold=True)
-        
-        # Định dạng số cho dòng tổng cộng
-        ws.cell(row=total_row, column=6).number_format = '#,##0.000'
-        ws.cell(row=total_row, column=7).number_format = '#,##0'
+        for col, key in zip(range(5, 10), ["revenue", "direct_cost", "salary_cost", "fuel_cost", "profit"]):
+            ws.cell(row=total_row, column=col, value=summary[key]).font = Font(bold=True)
+            ws.cell(row=total_row, column=col).number_format = '#,##0'
+        ws.cell(row=total_row, column=10, value=summary["margin_pct"]).font = Font(bold=True)
     
-    # Điều chỉnh độ rộng cột
-    column_widths = [8, 12, 20, 15, 20, 15, 18, 30]
+    column_widths = [10, 24, 10, 10, 16, 16, 16, 16, 16, 10]
     for col, width in enumerate(column_widths, 1):
         ws.column_dimensions[get_column_letter(col)].width = width
     
-    # Lưu vào memory
     output = io.BytesIO()
     wb.save(output)
     output.seek(0)
     
-    # Tạo tên file
-    today = date.today()
-    filename = f"BaoCao_DoDau_{today.strftime('%Y%m%d')}.xlsx"
-    
+    filename = f"LoiNhuan_Tuyen_{year}{month:02d}.xlsx" if month else f"LoiNhuan_Tuyen_{year}.xlsx"
     return Response(
         content=output.getvalue(),
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
     )
 
+# ===== XU HƯỚNG NHIỀU NĂM =====
+
+TREND_SERIES = ["trip_count", "distance_km", "fuel_liters", "fuel_cost", "income", "expense", "payroll"]
+TREND_MAX_YEARS = 10
+
+# Ngoài dữ liệu của chính tháng, các bảng này ảnh hưởng lương của mọi tháng (mốc tính lưu trong rollup_states)
+MONTHLY_ROLLUP_GLOBAL_TABLES = ("routes", "route_rates", "salary_rules", "payroll_periods")
+
+def refresh_monthly_rollups(db: Session, month_keys: list):
+    """Tính lại các tháng cho bảng monthly_rollups: chuyến/km/dầu/thu/chi bằng một truy vấn gom theo tháng,
+    lương lấy tổng bảng chốt (tháng đã chốt) hoặc tính theo quy tắc lương (tháng chưa chốt)"""
+    month_keys = sorted(month_keys)
+    source_version = current_data_version(db)
+    first_year, first_month = map(int, month_keys[0].split("-"))
+    last_year, last_month = map(int, month_keys[-1].split("-"))
+    params = {
+        "from_date": _month_date_range(first_month, first_year)[0].strftime("%Y-%m-%d"),
+        "to_date": _month_date_range(last_month, last_year)[1].strftime("%Y-%m-%d"),
+    }
+    rows = db.execute(text("""
+        SELECT substr(date, 1, 7) AS month, 'trip_count' AS measure, COUNT(*) AS value
+        FROM daily_routes WHERE date >= :from_date AND date <= :to_date GROUP BY 1
+        UNION ALL
+        SELECT substr(date, 1, 7), 'distance_km', SUM(COALESCE(distance_km, 0))
+        FROM daily_routes WHERE date >= :from_date AND date <= :to_date GROUP BY 1
+        UNION ALL
+        SELECT substr(date, 1, 7), 'fuel_liters', SUM(COALESCE(liters_pumped, 0))
+        FROM fuel_records WHERE date >= :from_date AND date <= :to_date GROUP BY 1
+        UNION ALL
+        SELECT substr(date, 1, 7), 'fuel_cost', SUM(COALESCE(cost_pumped, 0))
+        FROM fuel_records WHERE date >= :from_date AND date <= :to_date GROUP BY 1
+        UNION ALL
+        SELECT substr(date, 1, 7), CASE WHEN transaction_type = 'Thu' THEN 'income' ELSE 'expense' END, SUM(COALESCE(total, 0))
+        FROM finance_transactions
+        WHERE date >= :from_date AND date <= :to_date AND transaction_type IN ('Thu', 'Chi')
+        GROUP BY 1, 2
+        UNION ALL
+        SELECT month, 'payroll', total_salary
+        FROM payroll_periods WHERE month >= substr(:from_date, 1, 7) AND month <= substr(:to_date, 1, 7)
+    """), params).all()
+    
+    measures = {month_key: {} for month_key in month_keys}
+    for month, measure, value in rows:
+        if month in measures:
+            measures[month][measure] = value or 0
+    for month_key, values in measures.items():
+        if "payroll" not in values:
+            year, month = map(int, month_key.split("-"))
+            from_date, to_date = _month_date_range(month, year)
+            values["payroll"] = sum(item['daily_salary'] for item in get_salary_data(db, from_date, to_date))
+    
+    refreshed_at = datetime.utcnow()
+    db.execute(delete(MonthlyRollup).where(MonthlyRollup.month.in_(month_keys)))
+    db.execute(MonthlyRollup.__table__.insert(), [
+        dict({series: values.get(series, 0) for series in TREND_SERIES}, month=month_key, refreshed_at=refreshed_at)
+        for month_key, values in measures.items()
+    ])
+    mark_rollup_months_fresh(db, "monthly", month_keys, source_version)
+    db.commit()
+
+def get_trends(db: Session, years: int = 3) -> dict:
+    """Chuỗi số liệu theo tháng trong `years` năm gần nhất (tính cả tháng hiện tại), đọc từ monthly_rollups"""
+    today = date.today()
+    month_keys = []
+    year, month = today.year, today.month
+    for _ in range(years * 12):
+        month_keys.append(f"{year}-{month:02d}")
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    month_keys.reverse()
+    
+    stale = stale_rollup_months(db, "monthly", month_keys, MONTHLY_ROLLUP_GLOBAL_TABLES)
+    if stale:
+        refresh_monthly_rollups(db, stale)
+    
+    rows = db.query(MonthlyRollup).filter(
+        MonthlyRollup.month >= month_keys[0], MonthlyRollup.month <= month_keys[-1]
+    ).order_by(MonthlyRollup.month).all()
+    return {
+        "months": [row.month for row in rows],
+        "series": {series: [getattr(row, series) or 0 for row in rows] for series in TREND_SERIES},
+    }
+
+@app.get("/api/trends")
+async def trends_api(db: Session = Depends(get_db), years: int = 3):
+    """Chuỗi theo tháng: số chuyến, km, lít dầu, tiền dầu, thu, chi, lương lái xe"""
+    if years < 1 or years > TREND_MAX_YEARS:
+        return JSONResponse({"success": False, "message": f"years phải từ 1 đến {TREND_MAX_YEARS}"}, status_code=400)
+    return dict(get_trends(db, years), success=True, years=years)
+
+# ===== PHÂN TÍCH NHANH (DỮ LIỆU DẠNG CỘT) =====
+
+# Các bảng nạp vào bộ nhớ dạng cột. dimensions: cột phân loại (mã hóa thành số nguyên),
+# measures: cột số. Chiều thời gian day/week/month/year suy ra từ cột date.
+ANALYTICS_TABLES = {
+    "daily_routes": {
+        "label": "Chuyến hàng ngày",
+        "id_column": "dr.id",
+        "sql": """
+            SELECT dr.id, dr.date, dr.driver_name, UPPER(TRIM(dr.license_plate)) AS license_plate, r.route_code,
+                   COALESCE(dr.distance_km, 0) AS distance_km, COALESCE(dr.cargo_weight, 0) AS cargo_weight
+            FROM daily_routes dr
+            LEFT JOIN routes r ON r.id = dr.route_id
+        """,
+        "dimensions": ["driver_name", "license_plate", "route_code"],
+        "measures": ["distance_km", "cargo_weight"],
+        "related_tables": ["routes"],  # Mã tuyến lấy từ bảng routes -> đổi tuyến thì nạp lại toàn bộ
+    },
+    "fuel_records": {
+        "label": "Đổ dầu",
+        "id_column": "fr.id",
+        "sql": """
+            SELECT fr.id, fr.date, UPPER(TRIM(fr.license_plate)) AS license_plate, fr.fuel_type,
+                   COALESCE(fr.liters_pumped, 0) AS liters_pumped, COALESCE(fr.cost_pumped, 0) AS cost_pumped,
+                   COALESCE(fr.fuel_price_per_liter, 0) AS fuel_price_per_liter
+            FROM fuel_records fr
+        """,
+        "dimensions": ["license_plate", "fuel_type"],
+        "measures": ["liters_pumped", "cost_pumped", "fuel_price_per_liter"],
+    },
+    "finance_transactions": {
+        "label": "Thu chi",
+        "id_column": "ft.id",
+        "sql": """
+            SELECT ft.id, ft.date, ft.transaction_type, ft.category, TRIM(ft.route_code) AS route_code,
+                   COALESCE(ft.amount, 0) AS amount, COALESCE(ft.total, 0) AS total
+            FROM finance_transactions ft
+        """,
+        "dimensions": ["transaction_type", "category", "route_code"],
+        "measures": ["amount", "total"],
+    },
+}
+
+ANALYTICS_DATE_DIMENSIONS = ["day", "week", "month", "year"]
+ANALYTICS_AGGREGATES = ["count", "sum", "avg", "min", "max"]
+ANALYTICS_MAX_ROWS = 10000  # Số nhóm tối đa trả về một lần
+
+class ColumnarTable:
+    """Một bảng dạng cột trong bộ nhớ: id, ngày (số ngày từ 1970-01-01), mã phân loại, cột số.
+    Nạp thêm theo watermark id; dòng bị sửa/xóa được nạp lại theo id - báo qua on_data_change trong
+    process này và đọc từ nhật ký data_changes cho thay đổi của worker khác."""
+    
+    def __init__(self, name: str, spec: dict):
+        import threading
+        self.name = name
+        self.spec = spec
+        self.lock = threading.Lock()  # Giữ trong lúc nạp dữ liệu
+        self.dirty_lock = threading.Lock()  # Chỉ giữ khi đọc/ghi dirty_ids để listener không phải chờ lúc nạp
+        self.needs_full_reload = True
+        self.dirty_ids = set()
+        self._reset()
+    
+    def _reset(self):
+        self.watermark = 0
+        self.change_version = 0  # Mốc nhật ký data_changes đã áp dụng
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.days = np.zeros(0, dtype=np.int64)
+        self.codes = {dimension: np.zeros(0, dtype=np.int32) for dimension in self.spec["dimensions"]}
+        self.categories = {dimension: [] for dimension in self.spec["dimensions"]}
+        self.category_index = {dimension: {} for dimension in self.spec["dimensions"]}
+        self.values = {measure: np.zeros(0, dtype=float) for measure in self.spec["measures"]}
+        self.date_dimensions = {}
+    
+    def dimension(self, dimension: str) -> tuple:
+        """(mảng mã 0..k-1, danh sách nhãn) của một chiều. Chiều thời gian được mã hóa một lần
+        qua bảng tra trên khoảng ngày [min, max] và giữ lại đến lần nạp dữ liệu sau."""
+        if dimension not in ANALYTICS_DATE_DIMENSIONS:
+            return self.codes[dimension], self.categories[dimension]
+        if dimension not in self.date_dimensions:
+            if len(self.days):
+                first_day = int(self.days.min())
+                span = np.arange(first_day, int(self.days.max()) + 1)
+                span_keys, to_label = _date_dimension_keys(span, dimension)
+                unique_keys, span_codes = np.unique(span_keys, return_inverse=True)
+                codes = span_codes.astype(np.int32)[self.days - first_day]
+                labels = [to_label(key) for key in unique_keys]
+            else:
+                codes, labels = np.zeros(0, dtype=np.int32), []
+            self.date_dimensions[dimension] = (codes, labels)
+        return self.date_dimensions[dimension]
+    
+    def mark_changed(self, ids):
+        with self.dirty_lock:
+            if ids:
+                self.dirty_ids.update(ids)
+            else:
+                self.needs_full_reload = True
+    
+    def _encode(self, dimension: str, values: list):
+        index = self.category_index[dimension]
+        categories = self.categories[dimension]
+        codes = np.empty(len(values), dtype=np.int32)
+        for position, value in enumerate(values):
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(categories)
+                categories.append(value)
+            codes[position] = code
+        return codes
+    
+    def _append(self, rows: list):
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        self.ids = np.concatenate([self.ids, np.array(columns[0], dtype=np.int64)])
+        days = np.array(columns[1], dtype="datetime64[D]").astype(np.int64)
+        self.days = np.concatenate([self.days, days])
+        position = 2
+        for dimension in self.spec["dimensions"]:
+            self.codes[dimension] = np.concatenate([self.codes[dimension], self._encode(dimension, columns[position])])
+            position += 1
+        for measure in self.spec["measures"]:
+            self.values[measure] = np.concatenate([self.values[measure], np.array(columns[position], dtype=float)])
+            position += 1
+        self.watermark = max(self.watermark, int(self.ids.max()))
+        self.date_dimensions = {}
+    
+    def refresh(self, db: Session):
+        """Đồng bộ với DB: nạp lại toàn bộ nếu cần, nếu không chỉ nạp dòng mới (id > watermark) và dòng đã đổi"""
+        with self.lock:
+            id_column = self.spec["id_column"]
+            # Lấy và thay tập dirty trong một lần giữ khóa: id được báo sau đó sẽ vào tập mới, không bị mất
+            with self.dirty_lock:
+                dirty_ids, self.dirty_ids = self.dirty_ids, set()
+                full_reload, self.needs_full_reload = self.needs_full_reload, False
+            if not full_reload:
+                changes, change_version = read_data_changes(
+                    db, self.change_version, [self.name] + self.spec.get("related_tables", [])
+                )
+                if changes is None or any(table_name != self.name for table_name, _, _ in changes):
+                    full_reload = True
+                else:
+                    dirty_ids.update(row_id for _, row_id, _ in changes if row_id is not None)
+                    self.change_version = change_version
+            if full_reload:
+                self._reset()
+                # Đọc mốc trước khi nạp: thay đổi xen vào sẽ được nạp lại ở lần sau
+                self.change_version = current_data_version(db)
+                self._append(db.execute(text(f"{self.spec['sql']} ORDER BY {id_column}")).all())
+                return
+            dirty_ids = sorted(dirty_ids)
+            if dirty_ids:
+                keep = ~np.isin(self.ids, dirty_ids)
+                self.ids = self.ids[keep]
+                self.days = self.days[keep]
+                for dimension in self.codes:
+                    self.codes[dimension] = self.codes[dimension][keep]
+                for measure in self.values:
+                    self.values[measure] = self.values[measure][keep]
+                self.date_dimensions = {}
+                # Dòng đã đổi có id <= watermark -> nạp lại theo từng nhóm id (dòng đã xóa không còn trả về)
+                for start in range(0, len(dirty_ids), 500):
+                    chunk = [i for i in dirty_ids[start:start + 500] if i <= self.watermark]
+                    if chunk:
+                        self._append(db.execute(text(
+                            f"{self.spec['sql']} WHERE {id_column} IN ({','.join(str(int(i)) for i in chunk)})"
+                        )).all())
+            self._append(db.execute(
+                text(f"{self.spec['sql']} WHERE {id_column} > :watermark ORDER BY {id_column}"),
+                {"watermark": self.watermark}
+            ).all())
+
+_analytics_tables = {name: ColumnarTable(name, spec) for name, spec in ANALYTICS_TABLES.items()}
+
+@on_data_change
+def _track_analytics_changes(table_name, dates, ids):
+    if table_name in _analytics_tables:
+        _analytics_tables[table_name].mark_changed(ids)
+    for table in _analytics_tables.values():
+        if table_name in table.spec.get("related_tables", []):
+            table.mark_changed(None)
+
+def _date_dimension_keys(days, dimension: str):
+    """Khóa nhóm (số nguyên) và hàm đổi khóa -> nhãn cho chiều thời gian"""
+    if dimension == "day":
+        return days, lambda key: str(np.datetime64(int(key), "D"))
+    if dimension == "week":
+        # 1970-01-01 là thứ Năm -> (days + 3) % 7 = số ngày tính từ thứ Hai
+        return days - (days + 3) % 7, lambda key: str(np.datetime64(int(key), "D"))
+    if dimension == "month":
+        return days.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64), \
+            lambda key: str(np.datetime64(int(key), "M"))
+    return days.astype("datetime64[D]").astype("datetime64[Y]").astype(np.int64), \
+        lambda key: int(key) + 1970
+
+def run_analytics_query(db: Session, table_name: str, group_by: list, measures: list,
+                        filters: Optional[dict] = None, from_date: Optional[date] = None,
+                        to_date: Optional[date] = None, order_by: Optional[str] = None,
+                        limit: Optional[int] = None) -> dict:
+    """Nhóm/lọc/tính toán trên dữ liệu dạng cột. measures: "count", "sum:cột", "avg:cột", "min:cột", "max:cột".
+    Lỗi tham số -> ValueError."""
+    table = _analytics_tables.get(table_name)
+    if not table:
+        raise ValueError(f"Bảng không hợp lệ: {table_name}")
+    spec = table.spec
+    for dimension in group_by:
+        if dimension not in spec["dimensions"] and dimension not in ANALYTICS_DATE_DIMENSIONS:
+            raise ValueError(f"Không nhóm được theo: {dimension}")
+    parsed_measures = []
+    for measure in measures or ["count"]:
+        aggregate, _, column = measure.partition(":")
+        if aggregate not in ANALYTICS_AGGREGATES or (aggregate != "count" and column not in spec["measures"]):
+            raise ValueError(f"Chỉ tiêu không hợp lệ: {measure}")
+        parsed_measures.append((measure, aggregate, column))
+    
+    table.refresh(db)
+    
+    # Lọc (không lọc -> dùng thẳng các cột, không sao chép)
+    mask = np.ones(len(table.ids), dtype=bool)
+    if from_date:
+        mask &= table.days >= np.datetime64(from_date, "D").astype(np.int64)
+    if to_date:
+        mask &= table.days <= np.datetime64(to_date, "D").astype(np.int64)
+    for dimension, value in (filters or {}).items():
+        if dimension not in spec["dimensions"]:
+            raise ValueError(f"Không lọc được theo: {dimension}")
+        code = table.category_index[dimension].get(value)
+        mask &= table.codes[dimension] == code if code is not None else False
+    if mask.all():
+        take = lambda column: column
+        n_rows = len(table.ids)
+    else:
+        rows_index = np.flatnonzero(mask)
+        take = lambda column: column[rows_index]
+        n_rows = len(rows_index)
+    
+    # Mỗi chiều là mã dày 0..k-1 -> ghép thành một khóa phẳng,
+    # nhóm bằng bincount trên không gian khóa (không cần sắp xếp)
+    dimension_sizes = []
+    dimension_labels = []
+    flat_keys = np.zeros(n_rows, dtype=np.int64)
+    for dimension in group_by:
+        codes, labels = table.dimension(dimension)
+        size = max(len(labels), 1)
+        flat_keys = flat_keys * size + take(codes)
+        dimension_sizes.append(size)
+        dimension_labels.append(labels)
+    
+    if group_by and n_rows:
+        key_space = int(np.prod(dimension_sizes, dtype=np.int64))
+        if key_space <= max(4 * n_rows, 1 << 20):
+            group_keys = np.flatnonzero(np.bincount(flat_keys, minlength=key_space))
+            positions = np.zeros(key_space, dtype=np.int64)
+            positions[group_keys] = np.arange(len(group_keys))
+            group_index = positions[flat_keys]
+        else:
+            group_keys, group_index = np.unique(flat_keys, return_inverse=True)
+        group_dimensions = np.unravel_index(group_keys, dimension_sizes)
+    else:
+        group_keys = np.zeros(1 if n_rows or not group_by else 0, dtype=np.int64)
+        group_index = np.zeros(n_rows, dtype=np.int64)
+        group_dimensions = []
+    n_groups = len(group_keys)
+    
+    counts = np.bincount(group_index, minlength=n_groups).astype(float)
+    results = []
+    for measure, aggregate, column in parsed_measures:
+        if aggregate == "count":
+            results.append(counts)
+            continue
+        values = take(table.values[column])
+        if aggregate in ("sum", "avg"):
+            sums = np.bincount(group_index, weights=values, minlength=n_groups)
+            results.append(sums if aggregate == "sum" else np.divide(sums, counts, out=np.full(n_groups, np.nan), where=counts > 0))
+        else:
+            reducer = np.minimum if aggregate == "min" else np.maximum
+            extremes = np.full(n_groups, np.inf if aggregate == "min" else -np.inf)
+            reducer.at(extremes, group_index, values)
+            results.append(np.where(counts > 0, extremes, np.nan))
+    
+    # Sắp xếp: theo chỉ tiêu giảm dần nếu có order_by, mặc định theo khóa nhóm
+    if order_by:
+        if order_by not in [measure for measure, _, _ in parsed_measures]:
+            raise ValueError(f"order_by phải là một trong các chỉ tiêu: {order_by}")
+        sort_values = results[[measure for measure, _, _ in parsed_measures].index(order_by)]
+        group_order = np.argsort(-np.nan_to_num(sort_values, nan=-np.inf), kind="stable")
+    else:
+        group_order = np.arange(n_groups)
+    group_order = group_order[:min(limit or ANALYTICS_MAX_ROWS, ANALYTICS_MAX_ROWS)]
+    
+    result_columns = [column.tolist() for column in results]
+    rows = []
+    for group in group_order.tolist():
+        labels = [dimension_labels[d][int(group_dimensions[d][group])] for d in range(len(group_by))]
+        rows.append(labels + [
+            None if np.isnan(column[group]) else round(column[group], 4) for column in result_columns
+        ])
+    
+    return {
+        "columns": list(group_by) + [measure for measure, _, _ in parsed_measures],
+        "rows": rows,
+        "group_count": n_groups,
+        "row_count_scanned": n_rows,
+    }
+
+@app.get("/api/analytics/schema")
+async def analytics_schema_api():
+    """Các bảng, chiều nhóm và chỉ tiêu dùng được cho /api/analytics"""
+    return {
+        name: {
+            "label": spec["label"],
+            "dimensions": spec["dimensions"] + ANALYTICS_DATE_DIMENSIONS,
+            "measures": ["count"] + [f"{aggregate}:{column}" for column in spec["measures"] for aggregate in ANALYTICS_AGGREGATES[1:]],
+            "row_count": len(_analytics_tables[name].ids),
+        }
+        for name, spec in ANALYTICS_TABLES.items()
+    }
+
+@app.get("/api/analytics")
+async def analytics_api(
+    db: Session = Depends(get_db),
+    table: str = "daily_routes",
+    group_by: str = "",
+    measures: str = "count",
+    filters: str = "",
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    order_by: Optional[str] = None,
+    limit: Optional[int] = None
+):
+    """Truy vấn phân tích tổng quát.
+    VD: /api/analytics?table=daily_routes&group_by=driver_name,week&measures=count,sum:distance_km
+    filters dạng "cột:giá trị;cột:giá trị"."""
+    started = time.perf_counter()
+    try:
+        parsed_filters = {}
+        for item in filter(None, filters.split(";")):
+            dimension, separator, value = item.partition(":")
+            if not separator:
+                raise ValueError(f"Bộ lọc không hợp lệ: {item}")
+            parsed_filters[dimension.strip()] = value.strip()
+        result = run_analytics_query(
+            db, table,
+            [dimension.strip() for dimension in group_by.split(",") if dimension.strip()],
+            [measure.strip() for measure in measures.split(",") if measure.strip()],
+            parsed_filters,
+            datetime.strptime(from_date, "%Y-%m-%d").date() if from_date else None,
+            datetime.strptime(to_date, "%Y-%m-%d").date() if to_date else None,
+            order_by, limit
+        )
+    except ValueError as e:
+        return JSONResponse({"success": False, "message": str(e)}, status_code=400)
+    return dict(result, success=True, table=table, elapsed_ms=round((time.perf_counter() - started) * 1000, 2))
+
 # ===== SALARY CALCULATION ROUTES =====
 
 @app.get("/api/employees")
@@ -2431,7 +6879,8 @@ async def salary_calculation_page(
     db: Session = Depends(get_db),
     selected_month: Optional[str] = None,
     selected_employee: Optional[str] = None,
-    selected_route: Optional[str] = None
+    selected_route: Optional[str] = None,
+    error: Optional[str] = None
 ):
     """Trang bảng tính lương"""
     import calendar
@@ -2458,92 +6907,11 @@ async def salary_calculation_page(
     from_date = date(year, month, 1)
     to_date = date(year, month, days_in_month)
     
-    # Xây dựng query cơ bản
-    daily_routes_query = db.query(DailyRoute).filter(
-        DailyRoute.date >= from_date,
-        DailyRoute.date <= to_date,
-        DailyRoute.driver_name.isnot(None),
-        DailyRoute.driver_name != ""
-    )
-    
-    # Thêm filter theo nhân viên nếu được chọn
-    if selected_employee and selected_employee != "all":
-        # Tìm nhân viên theo ID hoặc tên
-        try:
-            employee_id = int(selected_employee)
-            employee = db.query(Employee).filter(Employee.id == employee_id, Employee.status == 1).first()
-            if employee:
-                daily_routes_query = daily_routes_query.filter(DailyRoute.driver_name == employee.name)
-        except ValueError:
-            # Nếu không phải số, coi như tên nhân viên
-            daily_routes_query = daily_routes_query.filter(DailyRoute.driver_name == selected_employee)
-    
-    # Join với Route để có thể filter theo route_code
-    daily_routes_query = daily_routes_query.join(Route)
-    
-    # Thêm filter theo mã tuyến nếu được chọn
-    if selected_route and selected_route != "all":
-        daily_routes_query = daily_routes_query.filter(Route.route_code == selected_route)
-    
-    daily_routes = daily_routes_query.order_by(Route.route_code, DailyRoute.date).all()
-    
-    # Tính lương cho từng chuyến và lấy biển số xe
-    salary_data = []
-    for daily_route in daily_routes:
-        # Tính lương theo công thức khác nhau tùy loại tuyến
-        daily_salary = 0
-        salary_type = "standard"  # Mặc định là tuyến chuẩn
-        
-        # Kiểm tra nếu là tuyến "Tăng Cường"
-        if daily_route.route.route_code and daily_route.route.route_code.strip() == "Tăng Cường":
-            salary_type = "tang_cuong"  # Luôn đánh dấu là tuyến Tăng Cường
-            # Công thức cho tuyến "Tăng Cường": Số km thực tế × 1,100 đ
-            if daily_route.distance_km and daily_route.distance_km > 0:
-                daily_salary = daily_route.distance_km * 1100
-        else:
-            # Công thức cho tuyến thường: Lương tuyến/tháng / 30
-            if daily_route.route.monthly_salary and daily_route.route.monthly_salary > 0:
-                daily_salary = daily_route.route.monthly_salary / 30
-        
-        # Lấy biển số xe từ daily-new với điều kiện lọc chính xác:
-        # Tên nhân viên + Mã tuyến + Ngày chạy
-        license_plate_display = "Chưa cập nhật"
-        if daily_route.driver_name:
-            # Tìm chuyến có cùng: tên lái xe + route_id + ngày chạy
-            matching_routes = db.query(DailyRoute).filter(
-                DailyRoute.driver_name == daily_route.driver_name,
-                DailyRoute.route_id == daily_route.route_id,
-                DailyRoute.date == daily_route.date,
-                DailyRoute.license_plate.isnot(None),
-                DailyRoute.license_plate != ""
-            ).order_by(DailyRoute.created_at.desc()).all()  # Sắp xếp theo thời gian tạo mới nhất
-            
-            if matching_routes:
-                # Lấy danh sách biển số xe duy nhất từ các chuyến khớp
-                license_plates = list(set([route.license_plate for route in matching_routes if route.license_plate]))
-                
-                if license_plates:
-                    if len(license_plates) == 1:
-                        license_plate_display = license_plates[0]
-                    else:
-                        # Nếu có nhiều biển số, hiển thị phân tách bằng dấu phẩy
-                        license_plate_display = ", ".join(license_plates)
-        
-        salary_data.append({
-            'driver_name': daily_route.driver_name,
-            'route_code': daily_route.route.route_code,
-            'route_name': daily_route.route.route_name,
-            'date': daily_route.date,
-            'license_plate': license_plate_display,
-            'daily_salary': daily_salary,
-            'monthly_salary': daily_route.route.monthly_salary or 0,
-            'days_in_month': 30,  # Chuẩn hóa tháng 30 ngày
-            'salary_type': salary_type,  # "standard" hoặc "tang_cuong"
-            'distance_km': daily_route.distance_km or 0  # Số km thực tế cho tuyến Tăng Cường
-        })
+    # Danh sách chuyến kèm lương chuyến (tháng đã chốt đọc từ bảng chốt,
+    # tháng chưa chốt tính theo đơn giá hiệu lực + quy tắc lương)
+    salary_data, payroll_period = get_month_salary_data(db, year, month, selected_employee, selected_route)
     
     # Lấy danh sách lái xe và tuyến để hiển thị
-    employees = db.query(Employee).filter(Employee.status == 1).all()
     routes = db.query(Route).filter(Route.is_active == 1, Route.status == 1).all()
     
     # Sắp xếp routes: A-Z bình thường, nhưng "Tăng Cường" đẩy xuống cuối
@@ -2571,17 +6939,20 @@ async def salary_calculation_page(
     template_data = {
         "request": request,
         "salary_data": salary_data,
-        "employees": employees,
         "routes": routes,
         "selected_month": f"{year}-{month:02d}",
         "selected_month_display": f"{month}/{year}",
         "selected_employee": selected_employee or "all",
+        "selected_employee_name": _resolve_driver_name(db, selected_employee) or "",
         "selected_route": selected_route or "all",
         "days_in_month": days_in_month,
         "total_trips": len(salary_data),
         "total_salary": total_salary,
         "total_standard_salary": total_standard_salary,
-        "total_tang_cuong_salary": total_tang_cuong_salary
+        "total_tang_cuong_salary": total_tang_cuong_salary,
+        "payroll_period": payroll_period,
+        "can_close_month": to_date < date.today(),
+        "error": error
     }
     
     return templates.TemplateResponse("salary_calculation.html", template_data)
@@ -2594,8 +6965,6 @@ async def export_salary_calculation_excel(
     selected_route: Optional[str] = None
 ):
     """Xuất Excel bảng tính lương"""
-    import calendar
-    
     # Xử lý tháng được chọn (sử dụng logic giống như salary_calculation_page)
     if selected_month:
         try:
@@ -2608,88 +6977,8 @@ async def export_salary_calculation_excel(
         today = date.today()
         year, month = today.year, today.month
     
-    # Tính số ngày trong tháng
-    days_in_month = calendar.monthrange(year, month)[1]
-    
-    # Lấy dữ liệu chuyến trong tháng được chọn
-    from_date = date(year, month, 1)
-    to_date = date(year, month, days_in_month)
-    
-    # Xây dựng query cơ bản (sử dụng logic giống như salary_calculation_page)
-    daily_routes_query = db.query(DailyRoute).filter(
-        DailyRoute.date >= from_date,
-        DailyRoute.date <= to_date,
-        DailyRoute.driver_name.isnot(None),
-        DailyRoute.driver_name != ""
-    )
-    
-    # Thêm filter theo nhân viên nếu được chọn
-    if selected_employee and selected_employee != "all":
-        try:
-            employee_id = int(selected_employee)
-            employee = db.query(Employee).filter(Employee.id == employee_id, Employee.status == 1).first()
-            if employee:
-                daily_routes_query = daily_routes_query.filter(DailyRoute.driver_name == employee.name)
-        except ValueError:
-            daily_routes_query = daily_routes_query.filter(DailyRoute.driver_name == selected_employee)
-    
-    # Join với Route để có thể filter theo route_code
-    daily_routes_query = daily_routes_query.join(Route)
-    
-    # Thêm filter theo mã tuyến nếu được chọn
-    if selected_route and selected_route != "all":
-        daily_routes_query = daily_routes_query.filter(Route.route_code == selected_route)
-    
-    daily_routes = daily_routes_query.order_by(Route.route_code, DailyRoute.date).all()
-    
-    # Tính lương cho từng chuyến và lấy biển số xe (sử dụng logic giống như salary_calculation_page)
-    salary_data = []
-    for daily_route in daily_routes:
-        # Tính lương theo công thức khác nhau tùy loại tuyến
-        daily_salary = 0
-        salary_type = "standard"  # Mặc định là tuyến chuẩn
-        
-        # Kiểm tra nếu là tuyến "Tăng Cường"
-        if daily_route.route.route_code and daily_route.route.route_code.strip() == "Tăng Cường":
-            salary_type = "tang_cuong"  # Luôn đánh dấu là tuyến Tăng Cường
-            # Công thức cho tuyến "Tăng Cường": Số km thực tế × 1,100 đ
-            if daily_route.distance_km and daily_route.distance_km > 0:
-                daily_salary = daily_route.distance_km * 1100
-        else:
-            # Công thức cho tuyến thường: Lương tuyến/tháng / 30
-            if daily_route.route.monthly_salary and daily_route.route.monthly_salary > 0:
-                daily_salary = daily_route.route.monthly_salary / 30
-        
-        # Lấy biển số xe từ daily-new với điều kiện lọc chính xác
-        license_plate_display = "Chưa cập nhật"
-        if daily_route.driver_name:
-            matching_routes = db.query(DailyRoute).filter(
-                DailyRoute.driver_name == daily_route.driver_name,
-                DailyRoute.route_id == daily_route.route_id,
-                DailyRoute.date == daily_route.date,
-                DailyRoute.license_plate.isnot(None),
-                DailyRoute.license_plate != ""
-            ).order_by(DailyRoute.created_at.desc()).all()
-            
-            if matching_routes:
-                license_plates = list(set([route.license_plate for route in matching_routes if route.license_plate]))
-                
-                if license_plates:
-                    if len(license_plates) == 1:
-                        license_plate_display = license_plates[0]
-                    else:
-                        license_plate_display = ", ".join(license_plates)
-        
-        salary_data.append({
-            'driver_name': daily_route.driver_name,
-            'route_code': daily_route.route.route_code,
-            'route_name': daily_route.route.route_name,
-            'date': daily_route.date,
-            'license_plate': license_plate_display,
-            'daily_salary': daily_salary,
-            'salary_type': salary_type,  # "standard" hoặc "tang_cuong"
-            'distance_km': daily_route.distance_km or 0  # Số km thực tế cho tuyến Tăng Cường
-        })
+    # Danh sách chuyến kèm lương chuyến (dùng chung với salary_calculation_page)
+    salary_data, payroll_period = get_month_salary_data(db, year, month, selected_employee, selected_route)
     
     # Tạo workbook Excel
     wb = Workbook()
@@ -2709,6 +6998,8 @@ async def export_salary_calculation_excel(
     
     # Thông tin tháng
     month_text = f"Tháng: {month}/{year}"
+    if payroll_period:
+        month_text += f" (đã chốt {payroll_period.closed_at.strftime('%d/%m/%Y')})"
     ws.merge_cells('A2:F2')
     ws['A2'] = month_text
     ws['A2'].alignment = Alignment(horizontal="center")
@@ -2771,12 +7062,188 @@ async def export_salary_calculation_excel(
         headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
     )
 
+PAYROLL_BATCH_WORKERS = 6  # Số tháng tính song song khi xuất lương cả năm
+
+def _load_month_payroll(year: int, month: int) -> tuple:
+    """Lương một tháng trên session riêng (chạy trong thread pool, mỗi thread một kết nối đọc)"""
+    db = SessionLocal()
+    try:
+        salary_data, period = get_month_salary_data(db, year, month)
+        return month, salary_data, period is not None
+    finally:
+        db.close()
+
+@app.get("/salary-calculation/export-year-excel")
+async def export_salary_year_excel(year: Optional[int] = None):
+    """Xuất Excel lương cả năm: mỗi tháng một sheet (có dòng cộng theo lái xe) + sheet tổng hợp.
+    Các tháng được tính song song nên thời gian xấp xỉ tháng chậm nhất."""
+    from concurrent.futures import ThreadPoolExecutor
+    
+    today = date.today()
+    year = year or today.year
+    if not is_valid_report_period(None, year):
+        return JSONResponse({"success": False, "message": "Năm không hợp lệ"}, status_code=400)
+    # Năm hiện tại chỉ lấy đến tháng hiện tại
+    months = range(1, (today.month if year == today.year else 12) + 1) if year <= today.year else range(0)
+    
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=PAYROLL_BATCH_WORKERS) as executor:
+        results = await asyncio.gather(*(
+            loop.run_in_executor(executor, _load_month_payroll, year, month) for month in months
+        ))
+    
+    # Ghép workbook (openpyxl không an toàn đa luồng -> làm tuần tự)
+    wb = Workbook()
+    summary_ws = wb.active
+    summary_ws.title = "Tổng hợp năm"
+    
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+    header_alignment = Alignment(horizontal="center", vertical="center")
+    subtotal_fill = PatternFill(start_color="D9E1F2", end_color="D9E1F2", fill_type="solid")
+    
+    driver_month_totals = {}  # driver_name -> {month: tổng lương}
+    for month, salary_data, is_closed in results:
+        ws = wb.create_sheet(title=f"Tháng {month:02d}")
+        ws.merge_cells('A1:G1')
+        ws['A1'] = f"BẢNG TÍNH LƯƠNG THÁNG {month}/{year}"
+        ws['A1'].font = Font(bold=True, size=16)
+        ws['A1'].alignment = Alignment(horizontal="center")
+        ws.merge_cells('A2:G2')
+        ws['A2'] = "Đã chốt lương" if is_closed else "Tạm tính (chưa chốt)"
+        ws['A2'].alignment = Alignment(horizontal="center")
+        ws['A2'].font = Font(italic=True)
+        
+        headers = ["STT", "Họ và tên lái xe", "Mã tuyến", "Ngày chạy", "Biển số xe", "Số km", "Lương chuyến (VNĐ)"]
+        for col, header in enumerate(headers, 1):
+            cell = ws.cell(row=4, column=col, value=header)
+            cell.font = header_font
+            cell.fill = header_fill
+            cell.alignment = header_alignment
+        
+        # Nhóm theo lái xe, mỗi nhóm kết thúc bằng dòng cộng
+        row = 5
+        stt = 0
+        month_total = 0
+        trips_by_driver = {}
+        for item in salary_data:
+            trips_by_driver.setdefault(item['driver_name'], []).append(item)
+            driver_totals = driver_month_totals.setdefault(item['driver_name'], {})
+            driver_totals[month] = driver_totals.get(month, 0) + item['daily_salary']
+        for driver_name in sorted(trips_by_driver):
+            driver_items = sorted(trips_by_driver[driver_name], key=lambda item: (item['date'], item['route_code']))
+            for item in driver_items:
+                stt += 1
+                ws.cell(row=row, column=1, value=stt)
+                ws.cell(row=row, column=2, value=item['driver_name'])
+                ws.cell(row=row, column=3, value=item['route_code'])
+                ws.cell(row=row, column=4, value=item['date'].strftime('%d/%m/%Y'))
+                ws.cell(row=row, column=5, value=item['license_plate'])
+                ws.cell(row=row, column=6, value=item['distance_km'])
+                ws.cell(row=row, column=7, value=item['daily_salary']).number_format = '#,##0'
+                row += 1
+            driver_total = driver_month_totals[driver_name][month]
+            month_total += driver_total
+            ws.cell(row=row, column=2, value=f"Cộng {driver_name} ({len(driver_items)} chuyến)")
+            ws.cell(row=row, column=6, value=sum(item['distance_km'] for item in driver_items))
+            ws.cell(row=row, column=7, value=driver_total).number_format = '#,##0'
+            for col in range(1, 8):
+                ws.cell(row=row, column=col).font = Font(bold=True)
+                ws.cell(row=row, column=col).fill = subtotal_fill
+            row += 1
+        
+        ws.cell(row=row, column=1, value="TỔNG CỘNG").font = Font(bold=True)
+        ws.cell(row=row, column=7, value=month_total).font = Font(bold=True)
+        ws.cell(row=row, column=7).number_format = '#,##0'
+        for col, width in enumerate([8, 25, 15, 15, 20, 10, 20], 1):
+            ws.column_dimensions[get_column_letter(col)].width = width
+    
+    # Sheet tổng hợp: lái xe × tháng
+    last_col = len(results) + 3
+    summary_ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=max(last_col, 3))
+    summary_ws['A1'] = f"TỔNG HỢP LƯƠNG NĂM {year}"
+    summary_ws['A1'].font = Font(bold=True, size=16)
+    summary_ws['A1'].alignment = Alignment(horizontal="center")
+    closed_months = [str(month) for month, _, is_closed in results if is_closed]
+    summary_ws.merge_cells(start_row=2, start_column=1, end_row=2, end_column=max(last_col, 3))
+    summary_ws['A2'] = f"Tháng đã chốt: {', '.join(closed_months)}" if closed_months else "Chưa có tháng nào được chốt"
+    summary_ws['A2'].alignment = Alignment(horizontal="center")
+    summary_ws['A2'].font = Font(italic=True)
+    
+    headers = ["STT", "Họ và tên lái xe"] + [f"Tháng {month}" for month, _, _ in results] + ["Cả năm"]
+    for col, header in enumerate(headers, 1):
+        cell = summary_ws.cell(row=4, column=col, value=header)
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = header_alignment
+    
+    row = 5
+    for stt, driver_name in enumerate(sorted(driver_month_totals), 1):
+        summary_ws.cell(row=row, column=1, value=stt)
+        summary_ws.cell(row=row, column=2, value=driver_name)
+        for col, (month, _, _) in enumerate(results, 3):
+            summary_ws.cell(row=row, column=col, value=driver_month_totals[driver_name].get(month, 0)).number_format = '#,##0'
+        summary_ws.cell(row=row, column=last_col, value=sum(driver_month_totals[driver_name].values())).number_format = '#,##0'
+        summary_ws.cell(row=row, column=last_col).font = Font(bold=True)
+        row += 1
+    summary_ws.cell(row=row, column=1, value="TỔNG CỘNG").font = Font(bold=True)
+    for col in range(3, last_col + 1):
+        column_total = sum(summary_ws.cell(row=r, column=col).value or 0 for r in range(5, row))
+        summary_ws.cell(row=row, column=col, value=column_total).font = Font(bold=True)
+        summary_ws.cell(row=row, column=col).number_format = '#,##0'
+    summary_ws.column_dimensions['A'].width = 8
+    summary_ws.column_dimensions['B'].width = 25
+    for col in range(3, last_col + 1):
+        summary_ws.column_dimensions[get_column_letter(col)].width = 15
+    
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    
+    filename = f"BangTinhLuong_Nam_{year}.xlsx"
+    
+    return Response(
+        content=output.getvalue(),
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
+    )
+
+def _finance_report_query(db: Session, month: int, year: int):
+    """Query thu chi của một tháng (lọc theo khoảng ngày để dùng được index)"""
+    if not is_valid_report_period(month, year):
+        # Tháng/năm không hợp lệ: trả về rỗng như khi lọc bằng extract() trước đây
+        return db.query(FinanceTransaction).filter(false())
+    from_date, to_date = _month_date_range(month, year)
+    return db.query(FinanceTransaction).filter(
+        FinanceTransaction.date >= from_date,
+        FinanceTransaction.date <= to_date
+    )
+
+def _finance_report_totals(finance_query) -> dict:
+    total_records, total_income, total_expense, total_amount = finance_query.with_entities(
+        func.count(FinanceTransaction.id),
+        func.coalesce(func.sum(case((FinanceTransaction.transaction_type == "Thu", FinanceTransaction.total), else_=0)), 0),
+        func.coalesce(func.sum(case((FinanceTransaction.transaction_type == "Chi", FinanceTransaction.total), else_=0)), 0),
+        func.coalesce(func.sum(FinanceTransaction.amount), 0)
+    ).one()
+    return {
+        "total_records": total_records,
+        "total_income": total_income,
+        "total_expense": total_expense,
+        "total_balance": total_income - total_expense,
+        "total_amount": total_amount,
+    }
+
 @app.get("/finance-report", response_class=HTMLResponse)
 async def finance_report_page(
     request: Request, 
     db: Session = Depends(get_db),
     month: Optional[int] = None,
-    year: Optional[int] = None
+    year: Optional[int] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    start: int = 1,
+    limit: int = REPORT_PAGE_SIZE
 ):
     # Mặc định là tháng hiện tại nếu không có tham số
     if not month or not year:
@@ -2784,29 +7251,56 @@ async def finance_report_page(
         month = month or current_date.month
         year = year or current_date.year
     
-    # Lấy dữ liệu tài chính từ bảng FinanceTransaction riêng biệt
-    finance_data = db.query(FinanceTransaction).filter(
-        and_(
-            extract('month', FinanceTransaction.date) == month,
-            extract('year', FinanceTransaction.date) == year
-        )
-    ).order_by(FinanceTransaction.date.desc()).all()
-    
-    # Tính tổng từ bảng mới
-    total_income = sum(item.total for item in finance_data if item.transaction_type == "Thu")
-    total_expense = sum(item.total for item in finance_data if item.transaction_type == "Chi")
-    total_balance = total_income - total_expense
+    # Lấy dữ liệu tài chính từ bảng FinanceTransaction riêng biệt, tổng tính riêng cho cả tháng
+    finance_query = _finance_report_query(db, month, year)
+    page = keyset_page(finance_query, FinanceTransaction, after, before, limit, descending=True)
     
     return templates.TemplateResponse("finance_report.html", {
         "request": request,
-        "finance_data": finance_data,
-        "total_income": total_income,
-        "total_expense": total_expense,
-        "total_balance": total_balance,
+        "finance_data": page["items"],
+        "pagination": build_page_links(request, page, start),
         "selected_month": month,
-        "selected_year": year
+        "selected_year": year,
+        **_finance_report_totals(finance_query)
     })
 
+@app.get("/api/finance-report")
+async def finance_report_api(
+    db: Session = Depends(get_db),
+    month: Optional[int] = None,
+    year: Optional[int] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    limit: int = REPORT_PAGE_SIZE
+):
+    """Giao dịch thu chi của tháng theo trang (mới nhất trước) kèm tổng cả tháng"""
+    if not month or not year:
+        current_date = datetime.now()
+        month = month or current_date.month
+        year = year or current_date.year
+    finance_query = _finance_report_query(db, month, year)
+    page = keyset_page(finance_query, FinanceTransaction, after, before, limit, descending=True)
+    return {
+        "success": True,
+        "items": [{
+            "id": item.id,
+            "date": item.date.strftime("%Y-%m-%d"),
+            "transaction_type": item.transaction_type,
+            "category": item.category,
+            "description": item.description,
+            "route_code": item.route_code or "",
+            "amount": item.amount or 0,
+            "vat": item.vat or 0,
+            "discount1": item.discount1 or 0,
+            "discount2": item.discount2 or 0,
+            "total": item.total or 0,
+            "note": item.note or ""
+        } for item in page["items"]],
+        "next_cursor": page["next_cursor"],
+        "prev_cursor": page["prev_cursor"],
+        "totals": _finance_report_totals(finance_query),
+    }
+
 @app.get("/finance-report/export")
 async def export_finance_report_excel(
     db: Session = Depends(get_db),
@@ -3002,6 +7496,7 @@ async def create_sample_finance_data(db: Session = Depends(get_db)):
     
     # Xóa dữ liệu cũ nếu có
     db.query(FinanceTransaction).delete()
+    mark_data_changed(db, "finance_transactions")
     
     # Thêm dữ liệu mẫu vào bảng mới
     for data in sample_data:
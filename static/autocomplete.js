@@ -0,0 +1,67 @@
+// Gợi ý nhập liệu lái xe / biển số.
+// Mỗi trang chỉ có một <datalist> cho mỗi loại; nội dung lấy theo từ khoá từ /api/autocomplete
+// (có ETag nên trình duyệt chỉ nhận 304 khi danh sách không đổi) thay vì in sẵn toàn bộ <option>.
+// Ô nhập: <input list="driverSuggestions" data-autocomplete="driver">; khi rời ô, giá trị được chuẩn hoá
+// về đúng tên/biển số trong danh sách rồi phát sự kiện "autocomplete:resolved".
+// Từ lúc gõ đến khi chuẩn hoá xong ô có data-autocomplete-pending; không khớp danh sách thì ô không hợp lệ (checkValidity).
+const AUTOCOMPLETE_DELAY_MS = 150;
+
+function normalizeAutocompleteText(kind, value) {
+    const folded = (value || '').replace(/đ/g, 'd').replace(/Đ/g, 'D')
+        .normalize('NFD').replace(/[\u0300-\u036f]/g, '').toLowerCase();
+    return kind === 'plate' ? folded.replace(/[^0-9a-z]/g, '') : folded.split(/\s+/).filter(Boolean).join(' ');
+}
+
+function fetchAutocomplete(kind, q) {
+    return fetch(`/api/autocomplete?kind=${kind}&q=${encodeURIComponent(q)}`)
+        .then(response => response.json())
+        .then(result => result.success ? result.items : [])
+        .catch(() => []);
+}
+
+function fillAutocompleteList(input, items) {
+    const datalist = document.getElementById(input.getAttribute('list'));
+    datalist.replaceChildren(...items.map(item => {
+        const option = document.createElement('option');
+        option.value = item;
+        return option;
+    }));
+}
+
+async function resolveAutocompleteValue(input) {
+    const kind = input.dataset.autocomplete;
+    const value = input.value.trim();
+    if (value) {
+        input.dataset.autocompletePending = 'true';
+        const items = await fetchAutocomplete(kind, value);
+        const exact = items.find(item => normalizeAutocompleteText(kind, item) === normalizeAutocompleteText(kind, value));
+        const resolved = exact || (items.length === 1 ? items[0] : null);
+        if (!resolved) {
+            input.setCustomValidity(kind === 'plate' ? 'Chọn biển số xe trong danh sách' : 'Chọn lái xe trong danh sách');
+            input.reportValidity();
+            return;
+        }
+        input.value = resolved;
+    }
+    input.setCustomValidity('');
+    delete input.dataset.autocompletePending;
+    input.dispatchEvent(new CustomEvent('autocomplete:resolved', { bubbles: true }));
+}
+
+function attachAutocomplete(input) {
+    const kind = input.dataset.autocomplete;
+    let timer = null;
+    input.setAttribute('autocomplete', 'off');
+    input.addEventListener('focus', () => fetchAutocomplete(kind, input.value).then(items => fillAutocompleteList(input, items)));
+    input.addEventListener('input', () => {
+        input.setCustomValidity('');
+        input.dataset.autocompletePending = 'true';
+        clearTimeout(timer);
+        timer = setTimeout(() => {
+            fetchAutocomplete(kind, input.value).then(items => fillAutocompleteList(input, items));
+        }, AUTOCOMPLETE_DELAY_MS);
+    });
+    input.addEventListener('change', () => resolveAutocompleteValue(input));
+}
+
+document.querySelectorAll('input[data-autocomplete]').forEach(attachAutocomplete);